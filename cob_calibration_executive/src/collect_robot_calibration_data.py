@@ -64,15 +64,32 @@ import rospy
 from simple_script_server import simple_script_server
 from cob_calibration_msgs.srv import Visible, Capture
 from cob_calibration_msgs.msg import Progress
+from std_msgs.msg import Bool
 import yaml
 import tf
 from cob_srvs.srv import SetJointStiffnessRequest, SetJointStiffness
 
 
-def capture_loop(positions, sss, visible, capture_kinematics, capture_image):
+class ConvergenceMonitor():
+
+    '''
+    @summary: Tracks whether the online calibration (online_cov_estimator.py of
+    cob_robot_calibration_est) reports its estimate as converged.
+    '''
+
+    def __init__(self, topic):
+        self.converged = False
+        rospy.Subscriber(topic, Bool, self._callback)
+
+    def _callback(self, msg):
+        self.converged = msg.data
+
+
+def capture_loop(positions, sss, visible, capture_kinematics, capture_image, monitor=None):
     '''
     Moves arm to all positions using script server instance sss
-    and calls capture() to capture samples
+    and calls capture() to capture samples. Stops early once the
+    ConvergenceMonitor monitor reports convergence
     '''
     progress_pub = rospy.Publisher(
         "/calibration/data_collection/progress", Progress)
@@ -81,6 +98,9 @@ def capture_loop(positions, sss, visible, capture_kinematics, capture_image):
     counter_kinematics = 0
     msg = Progress()
     for index in range(len(positions)):
+        if monitor is not None and monitor.converged:
+            print "--> online calibration converged, skipping the remaining %u positions" % (len(positions) - index)
+            break
         msg.Percent_done = round(100.0 * index / len(positions), 2)
         msg.Samples_left = len(positions) - index
         progress_pub.publish(msg)
@@ -187,9 +207,14 @@ def main():
         return
     with open(position_path, 'r') as f:
         positions = yaml.load(f)
+    # optionally stop as soon as the online calibration converged
+    monitor = None
+    if rospy.get_param('~stop_on_convergence', False):
+        monitor = ConvergenceMonitor(rospy.get_param(
+            '~convergence_topic', '/online_cov_estimator/converged'))
     print "==> capturing samples"
     start = rospy.Time.now()
-    capture_loop(positions, sss, visible, capture_kinematics, capture_image)
+    capture_loop(positions, sss, visible, capture_kinematics, capture_image, monitor)
     sss.move("arm", "calibration")
     print "finished after %s seconds" % (rospy.Time.now() - start).to_sec()
 
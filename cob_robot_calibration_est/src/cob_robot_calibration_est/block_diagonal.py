@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+# Helpers for block diagonal matrices that are stored compactly as an Nxkxk
+# array holding the N diagonal blocks of size kxk
+
+import numpy
+from numpy import zeros, matrix
+
+
+def inv_sqrt_blocks(blocks):
+    """
+    Computes the inverse square root of every symmetric positive definite block, i.e.
+    sqrtm(inv(block)) for all blocks at once. 2x2 blocks are handled in closed form,
+    all other block sizes by a batched eigen decomposition.
+    Input:
+    - blocks: Nxkxk array
+    Returns: Nxkxk array
+    """
+    blocks = numpy.asarray(blocks, float)
+    if blocks.shape[1:] == (2, 2):
+        a = blocks[:, 0, 0]
+        b = 0.5 * (blocks[:, 0, 1] + blocks[:, 1, 0])
+        c = blocks[:, 1, 1]
+        det = a * c - b * b
+        if numpy.any(det <= 0) or numpy.any(a <= 0):
+            raise numpy.linalg.LinAlgError("Covariance block is not positive definite")
+        # sqrtm(A) = (A + s*I) / t with s = sqrt(det(A)) and t = sqrt(trace(A) + 2s),
+        # so inv(sqrtm(A)) = t * inv(A + s*I)
+        s = numpy.sqrt(det)
+        t = numpy.sqrt(a + c + 2 * s)
+        scale = t / ((a + s) * (c + s) - b * b)
+        result = zeros(blocks.shape)
+        result[:, 0, 0] = scale * (c + s)
+        result[:, 0, 1] = -scale * b
+        result[:, 1, 0] = -scale * b
+        result[:, 1, 1] = scale * (a + s)
+        return result
+
+    w, V = numpy.linalg.eigh(blocks)
+    if numpy.any(w <= 0):
+        raise numpy.linalg.LinAlgError("Covariance block is not positive definite")
+    return numpy.einsum('nik,nk,njk->nij', V, 1.0 / numpy.sqrt(w), V)
+
+
+def scale_blocks(blocks, m):
+    """
+    Multiplies the block diagonal matrix with a vector or a matrix
+    Inputs:
+    - blocks: Nxkxk array
+    - m: Vector of length kN or (kN)xC array
+    Returns: Product with the same shape as m
+    """
+    N, k = blocks.shape[0:2]
+    m = numpy.asarray(m)
+    if m.ndim == 1:
+        return numpy.einsum('nij,nj->ni', blocks, m.reshape(N, k)).reshape(-1)
+    return numpy.einsum('nij,njc->nic', blocks, m.reshape(N, k, -1)).reshape(N * k, -1)
+
+
+def dense_blocks(blocks):
+    """
+    Expands the blocks into the full (kN)x(kN) block diagonal matrix
+    """
+    N, k = blocks.shape[0:2]
+    result = zeros([N * k, N * k])
+    for n in range(N):
+        result[n*k:(n+1)*k, n*k:(n+1)*k] = blocks[n]
+    return matrix(result)
+
+
+def diagonal_blocks(m, k):
+    """
+    Extracts the kxk blocks on the diagonal of the (kN)x(kN) matrix m
+    Returns: Nxkxk array
+    """
+    m = numpy.asarray(m)
+    N = m.shape[0] // k
+    idx = numpy.arange(N * k).reshape(N, k)
+    return m[idx[:, :, None], idx[:, None, :]]
@@ -32,7 +32,8 @@
 
 import numpy
 from numpy import matrix, array, vsplit, sin, cos, reshape, ones, append
-import rospy
+from cob_robot_calibration_est.ros_support import logger
+from cob_robot_calibration_est.profiling import timed
 
 
 param_names = ['baseline_shift', 'f_shift', 'cx_shift', 'cy_shift']
@@ -45,9 +46,11 @@ class RectifiedCamera:
     Parameters are ordered as follows [baseline_shift, f_shift, cx_shift, cy_shift]
     '''
     def __init__(self, config):
-        rospy.logdebug("Initializng rectified camera")
+        logger.debug("Initializng rectified camera")
         self._config = config
         self._cov_dict = config['cov']
+        # Projection matrices by id(P_list) and shifts, see projection_matrix
+        self._projection_matrices = {}
 
     def calc_free(self, free_config):
         return [free_config[x] == 1 for x in param_names]
@@ -63,6 +66,9 @@ class RectifiedCamera:
     def inflate(self, param_vec):
         param_list = array(param_vec)[:,0].tolist()
         for x,y in zip(param_names, param_list):
+            if self._config[x] != y:
+                # The shifts changed, so all cached projection matrices are outdated
+                self._projection_matrices = {}
             self._config[x] = y
 
     # Return column vector of config. In this case, it's always a 4x1 matrix
@@ -76,39 +82,85 @@ class RectifiedCamera:
     def get_param_names(self):
         return param_names;
 
+    # Build the 3x4 projection matrix, including the current parameter shifts
+    # P_list - Projection matrix. We expect this to be a 1x9 list. We then reshape
+    #          it into a 3x3 matrix (by filling 1 row at a time) and append a zero column.
+    #          A 1x12 list is reshaped into the 3x4 matrix directly.
+    # The matrix is built once for every P_list and set of shifts and kept until the next
+    # inflate that changes the shifts, so it is read-only.
+    def projection_matrix(self, P_list):
+        key = (id(P_list),) + tuple(self._config[x] for x in param_names)
+        if key not in self._projection_matrices:
+            # Reshape P_list into an actual matrix
+            P = matrix(P_list, float)
+            if P.size == 12:
+                P = reshape(P, (3,4))
+            else:
+                P = reshape(P, (3,3))
+                P = append(P.T, [[0,0,0]], axis=0).T
+
+            # Update the baseline by the "baseline_shift"
+            P[0,3] = P[0,3] + self._config['baseline_shift']
+            P[0,0] = P[0,0] + self._config['f_shift']
+            P[1,1] = P[1,1] + self._config['f_shift']
+            P[0,2] = P[0,2] + self._config['cx_shift']
+            P[1,2] = P[1,2] + self._config['cy_shift']
+            P.setflags(write=False)
+            # Keep P_list alive, so that its id can't be reused
+            self._projection_matrices[key] = (P_list, P)
+        return self._projection_matrices[key][1]
+
     # Project a set of 3D points points into pixel coordinates
-    # P_list - Projection matrix. We expect this to be a 1x12 list. We then reshape
-    #          it into a 3x4 matrix (by filling 1 row at a time)
+    # P_list - Projection matrix (see projection_matrix)
     # pts - 4xN numpy matrix holding the points that we want to project (homogenous coords)
     def project(self, P_list, pts):
-        N = pts.shape[1]
-
-        # Reshape P_list into an actual matrix
-        P = reshape( matrix(P_list, float), (3,3) )
-        P = append(P.T, [[0,0,0]], axis=0).T
-
-        # Update the baseline by the "baseline_shift"
-        P[0,3] = P[0,3] + self._config['baseline_shift']
-        P[0,0] = P[0,0] + self._config['f_shift']
-        P[1,1] = P[1,1] + self._config['f_shift']
-        P[0,2] = P[0,2] + self._config['cx_shift']
-        P[1,2] = P[1,2] + self._config['cy_shift']
-
-        #import code; code.interact(local=locals())
         if (pts.shape[0] == 3):
-            rospy.logfatal("Got vector of points with only 3 rows. Was expecting at 4 rows (homogenous coordinates)")
-
-
-        # Apply projection matrix
-        pixel_pts_h = P * pts
-
-        # print "pixel_points_h"
-        # print pixel_pts_h
-
-        #import code; code.interact(local=locals())
+            logger.critical("Got vector of points with only 3 rows. Was expecting at 4 rows (homogenous coordinates)")
+        return matrix(self.project_batch(P_list, array(pts, float)[numpy.newaxis])[0])
 
+    # Project a set of 3D points into pixel coordinates and compute the derivatives of the projection
+    # P_list - Projection matrix (see projection_matrix)
+    # pts - 4xN numpy matrix holding the points that we want to project (homogenous coords)
+    # Returns (pixel_pts, J_params, J_pts):
+    #  - pixel_pts: 2xN array, same as project
+    #  - J_params: Nx2x4 array, derivatives of (u,v) w.r.t. [baseline_shift, f_shift, cx_shift, cy_shift]
+    #  - J_pts: Nx2x3 array, derivatives of (u,v) w.r.t. the cartesian coordinates of the point
+    def project_jacobian(self, P_list, pts):
+        pixel_pts, J_params, J_pts = self.project_batch_jacobian(P_list, array(pts, float)[numpy.newaxis])
+        return pixel_pts[0], J_params[0], J_pts[0]
+
+    # Same as project, but for the points of M samples at once
+    # pts - Mx4xN array of points (homogenous coords)
+    # Returns: Mx2xN array of pixel coordinates
+    @timed('camera.project')
+    def project_batch(self, P_list, pts):
+        P = numpy.asarray(self.projection_matrix(P_list))
+        pixel_pts_h = numpy.einsum('ij,mjn->min', P, pts)
         # Strip out last row (3rd) and rescale
-        pixel_pts = pixel_pts_h[0:2,:] / pixel_pts_h[2,:]
-
-        return pixel_pts
-
+        return pixel_pts_h[:,0:2,:] / pixel_pts_h[:,2:3,:]
+
+    # Same as project_jacobian, but for the points of M samples at once
+    # pts - Mx4xN array of points (homogenous coords)
+    # Returns (pixel_pts, J_params, J_pts):
+    #  - pixel_pts: Mx2xN array
+    #  - J_params: MxNx2x4 array
+    #  - J_pts: MxNx2x3 array
+    @timed('camera.project_jacobian')
+    def project_batch_jacobian(self, P_list, pts):
+        P = numpy.asarray(self.projection_matrix(P_list))
+        M, _, N = pts.shape
+        pixel_pts_h = numpy.einsum('ij,mjn->min', P, pts)
+        w = pixel_pts_h[:,2,:]
+        pixel_pts = pixel_pts_h[:,0:2,:] / w[:,numpy.newaxis,:]
+
+        J_params = numpy.zeros((M,N,2,4))
+        J_params[:,:,0,0] = pts[:,3,:] / w
+        J_params[:,:,0,1] = pts[:,0,:] / w
+        J_params[:,:,1,1] = pts[:,1,:] / w
+        J_params[:,:,0,2] = pts[:,2,:] / w
+        J_params[:,:,1,3] = pts[:,2,:] / w
+
+        # d(h_i/w)/dX_j = (P[i,j] - (h_i/w) * P[2,j]) / w
+        J_pts = (P[0:2,0:3] - pixel_pts.transpose(0,2,1)[:,:,:,numpy.newaxis] * P[2,0:3]) / w[:,:,numpy.newaxis,numpy.newaxis]
+
+        return pixel_pts, J_params, J_pts
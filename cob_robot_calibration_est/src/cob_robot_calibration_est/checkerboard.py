@@ -32,7 +32,7 @@
 
 import numpy
 from numpy import matrix, vsplit, sin, cos, reshape
-import rospy
+from cob_robot_calibration_est.ros_support import logger
 
 # Primitive used to model PR2's tilting laser platform. Consists of 2 fixed transforms.
 # One before the joint, and one after. The joint axis is the x-axis after the first transform
@@ -48,9 +48,11 @@ class Checkerboard:
                                  "corners_y": 2,
                                  "spacing_x": .10,
                                  "spacing_y": .10} ):
-        rospy.logdebug("Initializing Checkerboard")
+        logger.debug("Initializing Checkerboard")
         self._corners_x = config["corners_x"]
         self._corners_y = config["corners_y"]
+        self._points = None
+        self._points_jacobian = None
 
         param_vec = reshape( matrix([ config["spacing_x"], config["spacing_y"] ], float), (-1,1))
         assert(param_vec.size == 2)
@@ -70,8 +72,12 @@ class Checkerboard:
 
     # Convert column vector of params into config
     def inflate(self, param_vec):
-        self._spacing_x = param_vec[0,0]
-        self._spacing_y = param_vec[1,0]
+        spacing = (param_vec[0,0], param_vec[1,0])
+        if self._points is not None and spacing == (self._spacing_x, self._spacing_y):
+            return
+        self._spacing_x, self._spacing_y = spacing
+        # The points are regenerated on demand, see generate_points
+        self._points = None
 
     # Return column vector of config
     def deflate(self):
@@ -82,16 +88,29 @@ class Checkerboard:
     def get_length(self):
         return 2
 
+    # Returns the names of the params, in the same order as deflate
+    def get_param_names(self):
+        return ["spacing_x", "spacing_y"]
+
     # Generate the 3D points associated with all the corners of the checkerboard
-    # returns - 4xN numpy matrix with all the points (in homogenous coords)
+    # returns - 4xN numpy matrix with all the points (in homogenous coords). The matrix is
+    #           cached until the next inflate, so it is read-only
     def generate_points(self):
-        N = self._corners_x * self._corners_y
-        pts = matrix(numpy.zeros((4,N), float))
-        for y in range(0,self._corners_y):
-            for x in range(0,self._corners_x):
-                n = y*self._corners_x + x
-                pts[:,n] = numpy.matrix([ [x * self._spacing_x],
-                                          [y * self._spacing_y],
-                                          [0],
-                                          [1] ])
-        return pts
+        if self._points is None:
+            pts = numpy.tensordot(numpy.array([self._spacing_x, self._spacing_y], float), self.generate_points_jacobian(), 1)
+            pts[3,:] = 1.0
+            self._points = matrix(pts)
+            self._points.setflags(write=False)
+        return self._points
+
+    # Derivatives of generate_points w.r.t. [spacing_x, spacing_y]
+    # returns - 2x4xN array (read-only)
+    def generate_points_jacobian(self):
+        if self._points_jacobian is None:
+            N = self._corners_x * self._corners_y
+            dpts = numpy.zeros((2,4,N))
+            dpts[0,0,:] = numpy.tile(numpy.arange(self._corners_x), self._corners_y)
+            dpts[1,1,:] = numpy.repeat(numpy.arange(self._corners_y), self._corners_x)
+            dpts.setflags(write=False)
+            self._points_jacobian = dpts
+        return self._points_jacobian
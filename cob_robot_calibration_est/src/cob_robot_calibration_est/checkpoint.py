@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+# Checkpoints of the calibration steps of multi_step_cov_estimator.py
+#
+# Every step is identified by a hash over everything its result depends on (the bag,
+# the system it starts from, the pose guesses, the free parameters, the sensors and the
+# solver options), so a checkpoint can never be used for a step that changed. The
+# checkpoint of a step lives in its own directory named after that hash:
+#   result.yaml:  system and checkerboard poses of the finished step
+#   information.npz: sparse normal matrix (J'*J) of the finished step (see covariance.py)
+#   snapshot.npy: best optimization vector seen so far, written periodically while the
+#                 step is running, so that an interrupted step can resume from there
+
+import hashlib
+import json
+import os
+import time
+import yaml
+import numpy
+
+from cob_robot_calibration_est.covariance import save_sparse, load_sparse
+
+
+def step_key(bag_key, system, pose_guesses, free_params, sensors, options):
+    """
+    Hash of a calibration step. All inputs need to be plain yaml/json types, except for
+    pose_guesses, which is an Mx6 array.
+    """
+    step = {'bag': bag_key,
+            'system': system,
+            'poses': numpy.asarray(pose_guesses, float).tolist(),
+            'free_params': free_params,
+            'sensors': sensors,
+            'options': options}
+    return hashlib.sha1(json.dumps(step, sort_keys=True, default=lambda x: numpy.asarray(x).tolist())).hexdigest()
+
+
+def write_atomic(filename, write):
+    """
+    Calls write(f) on a temporary file, which then replaces filename. Readers thus never see
+    a partially written file, even if the process is killed while writing.
+    """
+    tmp_filename = "%s.tmp%u" % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        write(f)
+    os.rename(tmp_filename, filename)
+
+
+class StepCheckpoint:
+    """
+    Checkpoint of a single calibration step in checkpoint_dir/key. Pass snapshot as snapshot
+    callback to an ErrorCalc to store the best optimization vector at most every interval seconds.
+    """
+    def __init__(self, checkpoint_dir, key, interval=60.0):
+        self._path = os.path.join(checkpoint_dir, key)
+        self._interval = interval
+        self._best = None
+        self._best_cost = None
+        self._written = True
+        self._last_write = time.time()
+        if not os.path.isdir(self._path):
+            os.makedirs(self._path)
+
+    def load_result(self):
+        """
+        Returns (system, poses, information) of the finished step, or None if the step didn't finish yet
+        """
+        filename = os.path.join(self._path, 'result.yaml')
+        information_filename = os.path.join(self._path, 'information.npz')
+        if not os.path.isfile(filename) or not os.path.isfile(information_filename):
+            return None
+        with open(filename) as f:
+            result = yaml.load(f)
+        information = load_sparse(information_filename)
+        return result['system'], numpy.array(result['poses'], float).reshape(-1, 6), information
+
+    def save_result(self, system, poses, information):
+        # The normal matrix is written first, as result.yaml marks the step as finished
+        write_atomic(os.path.join(self._path, 'information.npz'), lambda f: save_sparse(f, information))
+        result = {'system': system, 'poses': [[float(x) for x in pose] for pose in poses]}
+        write_atomic(os.path.join(self._path, 'result.yaml'), lambda f: yaml.dump(result, f))
+
+    def load_snapshot(self, size):
+        """
+        Returns the optimization vector of the last snapshot, or None if there is none of the given size
+        """
+        filename = os.path.join(self._path, 'snapshot.npy')
+        if not os.path.isfile(filename):
+            return None
+        x = numpy.load(filename)
+        if x.shape != (size,):
+            return None
+        return x
+
+    def snapshot(self, x, r):
+        """
+        Keeps x if its residual r is the best so far, and writes it if the last write is more
+        than interval seconds ago
+        """
+        cost = numpy.dot(r, r)
+        if self._best_cost is None or cost < self._best_cost:
+            self._best = numpy.array(x, float)
+            self._best_cost = cost
+            self._written = False
+        if time.time() - self._last_write >= self._interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the best optimization vector, unless it has been written already
+        """
+        if not self._written:
+            write_atomic(os.path.join(self._path, 'snapshot.npy'), lambda f: numpy.save(f, self._best))
+            self._written = True
+        self._last_write = time.time()
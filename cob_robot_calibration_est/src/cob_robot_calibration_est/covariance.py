@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+
+# Covariance of the results of a calibration step.
+#
+# The normal matrix J'*J of a step is kept sparse: besides the free system parameters, it only
+# has a 6x6 block on the diagonal for every checkerboard pose and the coupling of each pose with
+# the parameters. The marginal covariance of the system parameters is the inverse of the Schur
+# complement of these pose blocks, so the dense (F + 6M)x(F + 6M) matrix is never formed.
+# If the residuals are scaled by the measurement covariances (use_cov), J'*J is the information
+# matrix, otherwise the covariance is only known up to the variance of the residuals.
+
+import numpy
+import scipy.sparse
+from numpy import zeros
+
+
+def normal_matrix(J):
+    """
+    Computes J'*J of a dense or sparse jacobian
+    Returns: scipy.sparse.csr_matrix
+    """
+    J = scipy.sparse.csr_matrix(J)
+    return (J.T * J).tocsr()
+
+
+def marginal_information(N, num_poses):
+    """
+    Schur complement of the pose blocks of a normal matrix, i.e. the information about the system
+    parameters after the checkerboard poses are marginalized
+    Inputs:
+    - N: Sparse (F + 6M)x(F + 6M) normal matrix, with the columns of the M poses last (see normal_matrix)
+    - num_poses: Number of poses M
+    Returns: FxF array
+    """
+    N = scipy.sparse.csr_matrix(N)
+    F = N.shape[0] - 6 * num_poses
+    A = N[:F, :F].toarray()
+    B = N[:F, F:].toarray().reshape(F, num_poses, 6)
+
+    # Only the 6x6 blocks on the diagonal of the pose section are populated
+    C_coo = N[F:, F:].tocoo()
+    same_pose = C_coo.row // 6 == C_coo.col // 6
+    assert(numpy.all(C_coo.data[~same_pose] == 0))
+    C = zeros([num_poses, 6, 6])
+    numpy.add.at(C, (C_coo.row[same_pose] // 6, C_coo.row[same_pose] % 6, C_coo.col[same_pose] % 6), C_coo.data[same_pose])
+
+    # Poses without any measurement don't carry information about the parameters. The pose blocks
+    # mix translations and rotations, so they are badly scaled and solved for rather than inverted.
+    observed = C.reshape(num_poses, -1).any(1)
+    B = B[:, observed, :]
+    X = numpy.linalg.solve(C[observed], B.transpose(1, 2, 0))
+    S = A - numpy.einsum('fmi,mig->fg', B, X)
+    return 0.5 * (S + S.T)
+
+
+def eliminate_pose(J_params, J_pose, r):
+    """
+    Marginalizes the checkerboard pose out of the linearized rows of a sample, with a QR decomposition
+    of [J_pose | J_params | r]
+    Returns: (A, e), such that |A * dp + e|^2 is the linearized cost of the sample for a change dp of the
+             system parameters, when the pose is chosen optimally
+    """
+    F = J_params.shape[1]
+    R = numpy.linalg.qr(numpy.hstack([J_pose, J_params, r.reshape(-1, 1)]), mode='r')
+    return R[6:, 6:6 + F], R[6:, 6 + F]
+
+
+def marginal_covariance(N, num_poses, rcond=1e-12):
+    """
+    Covariance of the system parameters, with the poses marginalized (see marginal_information).
+    The parameters have different units, so the rank of the marginal information is decided on its
+    normalized columns: eigenvalues below rcond times the largest one span the directions that the
+    measurements don't constrain. Parameters with a component in these directions get an infinite
+    variance and NaN covariances, the others the covariance of the pseudo inverse.
+    Returns: FxF array
+    """
+    S = marginal_information(N, num_poses)
+    F = S.shape[0]
+    if F == 0:
+        return S
+    scale = numpy.sqrt(numpy.maximum(numpy.diag(S), 0.0))
+    scale[scale == 0] = 1.0
+    w, V = numpy.linalg.eigh(S / numpy.outer(scale, scale))
+    observed = w > rcond * max(w.max(), 0.0)
+    V_obs = V[:, observed]
+    cov = numpy.dot(V_obs / w[observed], V_obs.T) / numpy.outer(scale, scale)
+    unconstrained = (V[:, ~observed] ** 2).sum(1) > 1e-8
+    cov[unconstrained, :] = numpy.nan
+    cov[:, unconstrained] = numpy.nan
+    cov[unconstrained, unconstrained] = numpy.inf
+    return cov
+
+
+def unconstrained_params(cov, names):
+    """
+    Names of the parameters of a covariance matrix of marginal_covariance that the measurements don't constrain
+    """
+    return [name for name, var in zip(names, numpy.diag(cov)) if numpy.isinf(var)]
+
+
+def save_sparse(f, M):
+    """
+    Writes a sparse matrix to the .npz file f, in the format of scipy.sparse.save_npz
+    """
+    M = scipy.sparse.csr_matrix(M)
+    numpy.savez(f, format='csr', shape=M.shape, data=M.data, indices=M.indices, indptr=M.indptr)
+
+
+def load_sparse(f):
+    """
+    Reads a sparse matrix written by save_sparse
+    Returns: scipy.sparse.csr_matrix
+    """
+    data = numpy.load(f)
+    return scipy.sparse.csr_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+
+
+def std_summary(cov, names):
+    """
+    Standard deviations of the parameters of a covariance matrix, infinite for unconstrained parameters
+    Returns: Dictionary that maps the name of every parameter to its standard deviation
+    """
+    return dict(zip(names, numpy.sqrt(numpy.maximum(numpy.diag(cov), 0.0)).tolist()))
@@ -32,9 +32,9 @@
 
 import numpy
 from numpy import matrix, vsplit, sin, cos, reshape, pi, array
-import rospy
-from PyKDL import Chain, Segment, Joint, Frame, Vector, Rotation, ChainFkSolverPos_recursive, JntArray, RigidBodyInertia
 from functools import reduce
+from cob_robot_calibration_est.profiling import timed
+from cob_robot_calibration_est.ros_support import logger
 
 class DhChain:
     def __init__(self, config = [[0, 0, 0, 0]]):
@@ -43,7 +43,7 @@ class DhChain:
         # import code; code.interact(local=locals())
         # try:
         self._M = len(config['dh'])
-        rospy.logdebug("Initializing dh chain with [%u] links", self._M)
+        logger.debug("Initializing dh chain with [%u] links", self._M)
 
         param_mat = config['dh']
 
@@ -55,6 +55,11 @@ class DhChain:
 
         self._cov_dict = config['cov']
         self._gearing = config['gearing']
+
+        # Incremented whenever the segment parameters change, which
+        # invalidates the prefetched poses
+        self._version = 0
+        self._prefetched = (None, {})
         # except:
             # self._cov_dict=config['cov']
             # self._M=len(self._cov_dict['joint_angles'])
@@ -109,6 +114,7 @@ class DhChain:
         config_dict['dh'] = self._config
         for sc, c in zip(config_dict["dh"], param_mat):
             sc["xyzrpy"] = c.tolist()[:][0]
+        self._version += 1
         config_dict['gearing'] = (array(gearing_param_vec)[:, 0]).tolist()
         config_dict['cov'] = self._cov_dict
         return config_dict
@@ -117,11 +123,19 @@ class DhChain:
     def inflate(self, param_vec):
         param_mat = param_vec[:self._M*6,:]
         config = reshape(param_mat, (-1, 6))
+        changed = False
         for sc, c in zip(self._config, config):
-            sc["xyzrpy"] = c.tolist()[:][0]
+            xyzrpy = c.tolist()[:][0]
+            if sc["xyzrpy"] != xyzrpy:
+                sc["xyzrpy"] = xyzrpy
+                changed = True
         gearing = array(param_vec[self._M*6:,:])[:, 0].tolist()
         if len(gearing) is len(self._gearing):
+            if gearing != self._gearing:
+                changed = True
             self._gearing = gearing
+        if changed:
+            self._version += 1
 
     # Return column vector of config
     def deflate(self):
@@ -138,72 +152,291 @@ class DhChain:
     def get_length(self):
         return self._M*7
 
-    # Returns 4x4 numpy matrix of the pose of the tip of
-    # the specified link num. Assumes the last link's tip
-    # when link_num < 0
-    def fk(self, chain_state, link_num=-2):
+    # Returns the names of the params, in the same order as deflate
+    def get_param_names(self):
+        return [e["name"] + "." + x for e in self._config for x in ["x", "y", "z", "roll", "pitch", "yaw"]] + \
+               [e["name"] + ".gearing" for e in self._config]
+
+    # Returns the number of segments up to the tip of link_num.
+    # Assumes the last link's tip when link_num < 0
+    def segment_count(self, link_num=-2):
         if link_num<0:
             link_num -=1
         link_num += 1
         if link_num < 0:
             link_num = self._M
+        return link_num
 
-
-        pos_scaled = [cur_pos * cur_gearing for cur_pos, cur_gearing in zip(chain_state.actual.positions,self._gearing)]
-
-        #pos_scaled = JntArray(pos_scaled)
-        jnt_states = JntArray(len(pos_scaled))
-        for i,s in enumerate(pos_scaled):
-            jnt_states[i] = s
-        self.build_chain()
-        F1=Frame()
-
-        assert(0==self.fksolverpos.JntToCart(jnt_states,F1,link_num))
-
-
-        out = []
-        for i in range(3):
-            line=[]
-            for j in range(3):
-                line.append(F1.M[i,j])
-            line.append(F1.p[i])
-            out.append(line)
-        out.append([0,0,0,1])
-        out= matrix(out)
-        return out
-    def build_chain(self):
-        self.chain = Chain()
-        for e in self._config:
-            v = Vector(e["xyzrpy"][0], e["xyzrpy"][1], e["xyzrpy"][2])
-            r = Rotation.RPY(e["xyzrpy"][3], e["xyzrpy"][4], e["xyzrpy"][5])
-            j = Joint(e["name"], Joint.None)
-
-            f = Frame(r, v)
-
-            if e["type"] == "rotx":
-                axis = Vector(1.0, 0.0, 0.0)
-                j = Joint(e["name"],f.p, f.M * axis, Joint.RotAxis)
-            elif e["type"] == "roty":
-                axis = Vector(0.0, 1.0, 0.0)
-                j = Joint(e["name"],f.p, f.M * axis, Joint.RotAxis)
-            elif e["type"] == "rotz":
-                axis = Vector(0.0, 0.0, 1.0)
-                j = Joint(e["name"],f.p, f.M * axis, Joint.RotAxis)
-            elif e["type"] == "transx":
-                axis = Vector(1.0, 0.0, 0.0)
-                j = Joint(e["name"],f.p, f.M * axis, Joint.TransAxis)
-            elif e["type"] == "transy":
-                axis = Vector(0.0, 1.0, 0.0)
-                j = Joint(e["name"],f.p, f.M * axis, Joint.TransAxis)
-            elif e["type"] == "transz":
-                axis = Vector(0.0, 0.0, 1.0)
-                j = Joint(e["name"],f.p, f.M * axis, Joint.TransAxis)
-
-
-
-            self.chain.addSegment(Segment(e["name"]+"seg", j, f, RigidBodyInertia()))
-        self.fksolverpos = ChainFkSolverPos_recursive(self.chain)
-
+    # Returns 4x4 numpy matrix of the pose of the tip of
+    # the specified link num. Assumes the last link's tip
+    # when link_num < 0
+    @timed('dh_chain.fk')
+    def fk(self, chain_state, link_num=-2):
+        segments = self.segment_count(link_num)
+        if segments == self._M:
+            T = self.prefetched_fk(chain_state)
+            if T is not None:
+                return matrix(T)
+        return matrix(batch_fk(self._config, self._gearing, [chain_state.actual.positions], segments)[0])
+
+    # Returns Nx4x4 array with the poses of the tip of the specified
+    # link num (see fk) for an NxJ array of joint positions
+    def fk_batch(self, positions, link_num=-2):
+        return batch_fk(self._config, self._gearing, positions, self.segment_count(link_num))
+
+    # Evaluates the full chain for all chain states in one batch. Until
+    # the parameters change, fk returns the stored poses for these states
+    @timed('dh_chain.prefetch')
+    def prefetch(self, chain_states):
+        if len(chain_states) == 0:
+            return
+        T = self.fk_batch([s.actual.positions for s in chain_states])
+        self._prefetched = (self._version, dict((id(s), (s, t)) for s, t in zip(chain_states, T)))
+
+    # Returns the prefetched pose of the full chain for chain_state,
+    # or None if it is not available for the current parameters
+    def prefetched_fk(self, chain_state):
+        version, poses = self._prefetched
+        if version != self._version:
+            return None
+        entry = poses.get(id(chain_state))
+        if entry is None or entry[0] is not chain_state:
+            return None
+        return entry[1]
+
+    # Returns Nx4x4 array with the poses of the tip of the specified
+    # link num (see fk) for every chain state in joint_states_list
+    def fk_many(self, joint_states_list, link_num=-2):
+        if len(joint_states_list) == 0:
+            return numpy.zeros((0, 4, 4))
+        return self.fk_batch([s.actual.positions for s in joint_states_list], link_num)
+
+    # Returns the pose of the tip of the specified link num (see fk)
+    # together with its derivatives:
+    #  - T: 4x4 array
+    #  - dT_params: (7M)x4x4 array with the derivatives w.r.t. the
+    #               parameters, in the same order as deflate
+    #  - dT_joints: Jx4x4 array with the derivatives w.r.t. the measured
+    #               joint positions in chain_state.actual.positions
+    @timed('dh_chain.fk_jacobian')
+    def fk_jacobian(self, chain_state, link_num=-2):
+        link_num = self.segment_count(link_num)
+
+        positions = chain_state.actual.positions
+        dT_params = numpy.zeros((self._M * 7, 4, 4))
+        dT_joints = numpy.zeros((len(positions), 4, 4))
+
+        # Build every segment transform [xyz, rpy] * joint(gearing * q)
+        # as well as the derivatives of its factors
+        segments = []
+        j = 0
+        for e in self._config[:link_num]:
+            F = numpy.eye(4)
+            F[0:3,0:3] = rpy_matrix(*e["xyzrpy"][3:6])
+            F[0:3,3] = e["xyzrpy"][0:3]
+            if e["type"] in joint_axes:
+                axis, revolute = joint_axes[e["type"]]
+                gearing = self._gearing[j]
+                q = positions[j]
+                J = axis_transform(axis, revolute, gearing * q)
+                dJ = axis_transform_derivative(axis, revolute, gearing * q)
+                segments.append((F, J, dJ, j, gearing, q))
+                j += 1
+            else:
+                segments.append((F, numpy.eye(4), None, None, 0, 0))
+
+        # prefix[k] = S_0 * ... * S_(k-1), suffix[k] = S_(k+1) * ... * S_(n-1)
+        n = len(segments)
+        prefix = [numpy.eye(4)]
+        for F, J, dJ, j, gearing, q in segments:
+            prefix.append(numpy.dot(prefix[-1], numpy.dot(F, J)))
+        suffix = [numpy.eye(4)] * n
+        for k in range(n - 2, -1, -1):
+            F, J = segments[k + 1][0:2]
+            suffix[k] = numpy.dot(numpy.dot(F, J), suffix[k + 1])
+
+        for k, (F, J, dJ, j, gearing, q) in enumerate(segments):
+            # Derivatives w.r.t. the translation
+            for i in range(3):
+                dF = numpy.zeros((4,4))
+                dF[i,3] = 1.0
+                dT_params[k*6 + i] = chain_dot(prefix[k], dF, J, suffix[k])
+            # Derivatives w.r.t. roll, pitch and yaw
+            dR = rpy_jacobian(*self._config[k]["xyzrpy"][3:6])
+            for i in range(3):
+                dF = numpy.zeros((4,4))
+                dF[0:3,0:3] = dR[i]
+                dT_params[k*6 + 3 + i] = chain_dot(prefix[k], dF, J, suffix[k])
+            # Derivatives w.r.t. the gearing and the joint position
+            if dJ is not None:
+                dS = chain_dot(prefix[k], F, dJ, suffix[k])
+                dT_params[self._M*6 + j] = dS * q
+                dT_joints[j] = dS * gearing
+
+        return prefix[-1], dT_params, dT_joints
+
+    # Same as fk_jacobian, but only returns the pose and the derivatives
+    # w.r.t. the measured joint positions (T, dT_joints)
+    @timed('dh_chain.fk_joint_jacobian')
+    def fk_joint_jacobian(self, chain_state, link_num=-2):
+        T, dT_joints = batch_fk_joint_jacobian(self._config, self._gearing, [chain_state.actual.positions],
+                                               self.segment_count(link_num))
+        return T[0], dT_joints[0]
+
+
+# Joint axis and joint kind (True: revolute, False: prismatic) of the joint types
+# that can be used in the dh config
+joint_axes = { "rotx":   ([1.0, 0.0, 0.0], True),
+               "roty":   ([0.0, 1.0, 0.0], True),
+               "rotz":   ([0.0, 0.0, 1.0], True),
+               "transx": ([1.0, 0.0, 0.0], False),
+               "transy": ([0.0, 1.0, 0.0], False),
+               "transz": ([0.0, 0.0, 1.0], False) }
+
+# Multiplies all the 4x4 arrays passed in
+def chain_dot(*mats):
+    return reduce(numpy.dot, mats)
+
+# Elementary rotations about x, y and z, as well as their derivatives
+def _rot(axis, angle):
+    c = cos(angle)
+    s = sin(angle)
+    i, j = [(1, 2), (2, 0), (0, 1)][axis]
+    R = numpy.eye(3)
+    R[i,i] = c
+    R[i,j] = -s
+    R[j,i] = s
+    R[j,j] = c
+    return R
+
+def _drot(axis, angle):
+    c = cos(angle)
+    s = sin(angle)
+    i, j = [(1, 2), (2, 0), (0, 1)][axis]
+    dR = numpy.zeros((3,3))
+    dR[i,i] = -s
+    dR[i,j] = -c
+    dR[j,i] = c
+    dR[j,j] = -s
+    return dR
+
+# Rotation matrix of the rpy angles, identical to KDL's Rotation.RPY: Rz(y) * Ry(p) * Rx(r)
+def rpy_matrix(roll, pitch, yaw):
+    return chain_dot(_rot(2, yaw), _rot(1, pitch), _rot(0, roll))
+
+# Returns 3x3x3 array with the derivatives of rpy_matrix w.r.t. roll, pitch and yaw
+def rpy_jacobian(roll, pitch, yaw):
+    Rx, Ry, Rz = _rot(0, roll), _rot(1, pitch), _rot(2, yaw)
+    return numpy.array([ chain_dot(Rz, Ry, _drot(0, roll)),
+                         chain_dot(Rz, _drot(1, pitch), Rx),
+                         chain_dot(_drot(2, yaw), Ry, Rx) ])
+
+# 4x4 transform of a joint moving by q along (prismatic) or about (revolute) the given unit axis
+def axis_transform(axis, revolute, q):
+    T = numpy.eye(4)
+    if revolute:
+        T[0:3,0:3] = _rot(axis.index(1.0), q)
+    else:
+        T[0:3,3] = numpy.array(axis) * q
+    return T
+
+# Derivative of axis_transform w.r.t. q
+def axis_transform_derivative(axis, revolute, q):
+    dT = numpy.zeros((4,4))
+    if revolute:
+        dT[0:3,0:3] = _drot(axis.index(1.0), q)
+    else:
+        dT[0:3,3] = axis
+    return dT
+
+# Batched version of axis_transform for an array of N joint values. Returns Nx4x4 array
+def batch_axis_transform(axis, revolute, q):
+    T = numpy.tile(numpy.eye(4), (len(q), 1, 1))
+    if revolute:
+        i, j = [(1, 2), (2, 0), (0, 1)][axis.index(1.0)]
+        c = numpy.cos(q)
+        s = numpy.sin(q)
+        T[:,i,i] = c
+        T[:,i,j] = -s
+        T[:,j,i] = s
+        T[:,j,j] = c
+    else:
+        T[:,0:3,3] = numpy.outer(q, axis)
+    return T
+
+# Computes the pose of the tip of the first 'segments' segments of a
+# dh config (see DhChain) for N sets of joint positions at once
+# positions: NxJ array with the joint positions of every sample
+# returns: Nx4x4 array
+def batch_fk(dh_config, gearing, positions, segments):
+    positions = numpy.array(positions, float).reshape(len(positions), -1)
+    T = numpy.tile(numpy.eye(4), (positions.shape[0], 1, 1))
+    j = 0
+    for e in dh_config[:segments]:
+        F = numpy.eye(4)
+        F[0:3,0:3] = rpy_matrix(*e["xyzrpy"][3:6])
+        F[0:3,3] = e["xyzrpy"][0:3]
+        T = numpy.dot(T, F)
+        if e["type"] in joint_axes:
+            axis, revolute = joint_axes[e["type"]]
+            J = batch_axis_transform(axis, revolute, gearing[j] * positions[:,j])
+            T = numpy.einsum('nij,njk->nik', T, J)
+            j += 1
+    return T
+
+# Batched version of axis_transform_derivative. Returns Nx4x4 array
+def batch_axis_transform_derivative(axis, revolute, q):
+    dT = numpy.zeros((len(q), 4, 4))
+    if revolute:
+        i, j = [(1, 2), (2, 0), (0, 1)][axis.index(1.0)]
+        c = numpy.cos(q)
+        s = numpy.sin(q)
+        dT[:,i,i] = -s
+        dT[:,i,j] = -c
+        dT[:,j,i] = c
+        dT[:,j,j] = -s
+    else:
+        dT[:,0:3,3] = axis
+    return dT
+
+# Same as batch_fk, but also computes the derivatives of the poses
+# w.r.t. the joint positions
+# returns: (T, dT), Nx4x4 and NxJx4x4 arrays
+def batch_fk_joint_jacobian(dh_config, gearing, positions, segments):
+    positions = numpy.array(positions, float).reshape(len(positions), -1)
+    N = positions.shape[0]
+
+    # Every segment is F * J(q), with the derivative dJ/dq for joints
+    factors = []
+    j = 0
+    for e in dh_config[:segments]:
+        F = numpy.eye(4)
+        F[0:3,0:3] = rpy_matrix(*e["xyzrpy"][3:6])
+        F[0:3,3] = e["xyzrpy"][0:3]
+        if e["type"] in joint_axes:
+            axis, revolute = joint_axes[e["type"]]
+            q = gearing[j] * positions[:,j]
+            J = numpy.einsum('ij,njk->nik', F, batch_axis_transform(axis, revolute, q))
+            dJ = numpy.einsum('ij,njk->nik', F, batch_axis_transform_derivative(axis, revolute, q)) * gearing[j]
+            factors.append((J, dJ, j))
+            j += 1
+        else:
+            factors.append((numpy.tile(F, (N, 1, 1)), None, None))
+
+    # prefix[k] = S_0 * ... * S_(k-1), suffix[k] = S_(k+1) * ... * S_(n-1)
+    n = len(factors)
+    prefix = [numpy.tile(numpy.eye(4), (N, 1, 1))]
+    for S, dS, j in factors:
+        prefix.append(numpy.einsum('nij,njk->nik', prefix[-1], S))
+    suffix = [numpy.tile(numpy.eye(4), (N, 1, 1))] * n
+    for k in range(n - 2, -1, -1):
+        suffix[k] = numpy.einsum('nij,njk->nik', factors[k + 1][0], suffix[k + 1])
+
+    dT = numpy.zeros((N, positions.shape[1], 4, 4))
+    for k, (S, dS, j) in enumerate(factors):
+        if dS is not None:
+            dT[:,j] = numpy.einsum('nij,njk,nkl->nil', prefix[k], dS, suffix[k])
+    return prefix[-1], dT
 
 # Computes the transform for a chain
 # dh_params: Mx4 matrix, where M is the # of links in the model
@@ -44,7 +44,7 @@
 #from sensor_msgs.msg import JointState
 from numpy import matrix
 import numpy
-import tf.transformations
+from cob_robot_calibration_est.profiling import timed
 
 
 class FullChainRobotParams:
@@ -122,6 +122,34 @@ class SingleChainCalc:
 
         return pose
 
+    def fk_jacobian(self, joint_states):
+        """
+        Same as fk, but also returns how the pose changes with the system parameters
+        Returns (T, idx, dT):
+        - T: 4x4 array of the pose
+        - idx: Index of every derivative in the full system parameter vector
+        - dT: Kx4x4 array, where dT[k] is the derivative of T w.r.t. parameter idx[k]
+        """
+        T_chain, dT_chain, dT_joints = self._chain.fk_jacobian(joint_states)
+        factors = [transform_factor(t) for t in self._before_chain_Ts] + \
+                  [(T_chain, primitive_index(self._chain), dT_chain)] + \
+                  [transform_factor(t) for t in self._after_chain_Ts]
+        return chain_product(factors)
+
+    def fk_joint_jacobian(self, joint_state):
+        """
+        Same as fk, but also returns how the pose changes with the measured joint positions
+        Returns (T, dT):
+        - T: 4x4 array of the pose
+        - dT: Jx4x4 array, where dT[j] is the derivative of T w.r.t. joint_state.actual.positions[j]
+        """
+        T_chain, dT_joints = self._chain.fk_joint_jacobian(joint_state)
+        factors = [fixed_factor(t) for t in self._before_chain_Ts] + \
+                  [(T_chain, numpy.arange(dT_joints.shape[0]), dT_joints)] + \
+                  [fixed_factor(t) for t in self._after_chain_Ts]
+        T, idx, dT = chain_product(factors)
+        return T, dT
+
     def __getitem__(self, key):
         return self._config_dict[key]
 
@@ -137,6 +165,7 @@ class FullChainCalcBlock:
         #print "chains: ", self._chain_ids
         #print "after: ", self._after_chain_Ts
 
+    @timed('full_chain.fk')
     def fk(self, m_chain):
         pose = matrix(numpy.eye(4))
 
@@ -154,3 +183,85 @@ class FullChainCalcBlock:
             pose = pose * after_chain_T.transform
 
         return pose
+
+    @timed('full_chain.fk_jacobian')
+    def fk_jacobian(self, m_chain):
+        """
+        Same as fk, but also returns how the pose changes with the system parameters.
+        See SingleChainCalc.fk_jacobian for the returned values.
+        """
+        factors = [transform_factor(t) for t in self._before_chain_Ts]
+        for chain in self._chains:
+            for joint_state in m_chain:
+                if joint_state.header.frame_id == chain._config_dict["chain_id"]:
+                    factors.append(chain.fk_jacobian(joint_state))
+        factors += [transform_factor(t) for t in self._after_chain_Ts]
+        return chain_product(factors)
+
+    @timed('full_chain.fk_joint_jacobian')
+    def fk_joint_jacobian(self, m_chain):
+        """
+        Same as fk, but also returns how the pose changes with the measured joint positions
+        Returns (T, dT):
+        - T: 4x4 array of the pose
+        - dT: Kx4x4 array with the derivatives w.r.t. all joint positions of the chains, in the
+              order of the chains (the same order as the joint covariances of the chains)
+        """
+        factors = [fixed_factor(t) for t in self._before_chain_Ts]
+        offset = 0
+        for chain in self._chains:
+            for joint_state in m_chain:
+                if joint_state.header.frame_id == chain._config_dict["chain_id"]:
+                    T_i, dT_i = chain.fk_joint_jacobian(joint_state)
+                    factors.append((T_i, offset + numpy.arange(dT_i.shape[0]), dT_i))
+                    offset += dT_i.shape[0]
+        factors += [fixed_factor(t) for t in self._after_chain_Ts]
+        T, idx, dT = chain_product(factors)
+        return T, dT
+
+
+def primitive_index(primitive):
+    """
+    Indices of the parameters of a primitive in the full system parameter vector
+    """
+    return numpy.arange(primitive.start, primitive.end)
+
+
+def transform_factor(single_transform):
+    """
+    Factor for chain_product built from a SingleTransform
+    """
+    return (numpy.array(single_transform.transform), primitive_index(single_transform), single_transform.jacobian())
+
+
+def fixed_factor(single_transform):
+    """
+    Factor for chain_product built from a SingleTransform, without any derivatives
+    """
+    return (numpy.array(single_transform.transform), numpy.zeros(0, int), numpy.zeros((0, 4, 4)))
+
+
+def chain_product(factors):
+    """
+    Multiplies a list of transforms and propagates their derivatives through the product
+    Input:
+    - factors: List of (T_i, idx_i, dT_i) tuples, where T_i is a 4x4 transform and dT_i holds its
+               derivatives w.r.t. the parameters with indices idx_i
+    Returns (T, idx, dT), where T = T_0 * T_1 * ... * T_n and dT[k] is the derivative of T
+    w.r.t. parameter idx[k]. Parameters that appear in several factors show up several times.
+    """
+    T_list = [f[0] for f in factors]
+    # prefix[i] = T_0 * ... * T_(i-1), suffix[i] = T_(i+1) * ... * T_n
+    prefix = [numpy.eye(4)]
+    for T_i in T_list:
+        prefix.append(numpy.dot(prefix[-1], T_i))
+    suffix = [numpy.eye(4)] * len(T_list)
+    for i in range(len(T_list) - 2, -1, -1):
+        suffix[i] = numpy.dot(T_list[i + 1], suffix[i + 1])
+
+    idx_list = [numpy.zeros(0, int)]
+    dT_list = [numpy.zeros((0, 4, 4))]
+    for i, (T_i, idx_i, dT_i) in enumerate(factors):
+        idx_list.append(idx_i)
+        dT_list.append(numpy.einsum('ij,kjl,lm->kim', prefix[i], dT_i, suffix[i]))
+    return prefix[-1], numpy.concatenate(idx_list), numpy.concatenate(dT_list)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+# Process wide registry of the camera intrinsics (camera matrix and distortion coefficients).
+# Every camera's intrinsic yaml file is read once, the first time a sensor of that camera is
+# built, and the resulting read-only arrays are shared by all sensors. For offline runs without
+# a parameter server, the registry can be seeded with set_intrinsics beforehand.
+
+import yaml
+import numpy
+from numpy import array, float64
+
+from cob_robot_calibration_est.ros_support import get_param
+
+_intrinsics = {}
+
+
+def read_intrinsics(filename):
+    """
+    Reads a camera calibration yaml file (as written by camera_calibration)
+    Returns: (camera_matrix, distortion), a read-only 3x3 array and a read-only array of coefficients
+    """
+    with open(filename) as f:
+        config = yaml.load(f)
+    return make_intrinsics(config['camera_matrix']['data'], config['distortion_coefficients']['data'])
+
+
+def make_intrinsics(camera_matrix, distortion):
+    """
+    Builds the read-only arrays that are stored in the registry
+    """
+    camera_matrix = array(camera_matrix, float64).reshape(3, 3)
+    distortion = array(distortion, float64).reshape(-1)
+    camera_matrix.flags.writeable = False
+    distortion.flags.writeable = False
+    return camera_matrix, distortion
+
+
+def set_intrinsics(camera_id, camera_matrix, distortion):
+    """
+    Stores the intrinsics of a camera, replacing any previously loaded ones
+    """
+    _intrinsics[camera_id] = make_intrinsics(camera_matrix, distortion)
+
+
+def get_intrinsics(camera_id):
+    """
+    Returns the (camera_matrix, distortion) of a camera. If the camera isn't in the registry yet,
+    its intrinsics are read from <~camera_parameter>/<camera_id>.yaml, where the directory is given
+    by the /calibration_config/camera_parameter parameter.
+    """
+    if camera_id not in _intrinsics:
+        path = get_param('/calibration_config/camera_parameter') + camera_id + '.yaml'
+        _intrinsics[camera_id] = read_intrinsics(path)
+    return _intrinsics[camera_id]
+
+
+def clear_intrinsics():
+    """
+    Removes all cameras from the registry, so that the intrinsics are read again on the next access
+    """
+    _intrinsics.clear()
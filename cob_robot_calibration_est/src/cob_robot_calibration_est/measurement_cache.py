@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+# Converts the /robot_measurement messages of a calibration bag once into a
+# columnar cache on disk, so that the estimator does not need to read the bag
+# again for every calibration step and every rerun.
+#
+# Every cache lives in its own directory named after the hash of the bag:
+#   image_points.npy:    Px2 float64, the image points of all camera measurements
+#   cameras.npy:         Cx4 int64, [sample, camera_id, first_point, last_point] per camera measurement
+#   joint_positions.npy: Q float64, the joint positions of all chain measurements
+#   chains.npy:          Kx4 int64, [sample, frame_id, first_position, last_position] per chain measurement
+#   meta.yaml:           sample/target/chain ids per sample and the camera_id and frame_id tables
+# Only the fields the estimator uses are cached.
+
+import hashlib
+import os
+import shutil
+import yaml
+import numpy
+
+from cob_robot_calibration_est.measurement_store import MeasurementStore, measurement_columns
+
+CACHE_VERSION = 1
+MEASUREMENT_TOPICS = ['/robot_measurement', 'robot_measurement']
+COLUMN_ARRAYS = ['image_points', 'cameras', 'joint_positions', 'chains']
+
+
+def bag_hash(bag_filename, chunk_size=1 << 20):
+    """
+    Key of the cache of a bag: SHA1 over the file size and over the first and last chunk_size bytes
+    of the file. The end of a bag holds its index, so this identifies a bag without reading all of it.
+    """
+    size = os.path.getsize(bag_filename)
+    h = hashlib.sha1()
+    h.update("%u:%u" % (CACHE_VERSION, size))
+    with open(bag_filename, 'rb') as f:
+        h.update(f.read(chunk_size))
+        if size > chunk_size:
+            f.seek(max(size - chunk_size, chunk_size))
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def read_bag_measurements(bag_filename):
+    """
+    Reads all robot measurements from a bag
+    """
+    import rosbag
+    bag = rosbag.Bag(bag_filename)
+    msgs = [msg for topic, msg, t in bag.read_messages(topics=MEASUREMENT_TOPICS)]
+    bag.close()
+    return msgs
+
+
+def write_cache(cache_path, msgs):
+    """
+    Stores the robot measurements msgs as columnar cache in the directory cache_path
+    """
+    columns = measurement_columns(msgs)
+
+    # Write into a temporary directory first, so that an interrupted run never leaves a partial cache behind
+    tmp_path = "%s.tmp%u" % (cache_path, os.getpid())
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name in COLUMN_ARRAYS:
+        numpy.save(os.path.join(tmp_path, name + '.npy'), columns[name])
+    with open(os.path.join(tmp_path, 'meta.yaml'), 'w') as f:
+        yaml.dump({'version': CACHE_VERSION, 'samples': columns['samples'],
+                   'camera_ids': columns['camera_ids'], 'frame_ids': columns['frame_ids']}, f)
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        # Another run created the same cache in the meantime
+        shutil.rmtree(tmp_path)
+        if not os.path.isdir(cache_path):
+            raise
+
+
+def read_columns(cache_path):
+    """
+    Loads the columns (see measurement_store.measurement_columns) from the cache in the directory
+    cache_path. The arrays are memory mapped.
+    """
+    with open(os.path.join(cache_path, 'meta.yaml')) as f:
+        meta = yaml.load(f)
+    if meta['version'] != CACHE_VERSION:
+        raise Exception("Measurement cache [%s] has version %s, expected %u" % (cache_path, meta['version'], CACHE_VERSION))
+    columns = dict((name, numpy.load(os.path.join(cache_path, name + '.npy'), mmap_mode='r')) for name in COLUMN_ARRAYS)
+    columns.update((key, meta[key]) for key in ['samples', 'camera_ids', 'frame_ids'])
+    return columns
+
+
+def read_cache(cache_path):
+    """
+    Loads the robot measurements from the cache in the directory cache_path.
+    Returns: List of RobotMeasurement messages
+    """
+    from cob_calibration_msgs.msg import RobotMeasurement, CameraMeasurement, ImagePoint
+    from control_msgs.msg import JointTrajectoryControllerState
+
+    columns = read_columns(cache_path)
+    image_points = columns['image_points']
+    joint_positions = columns['joint_positions']
+
+    msgs = [RobotMeasurement(sample_id=s['sample_id'], target_id=s['target_id'], chain_id=s['chain_id'], M_cam=[], M_chain=[])
+            for s in columns['samples']]
+    for k, camera, first, last in columns['cameras'].tolist():
+        M_cam = CameraMeasurement()
+        M_cam.camera_id = columns['camera_ids'][camera]
+        M_cam.image_points = [ImagePoint(x, y) for x, y in image_points[first:last].tolist()]
+        msgs[k].M_cam.append(M_cam)
+    for k, frame, first, last in columns['chains'].tolist():
+        M_chain = JointTrajectoryControllerState()
+        M_chain.header.frame_id = columns['frame_ids'][frame]
+        M_chain.actual.positions = joint_positions[first:last].tolist()
+        msgs[k].M_chain.append(M_chain)
+    return msgs
+
+
+def update_cache(bag_filename, cache_dir):
+    """
+    Builds the cache of a bag in cache_dir, unless it exists already
+    Returns: Directory of the cache
+    """
+    cache_path = os.path.join(cache_dir, bag_hash(bag_filename))
+    if not os.path.isdir(cache_path):
+        print "Building measurement cache [%s]" % cache_path
+        write_cache(cache_path, read_bag_measurements(bag_filename))
+    else:
+        print "Using measurement cache [%s]" % cache_path
+    return cache_path
+
+
+def load_measurements(bag_filename, cache_dir):
+    """
+    Returns the robot measurements of a bag. The bag is only read if there is no cache for it in cache_dir yet.
+    """
+    return read_cache(update_cache(bag_filename, cache_dir))
+
+
+def load_measurement_store(bag_filename, cache_dir):
+    """
+    Same as load_measurements, but returns the measurements as MeasurementStore, which
+    is built directly from the memory mapped cache without creating any messages.
+    """
+    return MeasurementStore(read_columns(update_cache(bag_filename, cache_dir)))
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+# Compact in-memory representation of the robot measurements of a calibration run.
+# The image points and joint positions of all samples are kept in two flat arrays
+# (the same columns as the measurement cache, see measurement_cache.py). Every sample
+# is a small object that mimics the parts of a RobotMeasurement the sensors use, but
+# whose image points and joint positions are read-only views into these arrays. Frame
+# headers and the FullChainRobotParams of every sensor configuration are shared, so
+# the memory per sample does not grow with the size of the original messages (e.g.
+# the raw images embedded by collect_data.py). Samples that are appended later with
+# MeasurementStore.extend get arrays of their own.
+
+import numpy
+from numpy import array, float64
+
+from cob_robot_calibration_est.full_chain import FullChainRobotParams
+
+
+class StoredHeader(object):
+    __slots__ = ['frame_id']
+
+    def __init__(self, frame_id):
+        self.frame_id = frame_id
+
+
+class StoredJointState(object):
+    __slots__ = ['positions']
+
+    def __init__(self, positions):
+        self.positions = positions
+
+
+class StoredChainState(object):
+    """
+    Stands in for a JointTrajectoryControllerState: header.frame_id and actual.positions
+    """
+    __slots__ = ['header', 'actual']
+
+    def __init__(self, header, positions):
+        self.header = header
+        self.actual = StoredJointState(positions)
+
+
+class StoredCameraMeasurement(object):
+    """
+    Stands in for a CameraMeasurement: camera_id and the image_points as Nx2 array
+    """
+    __slots__ = ['camera_id', 'image_points']
+
+    def __init__(self, camera_id, image_points):
+        self.camera_id = camera_id
+        self.image_points = image_points
+
+
+class StoredRobotMeasurement(object):
+    """
+    Stands in for a RobotMeasurement
+    """
+    __slots__ = ['sample_id', 'target_id', 'chain_id', 'M_cam', 'M_chain']
+
+    def __init__(self, sample_id, target_id, chain_id):
+        self.sample_id = sample_id
+        self.target_id = target_id
+        self.chain_id = chain_id
+        self.M_cam = []
+        self.M_chain = []
+
+
+def measurement_columns(msgs):
+    """
+    Converts a list of RobotMeasurement messages (or StoredRobotMeasurements) into flat columns
+    Returns: Dictionary with the entries
+    - samples: List of dictionaries with the sample_id, target_id and chain_id of every sample
+    - camera_ids, frame_ids: Lists of all camera ids and chain frame ids
+    - image_points: Px2 array of the image points of all camera measurements
+    - cameras: Cx4 array, [sample, camera_id, first_point, last_point] per camera measurement
+    - joint_positions: Q array of the joint positions of all chain measurements
+    - chains: Kx4 array, [sample, frame_id, first_position, last_position] per chain measurement
+    """
+    camera_ids = []
+    frame_ids = []
+    samples = []
+    cameras = []
+    chains = []
+    image_points = []
+    joint_positions = []
+    num_points = 0
+    num_positions = 0
+    for k, msg in enumerate(msgs):
+        samples.append({'sample_id': msg.sample_id, 'target_id': msg.target_id, 'chain_id': msg.chain_id})
+        for M_cam in msg.M_cam:
+            if M_cam.camera_id not in camera_ids:
+                camera_ids.append(M_cam.camera_id)
+            image_points.extend(image_point_array(M_cam.image_points).tolist())
+            cameras.append([k, camera_ids.index(M_cam.camera_id), num_points, num_points + len(M_cam.image_points)])
+            num_points += len(M_cam.image_points)
+        for M_chain in msg.M_chain:
+            if M_chain.header.frame_id not in frame_ids:
+                frame_ids.append(M_chain.header.frame_id)
+            joint_positions.extend(M_chain.actual.positions)
+            chains.append([k, frame_ids.index(M_chain.header.frame_id), num_positions, num_positions + len(M_chain.actual.positions)])
+            num_positions += len(M_chain.actual.positions)
+    return {'samples': samples, 'camera_ids': camera_ids, 'frame_ids': frame_ids,
+            'image_points': array(image_points, float64).reshape(-1, 2),
+            'cameras': array(cameras, numpy.int64).reshape(-1, 4),
+            'joint_positions': array(joint_positions, float64),
+            'chains': array(chains, numpy.int64).reshape(-1, 4)}
+
+
+def image_point_array(image_points):
+    """
+    Returns the image points of a camera measurement as Nx2 array. Accepts both the
+    array of a StoredCameraMeasurement and the ImagePoint list of a CameraMeasurement.
+    """
+    if isinstance(image_points, numpy.ndarray):
+        return image_points
+    return array([[pt.x, pt.y] for pt in image_points], float64).reshape(-1, 2)
+
+
+class MeasurementStore:
+    """
+    Sequence of StoredRobotMeasurements, backed by the flat columns of measurement_columns
+    (or of a measurement cache). Can be used wherever a list of RobotMeasurements is expected.
+    """
+    def __init__(self, columns=None):
+        self._samples = []
+        self._full_chains = {}
+        if columns is not None:
+            self.extend(columns)
+
+    def extend(self, columns):
+        """
+        Appends the samples of the columns, e.g. of measurements that arrive one by one. Their image points
+        and joint positions are kept in arrays of their own, so the views of the earlier samples stay valid.
+        """
+        image_points = numpy.asarray(columns['image_points'], float64).reshape(-1, 2)
+        joint_positions = numpy.asarray(columns['joint_positions'], float64)
+        image_points.flags.writeable = False
+        joint_positions.flags.writeable = False
+
+        offset = len(self._samples)
+        headers = [StoredHeader(frame_id) for frame_id in columns['frame_ids']]
+        self._samples.extend([StoredRobotMeasurement(s['sample_id'], s['target_id'], s['chain_id'])
+                              for s in columns['samples']])
+        for k, camera, first, last in numpy.asarray(columns['cameras']).tolist():
+            self._samples[offset + k].M_cam.append(StoredCameraMeasurement(columns['camera_ids'][camera],
+                                                                           image_points[first:last]))
+        for k, frame, first, last in numpy.asarray(columns['chains']).tolist():
+            self._samples[offset + k].M_chain.append(StoredChainState(headers[frame], joint_positions[first:last]))
+
+    def __len__(self):
+        return len(self._samples)
+
+    def __getitem__(self, k):
+        return self._samples[k]
+
+    def __iter__(self):
+        return iter(self._samples)
+
+    def full_chain(self, config_dict, configuration):
+        """
+        Returns the FullChainRobotParams of a sensor configuration. It only depends on the
+        configuration, so all sensors built from this store with the same config share it.
+        """
+        key = (id(config_dict), id(configuration))
+        if key not in self._full_chains:
+            # Keep the configs alive, so that their ids can't be reused
+            self._full_chains[key] = (config_dict, configuration, FullChainRobotParams(config_dict, configuration))
+        return self._full_chains[key][2]
+
+
+def store_measurements(msgs):
+    """
+    Builds a MeasurementStore from a list of RobotMeasurement messages
+    """
+    return MeasurementStore(measurement_columns(msgs))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+
+# Online estimate of the free system parameters of a calibration step, updated with every robot measurement
+# as it arrives (e.g. on /robot_measurement while collect_data.py is running), so that the data collection
+# can be stopped as soon as the uncertainty of the parameters has converged.
+#
+# The estimator optimizes the free system parameters together with the checkerboard poses of the last
+# window samples. Older samples are marginalized into a prior on the system parameters in square root
+# information form, r_prior = R * (p - p_lin) + d, linearized at the estimate at the time they left the
+# window. Every new sample runs a few iterations of the Schur complement solver over the window and the
+# prior. The marginalized samples are not relinearized, so the estimate should be polished with a batch
+# optimization over all samples at the end (see OnlineEstimator.polish).
+
+import copy
+import numpy
+import scipy.linalg
+from numpy import array, zeros, ones, concatenate, vstack, dot
+
+from cob_robot_calibration_est.robot_params import RobotParams
+from cob_robot_calibration_est.measurement_store import MeasurementStore, measurement_columns
+from cob_robot_calibration_est.sensors.multi_sensor import MultiSensor
+from cob_robot_calibration_est.opt_runner import ErrorCalc, solve_schur, opt_runner, fk_pose_guess
+from cob_robot_calibration_est.covariance import eliminate_pose
+
+
+def compress_rows(A, e):
+    """
+    Replaces the rows of the cost |A * x + e|^2 by at most A.shape[1] equivalent rows. The part of the
+    cost that doesn't depend on x is dropped.
+    Returns: (R, d), with R upper triangular
+    """
+    F = A.shape[1]
+    R = numpy.linalg.qr(numpy.hstack([A, e.reshape(-1, 1)]), mode='r')
+    return R[:F, :F], R[:F, F]
+
+
+def parameter_std(R):
+    """
+    Standard deviations of the parameters for the square root information R, i.e. the covariance (R'R)^-1.
+    They are infinite as long as R is singular, i.e. some parameters are not constrained yet.
+    """
+    F = R.shape[1]
+    scale = numpy.sqrt((R ** 2).sum(0))
+    if R.shape[0] < F or numpy.any(scale == 0):
+        return numpy.inf * ones(F)
+    if F == 0:
+        return zeros(0)
+    # The parameters have different units, so the rank is decided on the normalized columns
+    R_s = numpy.linalg.qr(R / scale, mode='r')
+    diag = numpy.abs(numpy.diag(R_s))
+    if diag.min() <= 1e-10 * diag.max():
+        return numpy.inf * ones(F)
+    R_inv = scipy.linalg.solve_triangular(R_s, numpy.eye(F))
+    return numpy.sqrt((R_inv ** 2).sum(1)) / scale
+
+
+class PriorErrorCalc:
+    """
+    Adds the rows of a prior r_prior = R * (p - p_lin) + d on the free system parameters p to the residual
+    and the jacobian blocks of an ErrorCalc. The prior rows are appended to the block of the last
+    multisensor, with zero pose columns, so that schur_step eliminates the poses without touching them.
+    """
+    def __init__(self, error_calc, R, d, p_lin):
+        self._error_calc = error_calc
+        self._R = R
+        self._d = d
+        self._p_lin = p_lin
+
+    def prior_residual(self, opt_all_vec):
+        return dot(self._R, opt_all_vec[0:len(self._p_lin)] - self._p_lin) + self._d
+
+    def calculate_error(self, opt_all_vec):
+        return concatenate([self._error_calc.calculate_residual(opt_all_vec), self.prior_residual(opt_all_vec)])
+
+    def calculate_jacobian_blocks(self, opt_all_vec):
+        J_params, J_poses = self._error_calc.calculate_jacobian_blocks(opt_all_vec)
+        J_poses = J_poses[:-1] + [vstack([J_poses[-1], zeros([len(self._R), 6])])]
+        return vstack([J_params, self._R]), J_poses
+
+
+class OnlineEstimator:
+    """
+    Sliding window estimate of the free system parameters of a calibration step (see above)
+    - system: The initial system, in the format of the estimator's initial_system
+    - free_dict: The free parameters of the step
+    - sensor_configs: The sensors of the step (see multi_step_cov_estimator.load_requested_sensors)
+    - use_cov: Scale the residuals by the measurement covariances, as in the batch step. Only then are
+               the standard deviations of the parameters meaningful
+    - window: Number of samples whose poses are optimized together with the system parameters
+    - iterations: Maximum number of solver iterations per sample
+    - prior_std: Optional standard deviation of the free parameters of the initial system, a scalar or
+                 one per free parameter. It keeps the parameters in place that the first samples don't
+                 constrain yet
+    """
+    def __init__(self, system, free_dict, sensor_configs, use_cov=True, window=10, iterations=5, prior_std=None):
+        self._robot_params = RobotParams()
+        self._robot_params.configure(copy.deepcopy(system))
+        self._free_dict = free_dict
+        self._sensor_configs = sensor_configs
+        self._use_cov = use_cov
+        self._window_size = window
+        self._iterations = iterations
+
+        free_list = self._robot_params.calc_free(copy.deepcopy(free_dict))
+        self._free_idx = numpy.where(free_list)[0]
+        self._full_params = self._robot_params.deflate()
+        self.param_names = [name for name, free in zip(self._robot_params.get_param_names(), free_list) if free]
+        self.params = array(self._full_params[self._free_idx]).ravel()
+
+        # Samples, their multisensors and the current estimate of their checkerboard poses
+        self.store = MeasurementStore()
+        self.multisensors = []
+        self.poses = zeros([0, 6])
+        self._window = []
+
+        F = len(self._free_idx)
+        if prior_std is None:
+            self._prior_R = zeros([0, F])
+        else:
+            self._prior_R = numpy.diag(ones(F) / array(prior_std, float))
+        self._prior_d = zeros(len(self._prior_R))
+        self._prior_params = self.params.copy()
+        self.std = parameter_std(self._prior_R)
+        self.std_history = []
+
+    def full_param_vec(self):
+        full_param_vec = self._full_params.copy()
+        full_param_vec[self._free_idx, 0] = self.params
+        return full_param_vec
+
+    def system(self):
+        """
+        Returns: The current estimate of the system, in the format of the estimator's initial_system
+        """
+        return self._robot_params.params_to_config(self.full_param_vec())
+
+    def add_measurement(self, msg):
+        """
+        Adds a robot measurement and updates the estimate
+        Returns: False if none of the sensors of the step are in the measurement. The sample is kept
+                 for the batch optimization, but the estimate doesn't change.
+        """
+        self.store.extend(measurement_columns([msg]))
+        multisensor = MultiSensor(self._sensor_configs, self.store)
+        multisensor.sensors_from_message(self.store[len(self.store) - 1])
+        self.multisensors.append(multisensor)
+        self.poses = vstack([self.poses, self.pose_guess(multisensor)])
+        if len(multisensor.sensors) == 0:
+            return False
+
+        self._window.append(len(self.multisensors) - 1)
+        A_list, e_list = self.update()
+        self.std = parameter_std(vstack([self._prior_R] + A_list))
+        self.std_history.append(self.std)
+
+        # The rows of the oldest sample are merged into the prior as they are linearized now
+        if len(self._window) > self._window_size:
+            self._window.pop(0)
+            prior_r = dot(self._prior_R, self.params - self._prior_params) + self._prior_d
+            self._prior_R, self._prior_d = compress_rows(vstack([self._prior_R, A_list[0]]), concatenate([prior_r, e_list[0]]))
+            self._prior_params = self.params.copy()
+        return True
+
+    def pose_guess(self, multisensor):
+        """
+        Initial guess of the checkerboard pose of a sample: the forward kinematics of its chain sensor with
+        the current estimate (see fk_pose_guess), or the pose of the previous sample if it has none
+        """
+        pose = fk_pose_guess(self._robot_params, multisensor)
+        if pose is not None:
+            return pose
+        if len(self.poses) > 0:
+            return self.poses[-1]
+        return zeros(6)
+
+    def update(self):
+        """
+        Optimizes the free system parameters and the poses of the window samples, subject to the prior
+        Returns: (A_list, e_list), the rows of every window sample at the new estimate (see eliminate_pose)
+        """
+        multisensors = [self.multisensors[k] for k in self._window]
+        error_calc = ErrorCalc(self._robot_params, copy.deepcopy(self._free_dict), multisensors, self._use_cov)
+        x = concatenate([self.params, self.poses[self._window].ravel()])
+        x = solve_schur(PriorErrorCalc(error_calc, self._prior_R, self._prior_d, self._prior_params), x,
+                        max_iterations=self._iterations)
+
+        opt_param_vec, pose_arr = error_calc.split_all(x)
+        self.params = array(opt_param_vec)
+        self.poses[self._window] = pose_arr
+        self._robot_params.inflate(self.full_param_vec())
+
+        r = error_calc.calculate_residual(x)
+        J_params, J_poses = error_calc.calculate_jacobian_blocks(x)
+        A_list = []
+        e_list = []
+        first = 0
+        for J_pose in J_poses:
+            last = first + J_pose.shape[0]
+            A, e = eliminate_pose(J_params[first:last], J_pose, r[first:last])
+            A_list.append(A)
+            e_list.append(e)
+            first = last
+        return A_list, e_list
+
+    def converged(self, tolerance=0.05, samples=3):
+        """
+        True once the standard deviations of all free parameters are finite, and none of them changed by
+        more than tolerance (relative) over the last samples measurements. A single sample can change them
+        by a few percent, depending on the pose of the robot, so this shouldn't be checked per sample.
+        """
+        if len(self.std_history) <= samples:
+            return False
+        std = self.std_history[-1]
+        previous_std = self.std_history[-1 - samples]
+        if not numpy.all(numpy.isfinite(previous_std)):
+            return False
+        return bool(numpy.all(numpy.abs(previous_std - std) <= tolerance * std))
+
+    def std_summary(self):
+        """
+        Returns: Dictionary that maps the name of every free parameter to its current standard deviation
+        """
+        return dict(zip(self.param_names, self.std.tolist()))
+
+    def polish(self, solver='schur', jacobian='analytic', processes=1, checkpoint=None):
+        """
+        Batch optimization over all samples, starting from the online estimate (see opt_runner)
+        Returns: (system, poses, J), as opt_runner
+        """
+        return opt_runner(self.system(), self.poses.copy(), copy.deepcopy(self._free_dict), self.multisensors,
+                          self._use_cov, solver, jacobian, processes, checkpoint)
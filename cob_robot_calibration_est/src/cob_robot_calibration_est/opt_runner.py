@@ -32,27 +32,77 @@
 
 # author: Vijay Pradeep
 
-import roslib
-roslib.load_manifest('cob_robot_calibration_est')
-
 from cob_robot_calibration_est.robot_params import RobotParams
-from cob_robot_calibration_est.single_transform import SingleTransform
+from cob_robot_calibration_est.single_transform import pose_transforms, pose_jacobian, rotation_vectors
+from cob_robot_calibration_est.block_diagonal import scale_blocks
+from cob_robot_calibration_est.sensors.multi_sensor import compute_residuals, compute_gamma_sqrt_list
+from cob_robot_calibration_est.profiling import timed
+from cob_robot_calibration_est import profiling
+from cob_robot_calibration_est.ros_support import logger
 import numpy
-from numpy import array, zeros, cumsum, concatenate, reshape
+from numpy import array, matrix, zeros, cumsum, concatenate, reshape
+import scipy.linalg
 import scipy.optimize
-import sys
+import scipy.sparse
 
 
 class ErrorCalc:
     """
     Helpers for computing errors and jacobians
+
+    The jacobian is either computed from the closed form derivatives of the sensors
+    (jacobian='analytic') or by finite differences (jacobian='numeric'), which is
+    slower but can be used to verify the analytic derivatives.
     """
-    def __init__(self, robot_params, free_dict, multisensors, use_cov):
+    def __init__(self, robot_params, free_dict, multisensors, use_cov, jacobian='analytic'):
+        if jacobian not in ['analytic', 'numeric']:
+            raise Exception("Unknown jacobian type [%s]. Expected 'analytic' or 'numeric'" % jacobian)
         self._robot_params = robot_params
         self._expanded_params = robot_params.deflate()
         self._free_list = robot_params.calc_free(free_dict)
+        self._free_idx = numpy.where(self._free_list)[0]
         self._multisensors = multisensors
         self._use_cov = use_cov
+        self._jacobian = jacobian
+        self._column_groups = None
+        self._inflated_param_vec = None
+        self._last_evaluation = None
+        # Optional callable snapshot(x, r), called by calculate_error with every evaluated vector and its residual
+        self.snapshot = None
+        self.build_param_idx()
+
+    def build_param_idx(self):
+        '''
+        Stores the columns of the free system parameters that each sensor depends on as sensor.param_idx,
+        an immutable integer array. The parameter layout doesn't change during an optimization, so this
+        is only done once. Sensors with the same sparsity share the same array.
+        '''
+        idx_cache = {}
+        for multisensor in self._multisensors:
+            multisensor.update_config(self._robot_params)
+            for sensor in multisensor.sensors:
+                sparsity_dict = sensor.build_sparsity_dict()
+                for cur_key in ['dh_chains', 'tilting_lasers', 'transforms', 'rectified_cams', 'checkerboards']:
+                    if cur_key not in sparsity_dict.keys():
+                        sparsity_dict[cur_key] = {}
+                # Every residual depends on the points of the target that the sensor is viewing
+                sparsity_dict['checkerboards'][multisensor.checkerboard] = {'spacing_x': 1, 'spacing_y': 1}
+
+                key = repr(sorted(sparsity_dict.items()))
+                if key not in idx_cache:
+                    full_sparsity_vec = numpy.array(self._robot_params.calc_free(sparsity_dict), bool)
+                    param_idx = numpy.where(full_sparsity_vec[self._free_idx])[0]
+                    param_idx.setflags(write=False)
+                    idx_cache[key] = param_idx
+                sensor.param_idx = idx_cache[key]
+
+    def param_blocks(self):
+        '''
+        Returns the (row count, sensor.param_idx) pair of every sensor, in the order in which the
+        sensor blocks are stacked in the jacobian (see assemble_sparse_jacobian)
+        '''
+        return [(sensor.get_residual_length(), sensor.param_idx)
+                for multisensor in self._multisensors for sensor in multisensor.sensors]
 
     def calculate_full_param_vec(self, opt_param_vec):
         '''
@@ -64,37 +114,102 @@ class ErrorCalc:
         return full_param_vec
 
     def calculate_error(self, opt_all_vec):
-        print "x ",
-        sys.stdout.flush()
+        r_vec = self.calculate_residual(opt_all_vec)
+        if self.snapshot is not None:
+            self.snapshot(opt_all_vec, r_vec)
 
-        opt_param_vec, full_pose_arr = self.split_all(opt_all_vec)
+        logger.debug("RMS error: %.3f", numpy.sqrt(numpy.mean(r_vec ** 2)))
 
-        full_param_vec = self.calculate_full_param_vec(opt_param_vec)
+        return array(r_vec)
 
-        # Update the primitives with the new set of parameters
-        self._robot_params.inflate(full_param_vec)
+    def calculate_residual(self, opt_all_vec):
+        """
+        Computes the residual of all multisensors, without any console output
+        """
+        r_list, target_pts_list = self.multisensor_residuals(opt_all_vec, self._use_cov)
+        return concatenate(r_list)
 
-        # Update all the blocks' configs
-        for multisensor in self._multisensors:
-            multisensor.update_config(self._robot_params)
+    def multisensor_residuals(self, opt_all_vec, scaled):
+        """
+        Updates the primitives and computes the residual of every multisensor
+        Inputs:
+        - opt_all_vec: The optimization vector
+        - scaled: If True, the residuals are scaled by sqrt(Gamma)
+        Returns: (r_list, target_pts_list), with the residual and the target points of every multisensor
+        """
+        evaluation = self.evaluate(opt_all_vec)
+        if not scaled:
+            return evaluation['r_list'], evaluation['target_pts_list']
+        r_list = [ms.scale_by_gamma_sqrt(gamma_sqrt, r) for ms, gamma_sqrt, r in
+                  zip(self._multisensors, self.gamma_sqrt_list(opt_all_vec), evaluation['r_list'])]
+        return r_list, evaluation['target_pts_list']
+
+    @timed('evaluate')
+    def evaluate(self, opt_all_vec):
+        """
+        Updates the primitives and evaluates all multisensors at opt_all_vec. The solvers usually ask for
+        the residual and the jacobian at the same point, so the last evaluation is kept and reused as long
+        as the optimization vector is exactly the same.
+        Returns: Dictionary with the optimization vector 'x' and the lists with the unscaled residual
+                 'r_list' and the target points 'target_pts_list' of every multisensor. 'gamma_sqrt_list'
+                 is filled in by gamma_sqrt_list.
+        """
+        opt_all_vec = array(opt_all_vec, float)
+        opt_param_vec, full_pose_arr = self.split_all(opt_all_vec)
+        self.update_primitives(opt_param_vec)
+
+        if self._last_evaluation is not None and numpy.array_equal(self._last_evaluation['x'], opt_all_vec):
+            return self._last_evaluation
 
-        r_list = []
-        for multisensor, cb_pose_vec in zip(self._multisensors, list(full_pose_arr)):
+        target_pts_list = []
+        for multisensor, cb_pose_T in zip(self._multisensors, pose_transforms(full_pose_arr)):
             # Process cb pose
-            cb_points = SingleTransform(cb_pose_vec).transform * self._robot_params.checkerboards[multisensor.checkerboard].generate_points()
-            if (self._use_cov):
-                r_list.append(multisensor.compute_residual_scaled(cb_points))
-            else:
-                r_list.append(multisensor.compute_residual(cb_points))
-        #import code; code.interact(local=locals())
-        r_vec = concatenate(r_list)
+            cb_points = matrix(cb_pose_T) * self._robot_params.checkerboards[multisensor.checkerboard].generate_points()
+            target_pts_list.append(cb_points)
+        r_list = compute_residuals(self._multisensors, target_pts_list)
+        self._last_evaluation = {'x': opt_all_vec, 'r_list': r_list,
+                                 'target_pts_list': target_pts_list, 'gamma_sqrt_list': None}
+        return self._last_evaluation
+
+    def gamma_sqrt_list(self, opt_all_vec):
+        """
+        Returns the blocks of sqrt(Gamma) of every multisensor at opt_all_vec (see MultiSensor.compute_gamma_sqrt_blocks)
+        """
+        evaluation = self.evaluate(opt_all_vec)
+        if evaluation['gamma_sqrt_list'] is None:
+            evaluation['gamma_sqrt_list'] = compute_gamma_sqrt_list(self._multisensors, evaluation['target_pts_list'])
+        return evaluation['gamma_sqrt_list']
 
-        rms_error = numpy.sqrt(numpy.mean(r_vec ** 2))
-        print "%.3f " % rms_error,
-        sys.stdout.flush()
+    @timed('update_primitives')
+    def update_primitives(self, opt_param_vec):
+        """
+        Inflates the primitives with the free system parameters and updates the configs of all multisensors,
+        unless they already hold exactly these parameters
+        """
+        full_param_vec = self.calculate_full_param_vec(opt_param_vec)
+        if self._inflated_param_vec is not None and numpy.array_equal(self._inflated_param_vec, full_param_vec):
+            return
+        self._robot_params.inflate(full_param_vec)
+        for multisensor in self._multisensors:
+            multisensor.update_config(self._robot_params)
+        self.prefetch_fk()
+        self._inflated_param_vec = full_param_vec
 
-        return array(r_vec)
+    @timed('prefetch_fk')
+    def prefetch_fk(self):
+        '''
+        Evaluate the forward kinematics of every dh chain for all the samples in one
+        vectorized pass, so that the sensors don't need to run the solver per message
+        '''
+        chain_states = dict([(chain_id, []) for chain_id in self._robot_params.dh_chains])
+        for multisensor in self._multisensors:
+            for state in multisensor.chain_states():
+                if state.header.frame_id in chain_states:
+                    chain_states[state.header.frame_id].append(state)
+        for chain_id, states in chain_states.items():
+            self._robot_params.dh_chains[chain_id].prefetch(states)
 
+    @timed('dense_jacobian')
     def calculate_jacobian(self, opt_all_vec):
         """
         Full Jacobian:
@@ -128,54 +243,73 @@ class ErrorCalc:
             of the J_m_s_pose blocks are zero, except J_sensor_pose_m, since target m is the only target that
             was viewed by the sensors in this multisensor.
         """
-        sys.stdout.write("J-")
-        sys.stdout.flush()
+        logger.debug("Computing the dense jacobian")
         #import scipy.optimize.slsqp.approx_jacobian as approx_jacobian
         #J = approx_jacobian(opt_param_vec, self.calculate_error, 1e-6)
 
-        opt_param_vec, full_pose_arr = self.split_all(opt_all_vec)
+        J_params, J_poses = self.calculate_jacobian_blocks(opt_all_vec)
+        opt_param_len = J_params.shape[1]
 
         # Allocate the full jacobian matrix
-        ms_r_len = [ms.get_residual_length() for ms in self._multisensors]
-        J = zeros([sum(ms_r_len), len(opt_all_vec)])
-
-        # Calculate at which row each multisensor starts and ends
-        ms_end_row = list(cumsum(ms_r_len))
-        ms_start_row = [0] + ms_end_row[:-1]
-
-        # Calculate at which column each multisensor starts and ends
-        ms_end_col = list(
-            cumsum([6] * len(self._multisensors)) + len(opt_param_vec))
-        ms_start_col = [x - 6 for x in ms_end_col]
-
-        for i, ms in zip(range(len(self._multisensors)), self._multisensors):
-            # Populate the parameter section for this multisensor
-            J_ms_params = J[ms_start_row[i]:ms_end_row[i],
-                            0:len(opt_param_vec)]
-            s_r_len = [s.get_residual_length() for s in ms.sensors]
-            s_end_row = list(cumsum(s_r_len))
-            s_start_row = [0] + s_end_row[:-1]
-            #import code; code.interact(local=locals())
-            target_pose_T = SingleTransform(full_pose_arr[i, :]).transform
-            # Fill in parameter section one sensor at a time
-            for k, s in zip(range(len(ms.sensors)), ms.sensors):
-                J_s_params = J_ms_params[s_start_row[k]:s_end_row[k], :]
-                J_s_params[:, :] = self.single_sensor_params_jacobian(
-                    opt_param_vec, target_pose_T, ms.checkerboard, s)
-
-            # Populate the pose section for this multisensor
-            J_ms_pose = J[ms_start_row[i]:ms_end_row[i],
-                          ms_start_col[i]:ms_end_col[i]]
-            assert(J_ms_pose.shape[1] == 6)
-            J_ms_pose[:, :] = self.multisensor_pose_jacobian(
-                opt_param_vec, full_pose_arr[i, :], ms)
-            #import code; code.interact(local=locals())
-
-        print "-J",
-        sys.stdout.flush()
+        J = zeros([J_params.shape[0], len(opt_all_vec)])
+        J[:, 0:opt_param_len] = J_params
+
+        # Populate the pose section one multisensor at a time
+        ms_start_row = 0
+        for i, J_ms_pose in enumerate(J_poses):
+            ms_end_row = ms_start_row + J_ms_pose.shape[0]
+            ms_start_col = opt_param_len + 6 * i
+            J[ms_start_row:ms_end_row, ms_start_col:ms_start_col + 6] = J_ms_pose
+            ms_start_row = ms_end_row
+
+        return J
+
+    @timed('sparse_jacobian')
+    def calculate_sparse_jacobian(self, opt_all_vec):
+        """
+        Same as calculate_jacobian, but the result is stored as a scipy.sparse.csr_matrix. Only the
+        free system parameter columns of each sensor and the 6 pose columns of each multisensor are
+        stored, so memory grows linearly with the number of calibration samples.
+        """
+        logger.debug("Computing the sparse jacobian")
+        J_params, J_poses = self.calculate_jacobian_blocks(opt_all_vec)
+        J = assemble_sparse_jacobian(J_params, J_poses, self.param_blocks())
 
         return J
 
+    @timed('jacobian_blocks')
+    def calculate_jacobian_blocks(self, opt_all_vec):
+        """
+        Computes the blocks of the full jacobian that can be nonzero (see calculate_jacobian)
+        Output:
+        - J_params: The parameter section of the jacobian, with the J_params_m_s blocks of all
+                    multisensors stacked on top of each other.
+        - J_poses:  List with the J_sensor_pose_m block (6 columns wide) of every multisensor
+        """
+        profiling.next_iteration()
+        if self._jacobian == 'numeric':
+            return self.numeric_jacobian_blocks(opt_all_vec)
+
+        opt_param_vec, full_pose_arr = self.split_all(opt_all_vec)
+        evaluation = self.evaluate(opt_all_vec)
+        if self._use_cov:
+            gamma_sqrt_list = self.gamma_sqrt_list(opt_all_vec)
+
+        J_params_list = []
+        J_poses = []
+        for i, ms in enumerate(self._multisensors):
+            J_ms_params, J_ms_pose = self.multisensor_analytic_jacobian(
+                full_pose_arr[i, :], ms, evaluation['target_pts_list'][i],
+                gamma_sqrt_list[i] if self._use_cov else None)
+            J_params_list.extend(J_ms_params)
+            J_poses.append(J_ms_pose)
+
+        if len(J_params_list) == 0:
+            J_params = zeros([0, len(opt_param_vec)])
+        else:
+            J_params = concatenate([array(J_s) for J_s in J_params_list])
+        return J_params, J_poses
+
     def split_all(self, opt_all_vec):
         """
         Splits the input vector into two parts:
@@ -189,113 +323,362 @@ class ErrorCalc:
         full_pose_arr = numpy.reshape(full_pose_vec, [-1, 6])
         return opt_param_vec, full_pose_arr
 
-    def single_sensor_params_jacobian(self, opt_param_vec, target_pose_T, target_id, sensor):
+    def jacobian_structure(self):
         """
-        Computes the jacobian from the free system parameters to a single sensor
-        Inputs:
-        - opt_param_vec: Vector of the free system parameters (the parameters we're actuall optimizing)
-        - target_pose_T: The pose of the target that this sensor is viewing
-        - target_id: String name of the target that this sensor is viewing. This is necessary to generate the
-                     set of feature points on the target
-        - sensor: The actual sensor definition
-        Output:
-        - J_scaled: An mxn jacobian, where m is the length of sensor's residual and n is the length of opt_param_vec.
-                    If covariance calculations are enabled, then the Jacobian is scaled by sqrt(Gamma), where Gamma
-                    is the information matrix for this measurement.
+        Returns the columns of the optimization vector that the residual of each sensor can depend on:
+        the free system parameters in sensor.param_idx and the 6 pose columns of its multisensor.
+        Output: (block_rows, block_cols), lists with the residual length and the columns of every sensor
         """
-        sparsity_dict = sensor.build_sparsity_dict()
-        required_keys = ['dh_chains', 'tilting_lasers',
-                         'transforms', 'rectified_cams', 'checkerboards']
-        for cur_key in required_keys:
-            if cur_key not in sparsity_dict.keys():
-                sparsity_dict[cur_key] = {}
-        # Generate the full sparsity vector
-        full_sparsity_list = self._robot_params.calc_free(sparsity_dict)
-        full_sparsity_vec = numpy.array(full_sparsity_list)
-
-        # Extract the sparsity for only the parameters we are optimizing over
-
-        #import code; code.interact(local=locals())
-        opt_sparsity_vec = full_sparsity_vec[numpy.where(
-            self._free_list)].copy()
-
-        # Update the primitives with the new set of parameters
-        full_param_vec = self.calculate_full_param_vec(opt_param_vec)
-        self._robot_params.inflate(full_param_vec)
-        sensor.update_config(self._robot_params)
-
-        # based on code from scipy.slsqp
-        x0 = opt_param_vec
+        opt_param_len = sum(self._free_list)
+        block_rows = []
+        block_cols = []
+        for i, multisensor in enumerate(self._multisensors):
+            pose_cols = numpy.arange(opt_param_len + 6 * i, opt_param_len + 6 * i + 6)
+            for sensor in multisensor.sensors:
+                block_rows.append(sensor.get_residual_length())
+                block_cols.append(concatenate([sensor.param_idx, pose_cols]))
+        return block_rows, block_cols
+
+    @timed('numeric_jacobian_blocks')
+    def numeric_jacobian_blocks(self, opt_all_vec):
+        """
+        Computes the jacobian blocks (see calculate_jacobian_blocks) by forward differences. The columns
+        are grouped with column_groups, so that a single residual evaluation estimates all the columns of a
+        group. Only the unscaled residuals are differenced; with covariance calculations enabled the blocks
+        are scaled by sqrt(Gamma) at opt_all_vec afterwards.
+        """
+        opt_all_vec = array(opt_all_vec, float)
+        opt_param_len = sum(self._free_list)
         epsilon = 1e-6
-        target_points = target_pose_T * \
-            self._robot_params.checkerboards[target_id].generate_points()
-        f0 = sensor.compute_residual(target_points)
-        gamma_sqrt = sensor.compute_marginal_gamma_sqrt(target_points)
-        Jt = numpy.zeros([len(x0), len(f0)])
-        dx = numpy.zeros(len(x0))
-        for i in numpy.where(opt_sparsity_vec)[0]:
-            dx[i] = epsilon
-            opt_test_param_vec = x0 + dx
-            full_test_param_vec = self.calculate_full_param_vec(
-                opt_test_param_vec)
-            self._robot_params.inflate(full_test_param_vec)
-            sensor.update_config(self._robot_params)
-            #import code; code.interact(local=locals())
-            target_points = target_pose_T * \
-                self._robot_params.checkerboards[target_id].generate_points()
-            Jt[i] = (sensor.compute_residual(target_points) - f0) / epsilon
-            dx[i] = 0.0
-        J = Jt.transpose()
-        if (self._use_cov):
-            J_scaled = gamma_sqrt * J
-        else:
-            J_scaled = J
-        return J_scaled
 
-    def multisensor_pose_jacobian(self, opt_param_vec, pose_param_vec, multisensor):
+        evaluation = self.evaluate(opt_all_vec)
+        f0 = concatenate(evaluation['r_list'])
+        if self._use_cov:
+            gamma_sqrt_list = self.gamma_sqrt_list(opt_all_vec)
+
+        # The grouping only depends on the layout of the problem
+        if self._column_groups is None:
+            block_rows, block_cols = self.jacobian_structure()
+            block_of_row = numpy.repeat(numpy.arange(len(block_rows)), block_rows)
+            groups = column_groups(block_cols, len(opt_all_vec))
+            self._column_groups = zip(groups, block_group_columns(groups, block_cols)[:, block_of_row])
+
+        J_params = zeros([len(f0), opt_param_len])
+        J_pose = zeros([len(f0), 6])
+        for group, row_columns in self._column_groups:
+            test_vec = opt_all_vec.copy()
+            test_vec[group] += epsilon
+            r_list, target_pts_list = self.multisensor_residuals(test_vec, False)
+            df = (concatenate(r_list) - f0) / epsilon
+
+            # Every row depends on at most one column of the group
+            rows = numpy.where((row_columns >= 0) & (row_columns < opt_param_len))[0]
+            J_params[rows, row_columns[rows]] = df[rows]
+            rows = numpy.where(row_columns >= opt_param_len)[0]
+            J_pose[rows, (row_columns[rows] - opt_param_len) % 6] = df[rows]
+
+        # Leave the primitives in the state of opt_all_vec, and keep its evaluation
+        self.update_primitives(self.split_all(opt_all_vec)[0])
+        self._last_evaluation = evaluation
+
+        J_poses = []
+        first = 0
+        for i, ms in enumerate(self._multisensors):
+            last = first + ms.get_residual_length()
+            J_poses.append(J_pose[first:last])
+            if self._use_cov:
+                J_params[first:last] = ms.scale_by_gamma_sqrt(gamma_sqrt_list[i], J_params[first:last])
+                J_poses[i] = ms.scale_by_gamma_sqrt(gamma_sqrt_list[i], J_poses[i])
+            first = last
+        return J_params, J_poses
+
+    def multisensor_analytic_jacobian(self, pose_param_vec, multisensor, target_pts, gamma_sqrt_blocks=None):
         """
-        Generates the jacobian from a target pose to the multisensor's residual.
+        Computes the jacobian blocks of a multisensor from the closed form derivatives of its sensors.
+        The primitives must already be updated with the current set of parameters (see update_primitives).
 
         Input:
-        - opt_param_vec: Vector of the free system parameters (the parameters we're actuall optimizing)
         - pose_param_vec: Vector of length 6 encoding the target's pose 0:3=translation 3:6=rotation_axis
         - multisensor: The actual multisensor definition.
+        - target_pts: The target points in world coordinates for this pose
+        - gamma_sqrt_blocks: The blocks of sqrt(Gamma) of every sensor, only needed if covariance
+                             calculations are enabled
         Output:
-        - J_scaled: An mx6 jacobian, where m is the length of multisensor's residual. There are 6 columns since the
-                    target's pose is encoded using 6 parameters.
-                    If covariance calculations are enabled, then the Jacobian is scaled by sqrt(Gamma), where Gamma
-                    is the information matrix for this measurement.
+        - J_params_list: List with the J_params_m_s block of every sensor of the multisensor
+        - J_pose: An mx6 jacobian, where m is the length of multisensor's residual.
+        If covariance calculations are enabled, then all blocks are scaled by sqrt(Gamma), where Gamma
+        is the information matrix for this measurement.
         """
-        # Update the primitives with the new set of parameters
-        full_param_vec = self.calculate_full_param_vec(opt_param_vec)
-        self._robot_params.inflate(full_param_vec)
-        multisensor.update_config(self._robot_params)
         cb_model = self._robot_params.checkerboards[multisensor.checkerboard]
-        local_cb_points = cb_model.generate_points()
+        local_cb_points = array(cb_model.generate_points())
+        target_pose_T = pose_transforms(pose_param_vec)[0]
+
+        # Derivatives of the target points (world coordinates) w.r.t. the target's pose and
+        # w.r.t. the checkerboard spacing. Both are Nx3xK arrays.
+        dtarget_pose = numpy.einsum('kij,jn->nik', pose_jacobian(pose_param_vec)[:, 0:3, :], local_cb_points)
+        dtarget_cb = numpy.einsum('ij,kjn->nik', target_pose_T[0:3, :], cb_model.generate_points_jacobian())
+
+        J_params_list = []
+        J_pose_list = [zeros([0, 6])]
+        for s, sensor in enumerate(multisensor.sensors):
+            J_s_full, J_s_target = sensor.compute_residual_jacobian(target_pts)
+            r_len = J_s_full.shape[0]
+            J_s_full[:, cb_model.start:cb_model.end] += numpy.einsum('nai,nik->nak', J_s_target, dtarget_cb).reshape(r_len, -1)
+            J_s_pose = numpy.einsum('nai,nik->nak', J_s_target, dtarget_pose).reshape(r_len, 6)
+            J_s_params = J_s_full[:, self._free_idx]
+            if (self._use_cov):
+                J_s_params = scale_blocks(gamma_sqrt_blocks[s], J_s_params)
+                J_s_pose = scale_blocks(gamma_sqrt_blocks[s], J_s_pose)
+            J_params_list.append(J_s_params)
+            J_pose_list.append(J_s_pose)
+        return J_params_list, concatenate(J_pose_list)
 
-        # based on code from scipy.slsqp
-        x0 = pose_param_vec
-        epsilon = 1e-6
-        world_pts = SingleTransform(x0).transform * local_cb_points
-        f0 = multisensor.compute_residual(world_pts)
-        gamma_sqrt = multisensor.compute_marginal_gamma_sqrt(world_pts)
-
-        Jt = numpy.zeros([len(x0), len(f0)])
-        dx = numpy.zeros(len(x0))
-        for i in range(len(x0)):
-            dx[i] = epsilon
-            test_vec = x0 + dx
-            fTest = multisensor.compute_residual(
-                SingleTransform(test_vec).transform * local_cb_points)
-            Jt[i] = (fTest - f0) / epsilon
-            #import code; code.interact(local=locals())
-            dx[i] = 0.0
-        J = Jt.transpose()
-        if (self._use_cov):
-            J_scaled = gamma_sqrt * J
+
+def column_groups(block_cols, num_cols):
+    """
+    Partitions the columns of a jacobian into groups of structurally orthogonal columns, i.e. no two
+    columns of a group can be nonzero in the same row (Curtis, Powell and Reid). All columns of a group
+    can then be estimated with a single finite difference. The columns are colored greedily, the ones
+    that appear in the most row blocks first.
+    Inputs:
+    - block_cols: List with the columns that can be nonzero in every row block
+    - num_cols: Number of columns of the jacobian
+    Returns: List with the sorted column index array of every group
+    """
+    col_blocks = [[] for col in range(num_cols)]
+    for block, cols in enumerate(block_cols):
+        for col in cols:
+            col_blocks[col].append(block)
+    col_blocks = [numpy.array(blocks, int) for blocks in col_blocks]
+
+    order = sorted(range(num_cols), key=lambda col: -len(col_blocks[col]))
+    groups = []
+    used_blocks = []
+    for col in order:
+        for group, used in zip(groups, used_blocks):
+            if not used[col_blocks[col]].any():
+                break
         else:
-            J_scaled = J
-        return J_scaled
+            group = []
+            used = numpy.zeros(len(block_cols), bool)
+            groups.append(group)
+            used_blocks.append(used)
+        group.append(col)
+        used[col_blocks[col]] = True
+    return [numpy.array(sorted(group), int) for group in groups]
+
+
+def block_group_columns(groups, block_cols):
+    """
+    Returns a (groups x row blocks) array with the column of every group that each row block
+    depends on, or -1 if the row block doesn't depend on any column of the group (see column_groups)
+    """
+    cols = concatenate([zeros(0, int)] + [numpy.asarray(c, int) for c in block_cols])
+    blocks = numpy.repeat(numpy.arange(len(block_cols)), [len(c) for c in block_cols])
+    num_cols = max([0] + [numpy.max(c) + 1 for c in [cols] + list(groups) if len(c) > 0])
+    group_of_col = -numpy.ones(num_cols, int)
+    for g, group in enumerate(groups):
+        group_of_col[group] = g
+    grouped = group_of_col[cols] >= 0
+    columns = -numpy.ones([len(groups), len(block_cols)], int)
+    columns[group_of_col[cols[grouped]], blocks[grouped]] = cols[grouped]
+    return columns
+
+
+@timed('assemble_sparse_jacobian')
+def assemble_sparse_jacobian(J_params, J_poses, param_blocks=None):
+    """
+    Builds the full jacobian as a scipy.sparse.csr_matrix out of the blocks generated
+    by ErrorCalc.calculate_jacobian_blocks
+    Inputs:
+    - J_params: RxF parameter section of the jacobian
+    - J_poses: List of M pose blocks, each of them 6 columns wide
+    - param_blocks: Optional list with the (row count, parameter columns) of every sensor block of
+                    J_params (see ErrorCalc.param_blocks). Only these columns are stored, which keeps
+                    the sparsity pattern the same in every iteration. Without it, all nonzeros are stored.
+    Returns: Rx(F + Mx6) sparse jacobian
+    """
+    J_params = array(J_params)
+    num_rows, opt_param_len = J_params.shape
+
+    # Parameter section: only store the entries that are actually populated
+    if param_blocks is None:
+        param_rows, param_cols = numpy.nonzero(J_params)
+    else:
+        rows_list = []
+        cols_list = []
+        first = 0
+        for block_rows, param_idx in param_blocks:
+            rows, cols = numpy.meshgrid(numpy.arange(first, first + block_rows), param_idx, indexing='ij')
+            rows_list.append(rows.ravel())
+            cols_list.append(cols.ravel())
+            first += block_rows
+        assert(first == num_rows)
+        param_rows = concatenate([zeros(0, int)] + rows_list)
+        param_cols = concatenate([zeros(0, int)] + cols_list)
+    row_list = [param_rows]
+    col_list = [param_cols]
+    val_list = [J_params[param_rows, param_cols]]
+
+    # Pose section: every multisensor owns a dense block on the diagonal
+    ms_start_row = 0
+    for i, J_ms_pose in enumerate(J_poses):
+        ms_rows = J_ms_pose.shape[0]
+        rows, cols = numpy.mgrid[0:ms_rows, 0:6]
+        row_list.append(rows.ravel() + ms_start_row)
+        col_list.append(cols.ravel() + opt_param_len + 6 * i)
+        val_list.append(J_ms_pose.ravel())
+        ms_start_row += ms_rows
+    assert(ms_start_row == num_rows)
+
+    return scipy.sparse.csr_matrix(
+        (concatenate(val_list), (concatenate(row_list), concatenate(col_list))),
+        shape=(num_rows, opt_param_len + 6 * len(J_poses)))
+
+
+def solve_leastsq(error_calc, opt_all):
+    """
+    Dense Levenberg-Marquardt (MINPACK) on the full jacobian.
+    """
+    x, cov_x, infodict, mesg, iter = scipy.optimize.leastsq(error_calc.calculate_error, opt_all, Dfun=error_calc.calculate_jacobian, full_output=1)
+    return x
+
+
+def solve_sparse(error_calc, opt_all):
+    """
+    Trust region reflective solver that works directly on the sparse jacobian.
+    The columns are scaled by the jacobian norms, as MINPACK does for solve_leastsq.
+    """
+    if not hasattr(scipy.optimize, 'least_squares'):
+        raise Exception("The [sparse] solver requires scipy.optimize.least_squares (scipy >= 0.17)")
+    result = scipy.optimize.least_squares(error_calc.calculate_error, opt_all, jac=error_calc.calculate_sparse_jacobian,
+                                          method='trf', tr_solver='lsmr', x_scale='jac')
+    print ""
+    print result.message
+    return result.x
+
+
+# Lower bound of the damping of the Schur complement solver, relative to the column norms of the jacobian
+MIN_DAMPING = 1e-9
+
+
+@timed('schur_step')
+def schur_step(J_params, J_poses, r, damping):
+    """
+    Computes the Levenberg-Marquardt step, i.e. the least squares solution of
+
+        [           J           ]         [ r ]
+        [ sqrt(damping) diag(D) ] dx = - [ 0 ]
+
+    where D are the column norms of J, by eliminating the pose of every multisensor first. This is
+    the Schur complement of the pose blocks, computed in square root form: the rows of every multisensor
+    are projected onto the orthogonal complement of its (damped) pose block, which leaves a least squares
+    problem in the system parameters only. The poses are then recovered by back substitution.
+    Inputs:
+    - J_params, J_poses: The jacobian blocks (see ErrorCalc.calculate_jacobian_blocks)
+    - r: The residual vector
+    - damping: Levenberg-Marquardt damping factor
+    Returns: (dx, J_dx), the step for the full optimization vector and the change it predicts for the residual
+    """
+    J_params = array(J_params)
+    r = array(r)
+    opt_param_len = J_params.shape[1]
+    sqrt_damping = numpy.sqrt(damping)
+
+    reduced_J = []
+    reduced_r = []
+    pose_factors = []
+    first = 0
+    for J_ms_pose in J_poses:
+        last = first + J_ms_pose.shape[0]
+        # Append the damping rows of the pose, which only belong to this multisensor. A pose that is
+        # not observed at all is damped with unit scale, which keeps it in place.
+        pose_norms = numpy.sqrt((J_ms_pose ** 2).sum(0))
+        J_c = numpy.vstack([J_ms_pose, sqrt_damping * numpy.diag(numpy.where(pose_norms > 0, pose_norms, 1.0))])
+        J_p = numpy.vstack([J_params[first:last], zeros([6, opt_param_len])])
+        r_c = concatenate([r[first:last], zeros(6)])
+        Q, R = numpy.linalg.qr(J_c)
+        if numpy.any(numpy.abs(numpy.diag(R)) <= 1e-12 * max(numpy.abs(R).max(), 1e-300)):
+            raise numpy.linalg.LinAlgError("Pose block is rank deficient")
+        QtJ_p = numpy.dot(Q.T, J_p)
+        Qtr_c = numpy.dot(Q.T, r_c)
+        reduced_J.append(J_p - numpy.dot(Q, QtJ_p))
+        reduced_r.append(r_c - numpy.dot(Q, Qtr_c))
+        pose_factors.append((R, QtJ_p, Qtr_c))
+        first = last
+
+    # Damping rows of the system parameters
+    column_norms = numpy.sqrt((J_params ** 2).sum(0))
+    reduced_J.append(sqrt_damping * numpy.diag(column_norms))
+    reduced_r.append(zeros(opt_param_len))
+    if opt_param_len > 0:
+        # Solve in the scaled parameters, which keeps the singular values of parameters with different units comparable
+        scale = numpy.where(column_norms > 0, column_norms, 1.0)
+        dp = numpy.linalg.lstsq(numpy.vstack(reduced_J) / scale, -concatenate(reduced_r), rcond=None)[0] / scale
+    else:
+        dp = zeros(0)
+
+    dc = [-scipy.linalg.solve_triangular(R, numpy.dot(QtJ_p, dp) + Qtr_c) for R, QtJ_p, Qtr_c in pose_factors]
+
+    J_dx = numpy.dot(J_params, dp)
+    first = 0
+    for J_ms_pose, dc_i in zip(J_poses, dc):
+        last = first + J_ms_pose.shape[0]
+        J_dx[first:last] += numpy.dot(J_ms_pose, dc_i)
+        first = last
+    return concatenate([dp] + dc), J_dx
+
+
+def solve_schur(error_calc, opt_all, max_iterations=100, ftol=1.49012e-08, xtol=1.49012e-08):
+    """
+    Levenberg-Marquardt that marginalizes the checkerboard poses in every iteration (see schur_step), as
+    done in bundle adjustment. The cost of an iteration grows linearly with the number of calibration samples.
+    The damping is updated from the ratio of the actual and the predicted cost reduction.
+    """
+    x = array(opt_all, float)
+    r = error_calc.calculate_error(x)
+    cost = numpy.dot(r, r)
+    damping = 1e-3
+    factor = 2.0
+    for iteration in range(max_iterations):
+        J_params, J_poses = error_calc.calculate_jacobian_blocks(x)
+
+        # Increase the damping until the step reduces the cost
+        while True:
+            dx, J_dx = schur_step(J_params, J_poses, r, damping)
+            x_new = x + dx
+            r_new = error_calc.calculate_error(x_new)
+            cost_new = numpy.dot(r_new, r_new)
+            predicted = cost - numpy.dot(r + J_dx, r + J_dx)
+            if cost_new < cost:
+                rho = (cost - cost_new) / max(predicted, 1e-300)
+                damping = max(damping * max(1.0 / 3.0, 1.0 - (2.0 * rho - 1.0) ** 3), MIN_DAMPING)
+                factor = 2.0
+                break
+            damping *= factor
+            factor *= 2.0
+            if damping > 1e16:
+                print ""
+                print "Schur solver: the cost can not be reduced any further"
+                return x
+
+        converged = (cost - cost_new) <= ftol * cost and predicted <= ftol * cost or \
+                    numpy.linalg.norm(dx) <= xtol * (numpy.linalg.norm(x) + xtol)
+        x, r, cost = x_new, r_new, cost_new
+        if converged:
+            print ""
+            print "Schur solver converged after %u iterations" % (iteration + 1)
+            return x
+    print ""
+    print "Schur solver: reached the maximum number of iterations (%u)" % max_iterations
+    return x
+
+
+# Solver backends that can be selected for a calibration step. Each one maps
+# (error_calc, initial_guess) -> optimized vector
+solvers = {'leastsq': solve_leastsq,
+           'sparse':  solve_sparse,
+           'schur':   solve_schur}
 
 
 def build_opt_vector(robot_params, free_dict, pose_guess_arr):
@@ -334,14 +717,26 @@ def build_opt_vector(robot_params, free_dict, pose_guess_arr):
     return opt_all
 
 
+def fk_pose_guess(robot_params, multisensor):
+    """
+    Guess of the checkerboard pose of a multisensor from the forward kinematics of its chain sensor
+    (see ChainSensor.compute_target_pose) with the parameters of robot_params
+    Returns: Pose vector [x, y, z, rx, ry, rz], or None if the multisensor has no chain sensor
+    """
+    multisensor.update_config(robot_params)
+    for sensor in multisensor.sensors:
+        if sensor.sensor_type == "chain":
+            T = array(sensor.compute_target_pose())
+            return concatenate([T[0:3, 3], rotation_vectors(T[0:3, 0:3])[0]])
+    return None
+
+
 def compute_errors_breakdown(error_calc, multisensors, opt_pose_arr):
     errors_dict = {}
     # Compute the error for each sensor type
-    for ms, k in zip(multisensors, range(len(multisensors))):
+    for ms, cb_pose_T in zip(multisensors, pose_transforms(opt_pose_arr)):
         cb = error_calc._robot_params.checkerboards[ms.checkerboard]
-        cb_pose_vec = opt_pose_arr[k]
-        target_pts = SingleTransform(
-            cb_pose_vec).transform * cb.generate_points()
+        target_pts = matrix(cb_pose_T) * cb.generate_points()
         for sensor in ms.sensors:
             r_sensor = sensor.compute_residual(target_pts) * numpy.sqrt(sensor.terms_per_sample)    # terms per sample is a hack to find rms distance, instead of a pure rms, based on each term
             if sensor.sensor_id not in errors_dict.keys():
@@ -350,30 +745,57 @@ def compute_errors_breakdown(error_calc, multisensors, opt_pose_arr):
     return errors_dict
 
 
-def opt_runner(robot_params_dict, pose_guess_arr, free_dict, multisensors, use_cov):
+def opt_runner(robot_params_dict, pose_guess_arr, free_dict, multisensors, use_cov, solver='leastsq', jacobian='analytic', processes=1, checkpoint=None):
     """
     Runs a single optimization step for the calibration optimization.
       robot_params_dict - Dictionary storing all of the system primitives' parameters (lasers, cameras, chains, transforms, etc)
       free_dict - Dictionary storing which parameters are free
       multisensor - list of list of measurements. Each multisensor corresponds to a single checkerboard pose
       pose_guesses - List of guesses as to where all the checkerboard are. This is used to initialze the optimization
+      solver - Name of the solver backend (see solvers)
+      jacobian - 'analytic' or 'numeric' (finite differences, see ErrorCalc)
+      processes - Number of worker processes the multisensors are sharded across (see ParallelErrorCalc).
+                  With 1, everything is evaluated in this process
+      checkpoint - Optional StepCheckpoint (see checkpoint.py). The optimization starts from its last
+                   snapshot, if there is one, and keeps it up to date while running
+    Returns: (output_dict, opt_pose_arr, J), with the scipy.sparse jacobian J of the optimized vector
     """
+    if solver not in solvers:
+        raise Exception("Unknown solver [%s]. Valid solvers are: %s" % (solver, ", ".join(sorted(solvers.keys()))))
 
     # Load the robot params
     robot_params = RobotParams()
     robot_params.configure(robot_params_dict)
 
-    error_calc = ErrorCalc(robot_params, free_dict, multisensors, use_cov)
+    if processes > 1:
+        # Imported here, since parallel_error_calc depends on this module
+        from cob_robot_calibration_est.parallel_error_calc import ParallelErrorCalc
+        error_calc = ParallelErrorCalc(robot_params, free_dict, multisensors, use_cov, jacobian, processes)
+    else:
+        error_calc = ErrorCalc(robot_params, free_dict, multisensors, use_cov, jacobian)
 
     # Construct the initial guess
     opt_all = build_opt_vector(robot_params, free_dict, pose_guess_arr)
     #print len( scipy.optimize.leastsq(error_calc.calculate_error, opt_all, Dfun=error_calc.calculate_jacobian, full_output=1))
     #return
-    x, cov_x, infodict, mesg, iter = scipy.optimize.leastsq(error_calc.calculate_error, opt_all, Dfun=error_calc.calculate_jacobian, full_output=1)
-    #x = opt_all
-    #error_calc.calculate_error(x)
-
-    J = error_calc.calculate_jacobian(x)
+    if checkpoint is not None:
+        snapshot = checkpoint.load_snapshot(len(opt_all))
+        if snapshot is not None:
+            print "Resuming from the last snapshot of this step"
+            opt_all = snapshot
+        error_calc.snapshot = checkpoint.snapshot
+    try:
+        x = solvers[solver](error_calc, opt_all)
+        #x = opt_all
+        #error_calc.calculate_error(x)
+
+        # The returned jacobian is sparse for every solver, a dense one only exists inside leastsq
+        J = error_calc.calculate_sparse_jacobian(x)
+    finally:
+        if checkpoint is not None:
+            checkpoint.flush()
+        if processes > 1:
+            error_calc.close()
 
     # A hacky way to inflate x back into robot params
     opt_param_vec, pose_vec = error_calc.split_all(x)
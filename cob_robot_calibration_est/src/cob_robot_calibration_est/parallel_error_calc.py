@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+import multiprocessing
+import traceback
+import numpy
+from numpy import array, cumsum, concatenate
+
+from cob_robot_calibration_est.opt_runner import ErrorCalc
+from cob_robot_calibration_est.profiling import timed
+from cob_robot_calibration_est import profiling
+
+
+def shared_array(shape):
+    """
+    Allocates a zero initialized float array in shared memory, so that it can be
+    written by forked worker processes and read by the parent process
+    """
+    size = int(numpy.prod(shape))
+    buf = multiprocessing.RawArray('d', max(size, 1))
+    return numpy.frombuffer(buf, dtype=float)[0:size].reshape(shape)
+
+
+def shard_ranges(lengths, shards):
+    """
+    Splits a list of multisensors into contiguous shards with roughly the same number of residual rows
+    Inputs:
+    - lengths: Residual length of every multisensor
+    - shards: Number of shards to build
+    Returns: List of (first, last) multisensor indices of every non empty shard
+    """
+    ends = cumsum(lengths)
+    total = float(ends[-1]) if len(ends) > 0 else 0.0
+    ranges = []
+    first = 0
+    for k in range(1, shards + 1):
+        if k == shards:
+            last = len(lengths)
+        else:
+            last = max(int(numpy.searchsorted(ends, total * k / shards, side='right')), first + 1)
+            last = min(last, len(lengths))
+        if last > first:
+            ranges.append((first, last))
+        first = last
+    return ranges
+
+
+class ParallelErrorCalc(ErrorCalc):
+    """
+    ErrorCalc that shards the multisensors across a pool of worker processes
+
+    The workers are forked when the ErrorCalc is constructed, so each of them holds its own
+    copy of the RobotParams and of its multisensors. For every evaluation only the optimization
+    vector is sent to the workers, which write their rows of the residual and of the jacobian
+    blocks into shared memory.
+    """
+    def __init__(self, robot_params, free_dict, multisensors, use_cov, jacobian='analytic', processes=None):
+        ErrorCalc.__init__(self, robot_params, free_dict, multisensors, use_cov, jacobian)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        # The residual lengths are only known once the sensors are configured
+        for multisensor in multisensors:
+            multisensor.update_config(robot_params)
+        ms_lengths = [ms.get_residual_length() for ms in multisensors]
+        ms_ends = list(cumsum(ms_lengths))
+        self._ms_rows = zip([0] + ms_ends[0:-1], ms_ends)
+        num_rows = sum(ms_lengths)
+        opt_param_len = sum(self._free_list)
+
+        self._residual = shared_array((num_rows,))
+        self._J_params = shared_array((num_rows, opt_param_len))
+        self._J_pose = shared_array((num_rows, 6))
+
+        self._workers = []
+        for first, last in shard_ranges(ms_lengths, max(processes, 1)):
+            parent_conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_worker_main, args=(self, child_conn, first, last))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self._workers.append((process, parent_conn))
+
+    @timed('parallel_residual')
+    def calculate_residual(self, opt_all_vec):
+        self.run_workers('residual', opt_all_vec)
+        return self._residual.copy()
+
+    @timed('parallel_jacobian_blocks')
+    def calculate_jacobian_blocks(self, opt_all_vec):
+        profiling.next_iteration()
+        self.run_workers('jacobian', opt_all_vec)
+
+        # Keep the primitives of this process in sync, as the caller may evaluate the sensors directly
+        self.update_primitives(self.split_all(opt_all_vec)[0])
+
+        J_poses = [self._J_pose[first:last, :].copy() for first, last in self._ms_rows]
+        return self._J_params.copy(), J_poses
+
+    def run_workers(self, command, opt_all_vec):
+        """
+        Sends the optimization vector to all workers and waits until they are done
+        """
+        if len(self._workers) == 0:
+            raise Exception("The worker processes have already been shut down")
+        opt_all_vec = numpy.array(opt_all_vec, float)
+        for process, conn in self._workers:
+            conn.send((command, opt_all_vec))
+        errors = [conn.recv() for process, conn in self._workers]
+        errors = [e for e in errors if e is not None]
+        if len(errors) > 0:
+            raise Exception("Worker process failed:\n%s" % errors[0])
+
+    def close(self):
+        """
+        Shuts down the worker processes
+        """
+        for process, conn in self._workers:
+            conn.send(None)
+            conn.close()
+        for process, conn in self._workers:
+            process.join()
+        self._workers = []
+
+
+def _worker_main(error_calc, conn, first, last):
+    """
+    Main loop of a worker process. Evaluates the multisensors [first, last) of the
+    (forked) error_calc for every optimization vector it receives
+    """
+    row_start = error_calc._ms_rows[first][0]
+    row_end = error_calc._ms_rows[last - 1][1]
+    opt_param_len = sum(error_calc._free_list)
+
+    error_calc._workers = []
+    error_calc._multisensors = error_calc._multisensors[first:last]
+    error_calc._column_groups = None
+
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        command, opt_all_vec = msg
+        try:
+            # Only keep the poses of this worker's multisensors
+            local_vec = concatenate([opt_all_vec[0:opt_param_len],
+                                     opt_all_vec[opt_param_len + 6 * first:opt_param_len + 6 * last]])
+            if command == 'residual':
+                error_calc._residual[row_start:row_end] = ErrorCalc.calculate_residual(error_calc, local_vec)
+            elif command == 'jacobian':
+                J_params, J_poses = ErrorCalc.calculate_jacobian_blocks(error_calc, local_vec)
+                error_calc._J_params[row_start:row_end, :] = J_params
+                error_calc._J_pose[row_start:row_end, :] = concatenate([array(J).reshape([-1, 6]) for J in J_poses])
+            else:
+                raise Exception("Unknown command [%s]" % command)
+            conn.send(None)
+        except Exception:
+            conn.send(traceback.format_exc())
+    conn.close()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+# Opt-in profiling of the estimator's hot paths.
+#
+# Functions are instrumented with the timed decorator. As long as no Profiler is enabled,
+# the decorator only adds a single check per call. Once enabled, the wall time and the
+# call count of every instrumented function are accumulated per iteration of the
+# optimization (an iteration starts with every jacobian evaluation, see next_iteration),
+# and the single calls are kept as events for a Chrome trace (chrome://tracing). The
+# times are inclusive, e.g. the time of 'fk' is also part of the time of the
+# 'update_config' or 'jacobian' call it happens in.
+#
+# Only the calls of the current process are recorded, so the work of the worker
+# processes of a ParallelErrorCalc shows up as part of the calls that wait for it.
+
+import functools
+import json
+import os
+import time
+
+_profiler = None
+
+
+class Profiler:
+    """
+    Records the calls of the instrumented functions while it is enabled (see enable)
+    - max_events: Number of single calls that are kept for the Chrome trace. Calls beyond
+                  that only count towards the statistics.
+    """
+    def __init__(self, max_events=1000000):
+        self.max_events = max_events
+        self.events = []
+        self.iteration = 0
+        self.start = time.time()
+        # (iteration, name) -> [calls, seconds]
+        self._stats = {}
+
+    def record(self, name, start, end):
+        key = (self.iteration, name)
+        if key not in self._stats:
+            self._stats[key] = [0, 0.0]
+        self._stats[key][0] += 1
+        self._stats[key][1] += end - start
+        if len(self.events) < self.max_events:
+            self.events.append((name, start, end, self.iteration))
+
+    def statistics(self):
+        """
+        Returns a dictionary with the calls and seconds of every instrumented function, both
+        in total ('totals') and for every iteration ('iterations')
+        """
+        totals = {}
+        iterations = [{} for i in range(self.iteration + 1)]
+        for (iteration, name), (calls, seconds) in self._stats.items():
+            iterations[iteration][name] = {'calls': calls, 'seconds': seconds}
+            total = totals.setdefault(name, {'calls': 0, 'seconds': 0.0})
+            total['calls'] += calls
+            total['seconds'] += seconds
+        return {'wall_time': time.time() - self.start, 'totals': totals, 'iterations': iterations}
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.statistics(), f, indent=1, sort_keys=True)
+
+    def write_chrome_trace(self, filename):
+        """
+        Writes the recorded calls in the Chrome trace event format
+        """
+        pid = os.getpid()
+        events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': 0,
+                   'ts': (start - self.start) * 1e6, 'dur': (end - start) * 1e6,
+                   'args': {'iteration': iteration}}
+                  for name, start, end, iteration in self.events]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def enable(profiler=None):
+    """
+    Starts recording with profiler, or a new Profiler if none is given
+    Returns: The active Profiler
+    """
+    global _profiler
+    if profiler is None:
+        profiler = Profiler()
+    _profiler = profiler
+    return profiler
+
+
+def disable():
+    """
+    Stops recording
+    Returns: The Profiler that was active, if any
+    """
+    global _profiler
+    profiler = _profiler
+    _profiler = None
+    return profiler
+
+
+def next_iteration():
+    """
+    Marks the start of the next iteration of the optimization
+    """
+    if _profiler is not None:
+        _profiler.iteration += 1
+
+
+def timed(name):
+    """
+    Decorator that records every call of the decorated function as name, while a Profiler is enabled
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return function(*args, **kwargs)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profiler.record(name, start, time.time())
+        return wrapper
+    return decorate
@@ -32,10 +32,7 @@
 
 # author: Vijay Pradeep
 
-import roslib; roslib.load_manifest('cob_robot_calibration_est')
-
 import sys
-import rospy
 import numpy
 
 from cob_robot_calibration_est.dh_chain import DhChain
@@ -43,6 +40,7 @@ from cob_robot_calibration_est.dh_chain import DhChain
 from cob_robot_calibration_est.single_transform import SingleTransform
 from cob_robot_calibration_est.camera import RectifiedCamera
 from cob_robot_calibration_est.checkerboard import Checkerboard
+from cob_robot_calibration_est.profiling import timed
 
 # Construct a dictionary of all the primitives of the specified type
 def init_primitive_dict(start_index, config_dict, PrimitiveType):
@@ -75,6 +73,12 @@ def deflate_primitive_dict(param_vec, primitive_dict):
     for key, elem in primitive_dict.items():
         param_vec[elem.start:elem.end,0] = elem.deflate()
 
+# Given a dictionary of initialized primitives, store the names of their
+# parameters in the specified list, prefixed with the primitive name
+def primitive_param_names(name_list, primitive_dict, prefix):
+    for key, elem in primitive_dict.items():
+        name_list[elem.start:elem.end] = ["%s.%s.%s" % (prefix, key, x) for x in elem.get_param_names()]
+
 # Iterate over config dictionary and determine which parameters should be free,
 # based on the the flags in the free dictionary. Once computed, update the part
 # of the target vector that corresponds to this primitive
@@ -130,6 +134,7 @@ class RobotParams:
         config_dict["checkerboards"]  = primitive_params_to_config(param_vec, self.checkerboards)
         return config_dict
 
+    @timed('inflate')
     def inflate(self, param_vec):
         assert(self.length == param_vec.size)
 
@@ -139,6 +144,16 @@ class RobotParams:
         inflate_primitive_dict(param_vec, self.rectified_cams)
         inflate_primitive_dict(param_vec, self.checkerboards)
 
+    # Returns the names of all parameters, in the same order as deflate,
+    # e.g. "transforms.head_link.x"
+    def get_param_names(self):
+        name_list = [None] * self.length
+        primitive_param_names(name_list, self.dh_chains,      "dh_chains")
+        primitive_param_names(name_list, self.transforms,     "transforms")
+        primitive_param_names(name_list, self.rectified_cams, "rectified_cams")
+        primitive_param_names(name_list, self.checkerboards,  "checkerboards")
+        return name_list
+
     def deflate(self):
         param_vec = numpy.matrix( numpy.zeros((self.length,1), float))
         deflate_primitive_dict(param_vec, self.dh_chains)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+
+# Selection of the most informative samples of a calibration step before its optimization. Samples
+# with nearly the same robot pose add to the cost of every iteration, but hardly constrain the
+# parameters any further. Every sample is scored by the information it contributes to the free system
+# parameters, from its jacobian blocks at the initial guess with its checkerboard pose eliminated.
+# A subset of the requested size is then picked greedily to maximize the determinant of the information
+# matrix of the free parameters (D-optimal design).
+
+import copy
+import heapq
+import numpy
+from numpy import array, zeros, dot
+
+from cob_robot_calibration_est.robot_params import RobotParams
+from cob_robot_calibration_est.opt_runner import ErrorCalc, fk_pose_guess
+from cob_robot_calibration_est.covariance import eliminate_pose
+
+
+def sample_information(error_calc, opt_all_vec):
+    """
+    Square root information that every multisensor contributes to the free system parameters at
+    opt_all_vec, with its checkerboard pose eliminated (see eliminate_pose)
+    Returns: List with the rows A_i of every multisensor, whose information matrix is A_i'A_i
+    """
+    J_params, J_poses = error_calc.calculate_jacobian_blocks(opt_all_vec)
+    info_rows = []
+    first = 0
+    for J_pose in J_poses:
+        last = first + J_pose.shape[0]
+        info_rows.append(eliminate_pose(J_params[first:last], J_pose, zeros(last - first))[0])
+        first = last
+    return info_rows
+
+
+def select_samples(info_rows, budget, regularization=1e-6):
+    """
+    Greedy D-optimal selection of budget samples: each step adds the sample that increases the log
+    determinant of the information matrix of the free parameters the most. The information matrix
+    starts at regularization times the diagonal of the information of all samples, which makes the
+    choice independent of the units of the parameters. The log determinant is submodular, i.e. the
+    gain of a sample can only shrink as others are added, so the gains are kept in a heap and only
+    recomputed for the sample on top of it.
+    Inputs:
+    - info_rows: List with the square root information of every sample (see sample_information)
+    - budget: Number of samples to select
+    Returns: Sorted array with the indices of the selected samples
+    """
+    F = info_rows[0].shape[1] if len(info_rows) > 0 else 0
+    total_diag = zeros(F)
+    for A in info_rows:
+        total_diag += (A ** 2).sum(0)
+    M_inv = numpy.diag(1.0 / (regularization * numpy.where(total_diag > 0, total_diag, 1.0)))
+
+    def gain(A):
+        if A.shape[0] == 0:
+            return 0.0
+        return numpy.linalg.slogdet(numpy.eye(A.shape[0]) + dot(dot(A, M_inv), A.T))[1]
+
+    heap = [(-gain(A), k) for k, A in enumerate(info_rows)]
+    heapq.heapify(heap)
+    selected = []
+    while len(heap) > 0 and len(selected) < budget:
+        neg_gain, k = heapq.heappop(heap)
+        cur_gain = gain(info_rows[k])
+        if len(heap) > 0 and cur_gain < -heap[0][0]:
+            # Outdated gain, another sample might be better now
+            heapq.heappush(heap, (-cur_gain, k))
+            continue
+        selected.append(k)
+        # Update the inverse with the Woodbury identity
+        AM = dot(info_rows[k], M_inv)
+        M_inv = M_inv - dot(AM.T, numpy.linalg.solve(numpy.eye(AM.shape[0]) + dot(AM, info_rows[k].T), AM))
+        M_inv = 0.5 * (M_inv + M_inv.T)
+    return numpy.sort(array(selected, int))
+
+
+def choose_samples(robot_params_dict, free_dict, multisensors, pose_guess_arr, use_cov, budget):
+    """
+    Scores the multisensors of a calibration step at its initial guess, and selects budget of them
+    (see select_samples). The checkerboard poses are guessed from the forward kinematics where possible,
+    since the pose guesses of the first step are usually all zero.
+    Returns: (selected, poses), the sorted array with the indices of the selected multisensors and the
+             Mx6 array of the pose guesses they were scored with
+    """
+    robot_params = RobotParams()
+    robot_params.configure(copy.deepcopy(robot_params_dict))
+    free_list = robot_params.calc_free(copy.deepcopy(free_dict))
+    error_calc = ErrorCalc(robot_params, copy.deepcopy(free_dict), multisensors, use_cov)
+
+    poses = array(pose_guess_arr, float).copy()
+    for k, multisensor in enumerate(multisensors):
+        pose = fk_pose_guess(robot_params, multisensor)
+        if pose is not None:
+            poses[k] = pose
+    opt_param_vec = array(robot_params.deflate()[numpy.where(free_list)[0]]).ravel()
+    selected = select_samples(sample_information(error_calc, numpy.concatenate([opt_param_vec, poses.ravel()])), budget)
+    return selected, poses
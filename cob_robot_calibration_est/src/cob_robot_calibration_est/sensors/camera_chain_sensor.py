@@ -42,26 +42,28 @@
 
 
 from numpy import matrix, reshape, array, zeros, real, float64, asarray, diag, ones
+import numpy
 
-import roslib
-roslib.load_manifest('cob_robot_calibration_est')
-import rospy
 from cob_robot_calibration_est.full_chain import FullChainRobotParams
 from cob_robot_calibration_est.sensors.chain_sensor import ChainBundler, ChainSensor
+from cob_robot_calibration_est.block_diagonal import inv_sqrt_blocks, scale_blocks, dense_blocks
+from cob_robot_calibration_est.intrinsics import get_intrinsics
+from cob_robot_calibration_est.measurement_store import image_point_array
+from cob_robot_calibration_est.profiling import timed
+from cob_robot_calibration_est.ros_support import logger
 #from cob_robot_calibration_est.ChainMessage import ChainMessage
-import yaml
-import cv
 #import code
-from copy import deepcopy
 
 
 class CameraChainBundler:
     """
     Tool used to generate a list of CameraChain sensors from a single calibration sample message
     """
-    def __init__(self, configs):
+    def __init__(self, configs, store=None):
         """
         Inputs:
+        - store: Optional MeasurementStore the measurements come from. The sensors then share
+                 the FullChainRobotParams of their configuration.
         - valid_configs: A list of dictionaries, where each list elem stores the configuration of a potential
                          camera chain that we might encounter.
           Example (in yaml format):
@@ -76,6 +78,7 @@ class CameraChainBundler:
         """
         self._configs = configs
         self._valid_configs = configs['camera_chains']
+        self._store = store
 
     # Construct a CameraChainSensor for every camera chain sensor that exists in the given robot measurement
     def build_blocks(self, M_robot):
@@ -96,16 +99,19 @@ class CameraChainBundler:
                 else:
                     print "else cur_config[chain][chain_id]: ", cur_config["chain"]["chain_id"]
                     break
+                full_chain = None
+                if self._store is not None:
+                    full_chain = self._store.full_chain(cur_config["chain"], self._configs)
                 cur_sensor = CameraChainSensor(
-                    cur_config, M_cam, M_chain, self._configs)
+                    cur_config, M_cam, M_chain, self._configs, full_chain)
                 sensors.append(cur_sensor)
             else:
-                rospy.logdebug("  Didn't find block")
+                logger.debug("  Didn't find block")
         return sensors
 
 
 class CameraChainSensor():
-    def __init__(self, config_dict, M_cam, M_chain, config):
+    def __init__(self, config_dict, M_cam, M_chain, config, full_chain=None):
         """
         Generates a single sensor block for a single configuration
         Inputs:
@@ -113,6 +119,7 @@ class CameraChainSensor():
                        a single element from the valid_configs list passed into CameraChainBundler.__init__
         - M_cam: The camera measurement of type calibration_msgs/CameraMeasurement
         - M_chain: The chain measurement of type calibration_msgs/ChainMeasurement
+        - full_chain: Optional FullChainRobotParams of config_dict["chain"], shared with other sensors
         """
 
         self.sensor_type = "camera"
@@ -123,19 +130,25 @@ class CameraChainSensor():
         self._M_cam = M_cam
         self._M_chain = M_chain
 
-        self._chain = FullChainRobotParams(config_dict["chain"], self._config)
+        if full_chain is None:
+            full_chain = FullChainRobotParams(config_dict["chain"], self._config)
+        self._chain = full_chain
         self.camera_info_name = None
 
         self.info_used = self.sensor_id in ['left', 'right', 'kinect_rgb']
-        path = rospy.get_param(
-            '/calibration_config/camera_parameter') + self.sensor_id + '.yaml'
-        with open(path) as f:
-            self._yaml = yaml.load(f)
-        self._distortion = self._yaml['distortion_coefficients']['data']
-        self._camera_matrix = self._yaml['camera_matrix']['data']
+        self.load_intrinsics()
 
         self.terms_per_sample = 2
 
+    def load_intrinsics(self):
+        """
+        Gets the camera matrix and distortion coefficients from the intrinsics registry and
+        undistorts the measured image points with them. As the measurement only depends on the
+        intrinsics, this has to be called again whenever they change (see intrinsics.set_intrinsics).
+        """
+        self._camera_matrix, self._distortion = get_intrinsics(self.sensor_id)
+        self._measurement = self.undistort_measurement()
+
     def update_config(self, robot_params):
         """
         On each optimization cycle the set of system parameters that we're optimizing over will change. Thus,
@@ -144,6 +157,7 @@ class CameraChainSensor():
         """
         self._camera = robot_params.rectified_cams[
             self._config_dict["camera_id"]]
+        self._param_length = robot_params.length
 
         if self._chain is not None:
             self._chain.update_config(robot_params)
@@ -156,7 +170,7 @@ class CameraChainSensor():
         Output:
         - r: 2N long vector, storing pixel residuals for the target points in the form [u1, v1, u2, v2, ..., uN, vN]
         """
-        z_mat = self.get_measurement()[:, 0, :]
+        z_mat = self.get_measurement()
         h_mat = self.compute_expected(target_pts)
         #code.interact(local=locals())
         assert(z_mat.shape[1] == 2)
@@ -165,62 +179,88 @@ class CameraChainSensor():
         r = array(reshape(h_mat - z_mat, [-1, 1]))[:, 0]
         return r
 
+    @timed('camera_chain_sensor.jacobian')
+    def compute_residual_jacobian(self, target_pts):
+        """
+        Computes the derivatives of the measurement residual for the current set of system parameters
+        and target points.
+        Input:
+        - target_pts: 4XN matrix, storing features point locations in world cartesian homogenous coordinates.
+        Output:
+        - J_params: 2NxL array, derivatives of the residual w.r.t. the full system parameter vector
+        - J_target: Nx2x3 array, derivatives of the residual of each point w.r.t. its world coordinates
+        """
+        # Camera pose in root frame
+        camera_pose_root, idx, dT = self._chain.calc_block.fk_jacobian(self._M_chain)
+        camera_pose_inv = numpy.linalg.inv(camera_pose_root)
+        cam_frame_pts = numpy.dot(camera_pose_inv, array(target_pts, float))
+        pixel_pts, J_cam, J_pts = self._camera.project_jacobian(self._camera_matrix, cam_frame_pts)
+
+        # d(T^-1 * X)/dp = -T^-1 * dT/dp * T^-1 * X
+        dcam_frame_pts = -numpy.einsum('ij,kjl,ln->kin', camera_pose_inv, dT, cam_frame_pts)[:, 0:3, :]
+        N = cam_frame_pts.shape[1]
+        J_chain = numpy.einsum('naj,kjn->nak', J_pts, dcam_frame_pts).reshape(2 * N, -1)
+
+        J_params = zeros([2 * N, self._param_length])
+        numpy.add.at(J_params, (slice(None), idx), J_chain)
+        J_params[:, self._camera.start:self._camera.end] += J_cam.reshape(2 * N, -1)
+
+        J_target = numpy.einsum('naj,ji->nai', J_pts, camera_pose_inv[0:3, 0:3])
+        return J_params, J_target
+
     def compute_residual_scaled(self, target_pts):
         """
         Computes the residual, and then scales it by sqrt(Gamma), where Gamma
         is the information matrix for this measurement (Cov^-1).
         """
         r = self.compute_residual(target_pts)
-        gamma_sqrt = self.compute_marginal_gamma_sqrt(target_pts)
-        r_scaled = gamma_sqrt * matrix(r).T
-        return array(r_scaled.T)[0]
+        return scale_blocks(self.compute_gamma_sqrt_blocks(target_pts), r)
 
     def compute_marginal_gamma_sqrt(self, target_pts):
         """
         Calculates the square root of the information matrix for the measurement of the
         current set of system parameters at the passed in set of target points.
         """
-        import scipy.linalg
-        cov = self.compute_cov(target_pts)
-        gamma = matrix(zeros(cov.shape))
-        num_pts = self.get_residual_length()/2
-
-        for k in range(num_pts):
-            #print "k=%u" % k
-            first = 2*k
-            last = 2*k+2
-            sub_cov = matrix(cov[first:last, first:last])
-            sub_gamma_sqrt_full = matrix(scipy.linalg.sqrtm(sub_cov.I))
-            sub_gamma_sqrt = real(sub_gamma_sqrt_full)
-            assert(scipy.linalg.norm(sub_gamma_sqrt_full - sub_gamma_sqrt) < 1e-6)
-            gamma[first:last, first:last] = sub_gamma_sqrt
-        return gamma
+        return dense_blocks(self.compute_gamma_sqrt_blocks(target_pts))
+
+    def compute_gamma_sqrt_blocks(self, target_pts):
+        """
+        Same as compute_marginal_gamma_sqrt, but only the 2x2 blocks of each point are returned
+        Returns: Nx2x2 array
+        """
+        return inv_sqrt_blocks(self.compute_cov_blocks(target_pts))
 
     def get_residual_length(self):
         N = len(self._M_cam.image_points)
         return N * 2
 
-    # Get the observed measurement in a Nx2 Matrix
+    # Get the observed measurement in a Nx2 array
     def get_measurement(self):
         """
-        Get the target's pixel coordinates as measured by the actual sensor
+        Get the target's pixel coordinates as measured by the actual sensor. These are the undistorted
+        image points, which are computed once in load_intrinsics.
         """
-        cm = cv.CreateMat(3, 3, cv.CV_32F)
-        cv.Set(cm, 0)
-        cm_t = reshape(matrix(self._camera_matrix, float64), (3, 3))[:3, :3]
-        for x in range(3):
-            for y in range(3):
-                cm[x, y] = cm_t[x, y]
-        dc = cv.CreateMat(5, 1, cv.CV_32F)
-        for i in range(len(self._distortion)):
-            dc[i, 0] = self._distortion[i]
+        return self._measurement
 
-        camera_pix = cv.fromarray(float64(
-            [[[pt.x, pt.y]] for pt in self._M_cam.image_points]))
-        dst = cv.CreateMat(camera_pix.rows, camera_pix.cols, camera_pix.type)
-        cv.UndistortPoints(camera_pix, dst, cm, dc, P=cm)
+    def undistort_measurement(self):
+        """
+        Undistorts the measured image points with the current intrinsics. OpenCV is only
+        needed if the camera has distortion.
+        Returns: Nx2 array of undistorted pixel coordinates
+        """
+        camera_pix = numpy.array(image_point_array(self._M_cam.image_points), float64).reshape(-1, 1, 2)
+        if camera_pix.shape[0] == 0:
+            return zeros([0, 2])
+        if not self._distortion.any():
+            dst = camera_pix
+        else:
+            import cv2
+            cm = self._camera_matrix
+            dst = cv2.undistortPoints(camera_pix, cm, self._distortion, P=cm)
 
-        return asarray(dst)
+        measurement = numpy.ascontiguousarray(dst.reshape(-1, 2), float64)
+        measurement.flags.writeable = False
+        return measurement
 
     def compute_expected(self, target_pts):
         """
@@ -286,15 +326,8 @@ class CameraChainSensor():
         '''
         #chain cov
         chain_cov = self.compute_chain_cov(target_pts)
-        cam_cov = matrix(
-            zeros([self.get_residual_length(), self.get_residual_length()]))
-
-        # Convert StdDev into variance
-        var_u = self._camera._cov_dict['u'] * self._camera._cov_dict['u']
-        var_v = self._camera._cov_dict['v'] * self._camera._cov_dict['v']
-        for k in range(cam_cov.shape[0] / 2):
-            cam_cov[2 * k, 2 * k] = var_u
-            cam_cov[2 * k + 1, 2 * k + 1] = var_v
+        var_u, var_v = self.camera_variances()
+        cam_cov = matrix(diag([var_u, var_v] * (self.get_residual_length() / 2)))
 
         # Both chain and camera covariances are now in measurement space, so we can simply add them together
         if self._M_chain is not None:
@@ -302,45 +335,50 @@ class CameraChainSensor():
         else:
             cov = cam_cov
         return cov
-    def compute_chain_cov(self, target_pts):
-
-        _ones = ones([7, self.get_residual_length()])
-        cov = matrix(diag([0.01] * self.get_residual_length()))
 
-        epsilon = 1e-8
+    def compute_cov_blocks(self, target_pts):
+        '''
+        Computes only the 2x2 blocks on the diagonal of compute_cov, which are the
+        covariances of the single points
+        Returns: Nx2x2 array
+        '''
+        return camera_cov_blocks([self], [target_pts])[0]
 
+    def camera_variances(self):
+        '''
+        Variances (var_u, var_v) of the pixel measurements
+        '''
+        # Convert StdDev into variance
+        var_u = self._camera._cov_dict['u'] * self._camera._cov_dict['u']
+        var_v = self._camera._cov_dict['v'] * self._camera._cov_dict['v']
+        return var_u, var_v
 
+    def joint_variances(self):
+        '''
+        Variances of all the joint angles of the chains, in the order of compute_joint_jacobian
+        '''
+        cov_angles = []
+        for c in self._chain.calc_block._chains:
+            cov_angles.extend([ x * x for x in c._chain._cov_dict])
+        return array(cov_angles)
 
+    def compute_chain_cov(self, target_pts):
         chain_cov = None
         if self._M_chain is not None:
-            i_joints = []
-            num_joints = 0
-            for i,c in enumerate(self._M_chain):
-                l = len(c.actual.positions)
-                i_joints.extend([i] * l)
-                num_joints+=l
-
-            #num_joints = sum(num_joints)
-            #num_joints = len(self._M_chain.actual.position)
-            Jt = zeros([num_joints, self.get_residual_length()])
-
-            x = deepcopy(self._M_chain)
-            # Compute the Jacobian from the chain's joint angles to pixel residuals
-            f0 = reshape(array(self._compute_expected(target_pts, x)), [-1])
-            for i in range(num_joints):
-                x[i_joints[i]].header.frame_id = self._M_chain[i_joints[i]].header.frame_id
-                x[i_joints[i]].actual.positions = list(self._M_chain[i_joints[i]].actual.positions[:])
-                x[i_joints[i]].actual.positions[i] += epsilon
-                fTest = reshape(array(self._compute_expected(target_pts, x)), [-1])
-                Jt[i] = (fTest - f0)/epsilon
-            cov_angles = []
-
-            for c in self._chain.calc_block._chains:
-                cov_angles.extend([ x * x for x in c._chain._cov_dict])
+            Jt = self.compute_joint_jacobian(target_pts)
 
             # Transform the chain's covariance from joint angle space into pixel space using the just calculated jacobian
-            chain_cov = matrix(Jt).T * matrix(diag(cov_angles)) * matrix(Jt)
+            chain_cov = matrix(Jt).T * matrix(diag(self.joint_variances())) * matrix(Jt)
         return chain_cov
+
+    def compute_joint_jacobian(self, target_pts):
+        '''
+        Computes the Jacobian from the chain's joint angles to pixel residuals
+        Returns: (num_joints)x2N array
+        '''
+        J = camera_joint_jacobians([self], [target_pts])[0]
+        return J.reshape(-1, J.shape[2]).T
+
     def build_sparsity_dict(self):
         """
         Build a dictionary that defines which parameters will in fact affect this measurement.
@@ -387,3 +425,79 @@ class CameraChainSensor():
             [(x, 1) for x in self._camera.get_param_names()])
 
         return sparsity
+
+
+@timed('camera_chain_sensor.residuals')
+def camera_residuals(sensors, target_pts_list):
+    """
+    Computes the residuals of many camera sensors at once. The sensors are grouped by camera
+    and point count, and the points of every group are projected with one batched call
+    (see RectifiedCamera.project_batch).
+    Inputs:
+    - sensors: List of CameraChainSensors
+    - target_pts_list: 4xN matrix of the target points of every sensor
+    Returns: List with the residual of every sensor, same as compute_residual
+    """
+    groups = {}
+    for k, (sensor, target_pts) in enumerate(zip(sensors, target_pts_list)):
+        key = (id(sensor._camera), id(sensor._camera_matrix), target_pts.shape[1])
+        groups.setdefault(key, []).append(k)
+
+    r_list = [None] * len(sensors)
+    for ks in groups.values():
+        camera_poses = array([sensors[k]._chain.calc_block.fk(sensors[k]._M_chain) for k in ks], float)
+        target_pts = array([target_pts_list[k] for k in ks], float)
+        cam_frame_pts = numpy.einsum('mij,mjn->min', numpy.linalg.inv(camera_poses), target_pts)
+        pixel_pts = sensors[ks[0]]._camera.project_batch(sensors[ks[0]]._camera_matrix, cam_frame_pts)
+        z = array([sensors[k].get_measurement() for k in ks], float).reshape(len(ks), -1, 2)
+        r = (pixel_pts.transpose(0, 2, 1) - z).reshape(len(ks), -1)
+        for k, r_k in zip(ks, r):
+            r_list[k] = r_k
+    return r_list
+
+
+def camera_joint_jacobians(sensors, target_pts_list):
+    """
+    Computes the derivatives of the expected pixel coordinates of camera sensors w.r.t. the joint
+    angles of their chains, from the derivatives of the fk frames. All sensors need the same camera,
+    number of target points and number of joints.
+    Returns: MxNx2xK array, the derivatives of the N points of every sensor w.r.t. its K joints
+    """
+    fk = [sensor._chain.calc_block.fk_joint_jacobian(sensor._M_chain) for sensor in sensors]
+    camera_poses_inv = numpy.linalg.inv(array([T for T, dT in fk], float))
+    dT = array([dT for T, dT in fk], float)
+    target_pts = array([target_pts_list[k] for k in range(len(sensors))], float)
+    cam_frame_pts = numpy.einsum('mij,mjn->min', camera_poses_inv, target_pts)
+    pixel_pts, J_cam, J_pts = sensors[0]._camera.project_batch_jacobian(sensors[0]._camera_matrix, cam_frame_pts)
+
+    # d(T^-1 * X)/dq = -T^-1 * dT/dq * T^-1 * X
+    dcam_frame_pts = -numpy.einsum('mij,mkjl,mln->mkin', camera_poses_inv[:, 0:3, :], dT, cam_frame_pts)
+    return numpy.einsum('mnaj,mkjn->mnak', J_pts, dcam_frame_pts)
+
+
+@timed('camera_chain_sensor.cov')
+def camera_cov_blocks(sensors, target_pts_list):
+    """
+    Same as calling compute_cov_blocks of every camera sensor, but the chain covariances are
+    propagated in batches of sensors with the same camera, number of target points and joints
+    Returns: List with the Nx2x2 covariance blocks of every sensor
+    """
+    groups = {}
+    for k, (sensor, target_pts) in enumerate(zip(sensors, target_pts_list)):
+        num_joints = len(sensor.joint_variances()) if sensor._M_chain is not None else 0
+        key = (id(sensor._camera), id(sensor._camera_matrix), target_pts.shape[1], num_joints)
+        groups.setdefault(key, []).append(k)
+
+    cov_list = [None] * len(sensors)
+    for (camera, camera_matrix, num_pts, num_joints), ks in groups.items():
+        group = [sensors[k] for k in ks]
+        cov = zeros([len(ks), num_pts, 2, 2])
+        for m, sensor in enumerate(group):
+            cov[m, :, 0, 0], cov[m, :, 1, 1] = sensor.camera_variances()
+        if num_joints > 0:
+            J = camera_joint_jacobians(group, [target_pts_list[k] for k in ks])
+            variances = array([sensor.joint_variances() for sensor in group], float)
+            cov += numpy.einsum('mnak,mk,mnbk->mnab', J, variances, J)
+        for k, cov_k in zip(ks, cov):
+            cov_list[k] = cov_k
+    return cov_list
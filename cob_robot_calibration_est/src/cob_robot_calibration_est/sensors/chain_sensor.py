@@ -43,20 +43,20 @@
 #       before_chain_Ts -- target_chain -- after_chain_Ts -- checkerboard
 
 from numpy import reshape, array, zeros, diag, matrix, real, ones
-import roslib
-roslib.load_manifest('cob_robot_calibration_est')
-import rospy
+import numpy
 from cob_robot_calibration_est.full_chain import FullChainRobotParams
+from cob_robot_calibration_est.block_diagonal import inv_sqrt_blocks, scale_blocks, dense_blocks
+from cob_robot_calibration_est.profiling import timed
+from cob_robot_calibration_est.ros_support import logger
 #from cob_robot_calibration_est.ChainMessage import ChainMessage
-from control_msgs.msg import JointTrajectoryControllerState
-from copy import deepcopy
 #import code
 
 
 class ChainBundler:
-    def __init__(self, configs):
+    def __init__(self, configs, store=None):
         self._configs = configs
         self._valid_configs = configs['sensor_chains']
+        self._store = store
 
     # Construct a CameraChainRobotParamsBlock for every 'valid config' that finds everything it needs in the current robot measurement
     def build_blocks(self, M_robot):
@@ -66,20 +66,23 @@ class ChainBundler:
             cur_chain_id = cur_config["sensor_id"]
             if cur_chain_id == M_robot.chain_id and \
                     all([chain in [x.header.frame_id for x in M_robot.M_chain] for chain in cur_config['chains']]):
-                rospy.logdebug("  Found block")
+                logger.debug("  Found block")
                 #M_chain = M_robot.M_chain
                 M_chain = [c for c in M_robot.M_chain if c.header.frame_id in cur_config['chains']]
 
+                full_chain = None
+                if self._store is not None:
+                    full_chain = self._store.full_chain(cur_config, self._configs)
                 cur_sensor = ChainSensor(
-                    cur_config, M_chain, M_robot.target_id, self._configs)
+                    cur_config, M_chain, M_robot.target_id, self._configs, full_chain)
                 sensors.append(cur_sensor)
             else:
-                rospy.logdebug("  Didn't find block")
+                logger.debug("  Didn't find block")
         return sensors
 
 
 class ChainSensor:
-    def __init__(self, config_dict, M_chain, target_id, config):
+    def __init__(self, config_dict, M_chain, target_id, config, full_chain=None):
 
 
         self.sensor_type = "chain"
@@ -90,8 +93,10 @@ class ChainSensor:
         self._M_chain = M_chain
         self._target_id = target_id
 
-        self._full_chain = FullChainRobotParams(
-            self._config_dict, self._config)
+        # The full chain only depends on the configuration, so it can be shared between sensors
+        if full_chain is None:
+            full_chain = FullChainRobotParams(self._config_dict, self._config)
+        self._full_chain = full_chain
 
         self.terms_per_sample = 3
 
@@ -99,6 +104,7 @@ class ChainSensor:
     def update_config(self, robot_params):
         self._full_chain.update_config(robot_params)
         self._checkerboard = robot_params.checkerboards[self._target_id]
+        self._param_length = robot_params.length
 
     def compute_residual(self, target_pts):
         h_mat = self.compute_expected(target_pts)
@@ -109,38 +115,53 @@ class ChainSensor:
         r = array(reshape(r_mat.T, [-1, 1]))[:, 0]
         return r
 
+    @timed('chain_sensor.jacobian')
+    def compute_residual_jacobian(self, target_pts):
+        """
+        Computes the derivatives of the measurement residual for the current set of system parameters
+        and target points.
+        Input:
+        - target_pts: 4XN matrix, storing features point locations in world cartesian homogenous coordinates.
+        Output:
+        - J_params: 3NxL array, derivatives of the residual w.r.t. the full system parameter vector
+        - J_target: Nx3x3 array, derivatives of the residual of each point w.r.t. its world coordinates
+        """
+        target_pose_root, idx, dT = self._full_chain.calc_block.fk_jacobian(self._M_chain)
+        target_pts_tip = array(self._checkerboard.generate_points())
+        N = target_pts_tip.shape[1]
+
+        # The residual is target_pts - T * target_pts_tip, so all derivatives of the fk points get negated
+        J_chain = -numpy.einsum('kij,jn->nik', dT[:, 0:3, :], target_pts_tip)
+        J_cb = -numpy.einsum('ij,kjn->nik', target_pose_root[0:3, :], self._checkerboard.generate_points_jacobian())
+
+        J_params = zeros([3 * N, self._param_length])
+        numpy.add.at(J_params, (slice(None), idx), J_chain.reshape(3 * N, -1))
+        J_params[:, self._checkerboard.start:self._checkerboard.end] += J_cb.reshape(3 * N, -1)
+
+        J_target = numpy.tile(numpy.eye(3), (N, 1, 1))
+        return J_params, J_target
+
     def compute_residual_scaled(self, target_pts):
         """
         Computes the residual, and then scales it by sqrt(Gamma), where Gamma
         is the information matrix for this measurement (Cov^-1).
         """
         r = self.compute_residual(target_pts)
-        gamma_sqrt = self.compute_marginal_gamma_sqrt(target_pts)
-        r_scaled = gamma_sqrt * matrix(r).T
-        return array(r_scaled.T)[0]
+        return scale_blocks(self.compute_gamma_sqrt_blocks(target_pts), r)
 
     def compute_marginal_gamma_sqrt(self, target_pts):
         """
         Calculates the square root of the information matrix for the measurement of the
         current set of system parameters at the passed in set of target points.
         """
-        import scipy.linalg
-        # ----- Populate Here -----
-        cov = self.compute_cov(target_pts)
-        gamma = matrix(zeros(cov.shape))
-        num_pts = self.get_residual_length() / self.terms_per_sample
-        #code.interact(local=locals())
-        for k in range(num_pts):
-            #print "k=%u" % k
-            first = self.terms_per_sample * k
-            last = self.terms_per_sample * k + self.terms_per_sample
-            sub_cov = matrix(cov[first:last, first:last])
-            sub_gamma_sqrt_full = matrix(scipy.linalg.sqrtm(sub_cov.I))
-            sub_gamma_sqrt = real(sub_gamma_sqrt_full)
-            assert(scipy.linalg.norm(
-                sub_gamma_sqrt_full - sub_gamma_sqrt) < 1e-6)
-            gamma[first:last, first:last] = sub_gamma_sqrt
-        return gamma
+        return dense_blocks(self.compute_gamma_sqrt_blocks(target_pts))
+
+    def compute_gamma_sqrt_blocks(self, target_pts):
+        """
+        Same as compute_marginal_gamma_sqrt, but only the blocks of each point are returned
+        Returns: Nx3x3 array
+        """
+        return inv_sqrt_blocks(self.compute_cov_blocks(target_pts))
 
     def compute_cov(self, target_pts):
         '''
@@ -149,41 +170,38 @@ class ChainSensor:
         Input:
          - target_pts: 4xN matrix, storing N feature points of the target, in homogeneous coords
         '''
-        _ones = ones([7, self.get_residual_length()])
-        cov = matrix(diag([0.01] * self.get_residual_length()))
-
-        epsilon = 1e-8
-
-        i_joints = []
-        num_joints = 0
-        for i,c in enumerate(self._M_chain):
-            l = len(c.actual.positions)
-            i_joints.extend([i] * l)
-            num_joints+=l
-
-        #num_joints = sum(num_joints)
-        #num_joints = len(self._M_chain.actual.position)
-        Jt = zeros([num_joints, self.get_residual_length()])
-
-        x = deepcopy(self._M_chain)
-        #x.actual.position = self._M_chain.actual.position[:]
-
-        f0 = reshape(array(self._calc_fk_target_pts(x)[0:3, :].T), [-1])
-        for i in range(num_joints):
-            x[i_joints[i]].header.frame_id = self._M_chain[i_joints[i]].header.frame_id
-            x[i_joints[i]].actual.positions = list(self._M_chain[i_joints[i]].actual.positions[:])
-            x[i_joints[i]].actual.positions[i] += epsilon
-            fTest = reshape(array(self._calc_fk_target_pts(x)[0:3, :].T), [-1])
-            Jt[i] = (fTest - f0) / epsilon
-        cov_angles = []
-        for c in self._full_chain.calc_block._chains:
-            cov_angles.extend([ x * x for x in c._chain._cov_dict])
+        Jt = self.compute_joint_jacobian(target_pts)
 
         #cov_angles = [x * x for x in self._full_chain.calc_block._chain._cov_dict['joint_angles']]
         #import code; code.interact(local=locals())
-        cov = matrix(Jt).T * matrix(diag(cov_angles)) * matrix(Jt)
+        cov = matrix(Jt).T * matrix(diag(self.joint_variances())) * matrix(Jt)
         return cov
 
+    def compute_cov_blocks(self, target_pts):
+        '''
+        Computes only the 3x3 blocks on the diagonal of compute_cov, which are the
+        covariances of the single points
+        Returns: Nx3x3 array
+        '''
+        return chain_cov_blocks([self])[0]
+
+    def joint_variances(self):
+        '''
+        Variances of all the joint angles of the chains, in the order of compute_joint_jacobian
+        '''
+        cov_angles = []
+        for c in self._full_chain.calc_block._chains:
+            cov_angles.extend([ x * x for x in c._chain._cov_dict])
+        return array(cov_angles)
+
+    def compute_joint_jacobian(self, target_pts):
+        '''
+        Computes the Jacobian from the chain's joint angles to the target points
+        Returns: (num_joints)x3N array
+        '''
+        J = chain_joint_jacobians([self])[0]
+        return J.reshape(-1, J.shape[2]).T
+
     def get_residual_length(self):
         pts = self._checkerboard.generate_points()
         N = pts.shape[1]
@@ -196,6 +214,13 @@ class ChainSensor:
         '''
         return self._calc_fk_target_pts()
 
+    def compute_target_pose(self):
+        '''
+        Returns the 4x4 pose of the target in the root frame, as per the forward kinematics of the chain.
+        Can be used as initial guess of the checkerboard pose of a sample.
+        '''
+        return self._full_chain.calc_block.fk(self._M_chain)
+
     def _calc_fk_target_pts(self, M_chain=None):
         #code.interact(local=locals())
         M_chain = self._M_chain if M_chain is None else M_chain
@@ -260,3 +285,38 @@ class ChainSensor:
                                                       'spacing_y': 1}
 
         return sparsity
+
+
+def chain_joint_jacobians(sensors):
+    """
+    Computes the derivatives of the fk target points of chain sensors w.r.t. their joint angles,
+    from the derivatives of the fk frames. All sensors need the same number of target points
+    and joints.
+    Returns: MxNx3xK array, the derivatives of the N points of every sensor w.r.t. its K joints
+    """
+    dT = array([sensor._full_chain.calc_block.fk_joint_jacobian(sensor._M_chain)[1] for sensor in sensors], float)
+    target_pts_tip = array([sensor._checkerboard.generate_points() for sensor in sensors], float)
+    return numpy.einsum('mkij,mjn->mnik', dT[:, :, 0:3, :], target_pts_tip)
+
+
+@timed('chain_sensor.cov')
+def chain_cov_blocks(sensors):
+    """
+    Same as calling compute_cov_blocks of every chain sensor, but batched over all sensors with
+    the same number of target points and joints
+    Returns: List with the Nx3x3 covariance blocks of every sensor
+    """
+    groups = {}
+    for k, sensor in enumerate(sensors):
+        key = (sensor.get_residual_length(), len(sensor.joint_variances()))
+        groups.setdefault(key, []).append(k)
+
+    cov_list = [None] * len(sensors)
+    for ks in groups.values():
+        group = [sensors[k] for k in ks]
+        J = chain_joint_jacobians(group)
+        variances = array([sensor.joint_variances() for sensor in group], float)
+        cov = numpy.einsum('mnak,mk,mnbk->mnab', J, variances, J)
+        for k, cov_k in zip(ks, cov):
+            cov_list[k] = cov_k
+    return cov_list
@@ -33,6 +33,8 @@
 # author: Vijay Pradeep
 
 from cob_robot_calibration_est.sensors import chain_sensor, camera_chain_sensor
+from cob_robot_calibration_est.block_diagonal import scale_blocks, inv_sqrt_blocks
+from cob_robot_calibration_est.profiling import timed
 from numpy import concatenate
 from numpy import zeros, cumsum, matrix, array
 
@@ -57,10 +59,12 @@ def block_diag(m_list):
 class MultiSensor:
     '''
     Provides helper methods for dealing with all the sensor measurements
-    generated from a single RobotMeasurement/CbPose pair
+    generated from a single RobotMeasurement/CbPose pair. If the measurements come from a
+    MeasurementStore, pass it as store, so that the sensors share their chain definitions.
     '''
-    def __init__(self, sensor_configs):
+    def __init__(self, sensor_configs, store=None):
         self._sensor_configs = sensor_configs
+        self._store = store
         self.sensors = []
         self.checkerboard = "NONE"
         #print "in MultiSensor"
@@ -80,7 +84,7 @@ class MultiSensor:
         sensor_type = 'sensor_chains'
         if sensor_type in self._sensor_configs.keys():
             cur_bundler = chain_sensor.ChainBundler(
-                self._sensor_configs)
+                self._sensor_configs, self._store)
             cur_sensors = cur_bundler.build_blocks(msg)
             sensors.extend(cur_sensors)
         else:
@@ -89,7 +93,7 @@ class MultiSensor:
         sensor_type = 'camera_chains'
         if sensor_type in self._sensor_configs.keys():
             cur_bundler = camera_chain_sensor.CameraChainBundler(
-                self._sensor_configs)
+                self._sensor_configs, self._store)
             cur_sensors = cur_bundler.build_blocks(msg)
             sensors.extend(cur_sensors)
         else:
@@ -99,12 +103,24 @@ class MultiSensor:
         self.sensors = sensors
         self.checkerboard = msg.target_id
 
+    @timed('update_config')
     def update_config(self, robot_params):
         #import code
         #code.interact(local=locals())
         for sensor in self.sensors:
             sensor.update_config(robot_params)
 
+    def chain_states(self):
+        '''
+        Returns the chain measurements used by the sensors, without duplicates
+        '''
+        states = []
+        for sensor in self.sensors:
+            for state in sensor._M_chain or []:
+                if not any(state is s for s in states):
+                    states.append(state)
+        return states
+
     def compute_residual(self, target_pts):
         r_list = [sensor.compute_residual(target_pts)
                   for sensor in self.sensors]
@@ -133,5 +149,86 @@ class MultiSensor:
         gamma_sqrt = block_diag(gamma_sqrt_list)
         return gamma_sqrt
 
+    def compute_gamma_sqrt_blocks(self, target_pts):
+        '''
+        Returns a list with the blocks of the square root of the information matrix of every
+        sensor (see compute_gamma_sqrt_blocks of the sensors)
+        '''
+        return [sensor.compute_gamma_sqrt_blocks(target_pts) for sensor in self.sensors]
+
+    def scale_by_gamma_sqrt(self, gamma_sqrt_blocks, m):
+        '''
+        Multiplies a vector or matrix, whose rows correspond to the residual of this multisensor,
+        by the square root of the information matrix given as list of blocks (see compute_gamma_sqrt_blocks)
+        '''
+        scaled = []
+        first = 0
+        for blocks in gamma_sqrt_blocks:
+            last = first + blocks.shape[0] * blocks.shape[1]
+            scaled.append(scale_blocks(blocks, m[first:last]))
+            first = last
+        if len(scaled) == 0:
+            return array(m)
+        return concatenate(scaled, 0)
+
     def get_residual_length(self):
         return sum([sensor.get_residual_length() for sensor in self.sensors])
+
+
+@timed('multi_sensor.residuals')
+def compute_residuals(multisensors, target_pts_list):
+    '''
+    Same as calling compute_residual of every multisensor with its target points, but the
+    residuals of all camera sensors are computed in one go (see camera_chain_sensor.camera_residuals)
+    '''
+    cameras = [(sensor, target_pts) for multisensor, target_pts in zip(multisensors, target_pts_list)
+               for sensor in multisensor.sensors if isinstance(sensor, camera_chain_sensor.CameraChainSensor)]
+    camera_r = {}
+    if len(cameras) > 0:
+        sensors, camera_pts = zip(*cameras)
+        camera_r = dict(zip([id(s) for s in sensors], camera_chain_sensor.camera_residuals(sensors, camera_pts)))
+
+    r_list = []
+    for multisensor, target_pts in zip(multisensors, target_pts_list):
+        r = [camera_r[id(sensor)] if id(sensor) in camera_r else sensor.compute_residual(target_pts)
+             for sensor in multisensor.sensors]
+        r_list.append(concatenate(r, 0) if len(r) > 0 else array([]))
+    return r_list
+
+
+@timed('multi_sensor.gamma_sqrt')
+def compute_gamma_sqrt_list(multisensors, target_pts_list):
+    '''
+    Same as calling compute_gamma_sqrt_blocks of every multisensor with its target points, but the
+    covariances of all camera and chain sensors are computed in batches (see camera_chain_sensor.camera_cov_blocks
+    and chain_sensor.chain_cov_blocks) and inverted at once
+    '''
+    cameras = []
+    chains = []
+    for multisensor, target_pts in zip(multisensors, target_pts_list):
+        for sensor in multisensor.sensors:
+            if isinstance(sensor, camera_chain_sensor.CameraChainSensor):
+                cameras.append((sensor, target_pts))
+            elif isinstance(sensor, chain_sensor.ChainSensor):
+                chains.append(sensor)
+    cov_blocks = {}
+    if len(cameras) > 0:
+        sensors, camera_pts = zip(*cameras)
+        cov_blocks.update(zip([id(s) for s in sensors], camera_chain_sensor.camera_cov_blocks(sensors, camera_pts)))
+    if len(chains) > 0:
+        cov_blocks.update(zip([id(s) for s in chains], chain_sensor.chain_cov_blocks(chains)))
+
+    # Invert all blocks of the same size in one go
+    gamma_sqrt_blocks = {}
+    for size in set(blocks.shape[1] for blocks in cov_blocks.values()):
+        keys = [key for key, blocks in cov_blocks.items() if blocks.shape[1] == size]
+        gamma_sqrt = inv_sqrt_blocks(concatenate([cov_blocks[key] for key in keys], 0).reshape(-1, size, size))
+        first = 0
+        for key in keys:
+            last = first + cov_blocks[key].shape[0]
+            gamma_sqrt_blocks[key] = gamma_sqrt[first:last]
+            first = last
+
+    return [[gamma_sqrt_blocks[id(sensor)] if id(sensor) in gamma_sqrt_blocks else sensor.compute_gamma_sqrt_blocks(target_pts)
+             for sensor in multisensor.sensors]
+            for multisensor, target_pts in zip(multisensors, target_pts_list)]
@@ -32,8 +32,7 @@
 
 import numpy
 from numpy import matrix, vsplit, sin, cos, reshape, zeros, pi, isnan, isinf, array, arctan
-import rospy
-import tf.transformations
+from cob_robot_calibration_est.ros_support import logger
 
 class SingleTransform:
     def __init__(self, config = zeros((6,1))):
@@ -44,9 +43,9 @@ class SingleTransform:
         self._config = array(reshape(matrix(eval_config, float), (-1,1)))
 
         try:
-            rospy.logdebug("Initializing single transform with params [%s]", ", ".join(["% 2.4f" % x[0] for x in eval_config]))
+            logger.debug("Initializing single transform with params [%s]", ", ".join(["% 2.4f" % x[0] for x in eval_config]))
         except:
-            rospy.logdebug("Initializing single transform with params [%s]", ", ".join(["% 2.4f" % x for x in eval_config]))
+            logger.debug("Initializing single transform with params [%s]", ", ".join(["% 2.4f" % x for x in eval_config]))
         self.inflate(self._config)
 
     def calc_free(self, free_config):
@@ -61,6 +60,7 @@ class SingleTransform:
     # Convert column vector of params into config/home/fmw-ja/.ros/test_results/cob_robot_calibration_est/TEST-test_SingleTransform.xml
     def inflate_rpy(self, p, ret=False):
         assert(p.size == 6)
+        import tf.transformations
         T=tf.transformations.compose_matrix(angles=[p[3,0],p[4,0],p[5,0]],translate=[p[0,0],p[1,0],p[2,0]])
 
         self.transform = T
@@ -80,6 +80,8 @@ class SingleTransform:
         T = matrix( zeros((4,4), float ))
 
 
+        import tf.transformations
+
         # Renormalize the rotation axis to be unit length
         a = tf.transformations.unit_vector(p[3:6])
         rot_angle= tf.transformations.vector_norm(p[3:6])
@@ -98,44 +100,27 @@ class SingleTransform:
         if ret:
             return T
     def inflate(self,p, ret=False):
-
         '''
-        complex calculation of 4x4 homogeneus transformation matrix by Willow Garage Inc.
-        for simplification with use of tf see inflate(self,p)
+        Builds the 4x4 homogeneus transformation matrix from the params [x, y, z, rx, ry, rz],
+        where [rx, ry, rz] is the rotation axis scaled by the rotation angle (see pose_transforms)
         '''
-        p = array(p)
-        p=reshape(matrix([eval(str(x))for x in p],float),(-1,1))
-
-
-
-        # Init output matrix
-        T = matrix( zeros((4,4), float ))
-        T[3,3] = 1.0
-
-        # Copy position into matrix
-        T[0:3,3] = p[0:3]
-
-        # Renormalize the rotation axis to be unit length
-        U,S,Vt = numpy.linalg.svd(p[3:6])
-        a = U[:,0]
-        rot_angle= S[0]*Vt[0,0]
-
-
-        # Built rotation matrix
-        c = cos(rot_angle) ;
-        s = sin(rot_angle) ;
-
-        R = matrix( [ [   a[0,0]**2+(1-a[0,0]**2)*c, a[0,0]*a[1,0]*(1-c)-a[2,0]*s, a[0,0]*a[2,0]*(1-c)+a[1,0]*s],
-                      [a[0,0]*a[1,0]*(1-c)+a[2,0]*s,    a[1,0]**2+(1-a[1,0]**2)*c, a[1,0]*a[2,0]*(1-c)-a[0,0]*s],
-                      [a[0,0]*a[2,0]*(1-c)-a[1,0]*s, a[1,0]*a[2,0]*(1-c)+a[0,0]*s,    a[2,0]**2+(1-a[2,0]**2)*c] ] )
-
-        T[0:3,0:3] = R ;
+        p = array(p, float).reshape(-1)
+        T = matrix(pose_transforms(p.reshape(1,6))[0])
         self.transform = T
+        self._params = p
         if ret:
             return T
 
+    def jacobian(self):
+        '''
+        Derivative of the current transform w.r.t. the 6 parameters [x, y, z, rx, ry, rz]
+        Returns: 6x4x4 array, where element k is d(transform)/d(param k)
+        '''
+        return pose_jacobian(self._params)
+
     # Take transform, and convert into 6 param vector
     def deflate_rpy(self):
+        import tf.transformations
         scale,shear,angles,transl,persp=tf.transformations.decompose_matrix(self.transform)
         config=list(transl)+list(angles)
         c=[[v] for v in config]
@@ -146,11 +131,122 @@ class SingleTransform:
         if isnan(self.transform).any() or isinf(self.transform).any():
             v = [0,0,0]
         else:
-            angle, direction, point = tf.transformations.rotation_from_matrix(self.transform)
-            v = angle * direction
+            v = rotation_vectors(array(T)[0:3,0:3].reshape(1,3,3))[0]
         return matrix([T[0,3],T[1,3],T[2,3], v[0], v[1], v[2]]).T
 
     # Returns # of params needed for inflation & deflation
     def get_length(self):
         return 6
 
+    # Returns the names of the params, in the same order as deflate
+    def get_param_names(self):
+        return ['x', 'y', 'z', 'rx', 'ry', 'rz']
+
+
+
+def skew(v):
+    '''
+    3x3 cross product matrix of the vector v
+    '''
+    return array([[    0, -v[2],  v[1]],
+                  [ v[2],     0, -v[0]],
+                  [-v[1],  v[0],     0]], float)
+
+def rotation_matrices(r):
+    '''
+    Rotation matrices of an Mx3 array of rotation vectors (Rodrigues' formula)
+    Returns: Mx3x3 array
+    '''
+    r = array(r, float).reshape(-1,3)
+    theta_sq = (r ** 2).sum(1)
+    theta = numpy.sqrt(theta_sq)
+    # sin(theta)/theta and (1-cos(theta))/theta^2, with their series expansions for small angles
+    small = theta < 1e-6
+    safe_theta = numpy.where(small, 1.0, theta)
+    a = numpy.where(small, 1.0 - theta_sq / 6.0, sin(safe_theta) / safe_theta)
+    b = numpy.where(small, 0.5 - theta_sq / 24.0, (1.0 - cos(safe_theta)) / safe_theta ** 2)
+
+    K = zeros((len(r),3,3))
+    K[:,0,1] = -r[:,2]
+    K[:,0,2] =  r[:,1]
+    K[:,1,0] =  r[:,2]
+    K[:,1,2] = -r[:,0]
+    K[:,2,0] = -r[:,1]
+    K[:,2,1] =  r[:,0]
+    return numpy.eye(3) + a[:,None,None] * K + b[:,None,None] * numpy.einsum('mij,mjk->mik', K, K)
+
+def rotation_vectors(R):
+    '''
+    Rotation vectors of an Mx3x3 array of rotation matrices, the inverse of rotation_matrices.
+    The rotation angles are in [0, pi].
+    Returns: Mx3 array
+    '''
+    R = array(R, float).reshape(-1,3,3)
+    # w = sin(theta) * axis
+    w = 0.5 * numpy.array([R[:,2,1] - R[:,1,2], R[:,0,2] - R[:,2,0], R[:,1,0] - R[:,0,1]]).T
+    sin_theta = numpy.sqrt((w ** 2).sum(1))
+    cos_theta = 0.5 * (numpy.trace(R, axis1=1, axis2=2) - 1.0)
+    theta = numpy.arctan2(sin_theta, cos_theta)
+
+    r = numpy.empty((len(R),3))
+    for m in range(len(R)):
+        if sin_theta[m] > 1e-6:
+            r[m] = theta[m] / sin_theta[m] * w[m]
+        elif cos_theta[m] > 0:
+            r[m] = w[m]
+        else:
+            # Close to pi the axis is read from R + I = 2 * axis * axis^T (up to O(sin(theta)))
+            S = R[m] + numpy.eye(3)
+            col = S[:, numpy.argmax((S ** 2).sum(0))]
+            axis = col / numpy.linalg.norm(col)
+            if numpy.dot(axis, w[m]) < 0:
+                axis = -axis
+            r[m] = theta[m] * axis
+    return r
+
+def pose_transforms(poses):
+    '''
+    4x4 homogeneus transformation matrices of an Mx6 array of poses [x, y, z, rx, ry, rz],
+    where [rx, ry, rz] is the rotation axis scaled by the rotation angle
+    Returns: Mx4x4 array
+    '''
+    poses = array(poses, float).reshape(-1,6)
+    T = zeros((len(poses),4,4))
+    T[:,0:3,0:3] = rotation_matrices(poses[:,3:6])
+    T[:,0:3,3] = poses[:,0:3]
+    T[:,3,3] = 1.0
+    return T
+
+def rotation_vector_jacobian(r, R):
+    '''
+    Derivative of the rotation matrix R = exp(skew(r)) w.r.t. the rotation vector r
+    (Gallego and Yezzi, "A compact formula for the derivative of a 3-D rotation in
+    exponential coordinates").
+    Returns: 3x3x3 array, where element i is dR/dr_i
+    '''
+    r = array(r, float).reshape(-1)
+    R = array(R, float)
+    theta_sq = numpy.dot(r, r)
+    dR = numpy.zeros((3,3,3))
+    for i in range(3):
+        e_i = numpy.zeros(3)
+        e_i[i] = 1.0
+        if theta_sq < 1e-16:
+            dR[i] = skew(e_i)
+        else:
+            dR[i] = numpy.dot((r[i] * skew(r) + skew(numpy.cross(r, e_i - numpy.dot(R, e_i)))) / theta_sq, R)
+    return dR
+
+def pose_jacobian(p):
+    '''
+    Derivative of the 4x4 transform built by SingleTransform.inflate w.r.t. the
+    6 parameters p = [x, y, z, rx, ry, rz]
+    Returns: 6x4x4 array, where element k is dT/dp_k
+    '''
+    p = array(p, float).reshape(-1)
+    T = pose_transforms(p)[0]
+    dT = numpy.zeros((6,4,4))
+    for i in range(3):
+        dT[i,i,3] = 1.0
+    dT[3:6,0:3,0:3] = rotation_vector_jacobian(p[3:6], T[0:3,0:3])
+    return dT
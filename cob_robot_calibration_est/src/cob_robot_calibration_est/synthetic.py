@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+
+# Synthetic robots and measurements, e.g. for benchmarking the estimator without a robot or a bag.
+#
+# synthetic_robot builds a system in the format of the estimator's initial_system: a head chain
+# carrying num_cameras rectified cameras looking along x, and an arm chain with num_joints joints
+# holding a checkerboard in front of them. synthetic_measurements then samples random joint positions
+# and projects the checkerboard into the cameras with the true system parameters. The noise that is
+# added to the image points and joint positions has the standard deviations given in the cov entries of
+# the system, so the estimator's covariance model matches the data.
+
+import copy
+import numpy
+from numpy import array, matrix, zeros, float64
+
+from cob_robot_calibration_est.robot_params import RobotParams
+from cob_robot_calibration_est.full_chain import FullChainRobotParams
+from cob_robot_calibration_est.single_transform import rotation_vectors
+from cob_robot_calibration_est.measurement_store import MeasurementStore, StoredHeader, StoredChainState
+from cob_robot_calibration_est.intrinsics import set_intrinsics, get_intrinsics
+from cob_robot_calibration_est.sensors.multi_sensor import MultiSensor
+
+# Camera looking along x of its parent frame, with the image x axis along -y and the image y axis along -z
+_camera_rotation = rotation_vectors(array([[0, 0, 1], [-1, 0, 0], [0, -1, 0]], float64))[0].tolist()
+# Checkerboard facing -x of its parent frame, with its x axis along -y and its y axis along z
+_checkerboard_rotation = rotation_vectors(array([[0, 0, -1], [-1, 0, 0], [0, 1, 0]], float64))[0].tolist()
+
+
+def synthetic_robot(num_joints=6, num_cameras=2, corners_x=6, corners_y=4, spacing=0.03,
+                    pixel_sigma=0.25, joint_sigma=0.001):
+    """
+    Builds a synthetic robot
+    Returns: (system, sensors, free), dictionaries in the format of the estimator's initial_system,
+             sensors and free_params. The DH parameters of the arm and of the head tilt link, the
+             checkerboard mount and the transforms of all but the first camera are free. Like on
+             a real robot, some of them are redundant.
+    """
+    joint_types = ['rotz', 'roty', 'rotx']
+    link_length = 0.1
+    arm_dh = [{'name': 'arm_%u' % j, 'type': joint_types[j % 3],
+               'xyzrpy': [0.0, 0.0, link_length if j > 0 else 0.0, 0.0, 0.0, 0.0]} for j in range(num_joints)]
+    head_dh = [{'name': 'head_pan', 'type': 'rotz', 'xyzrpy': [0.0, 0.0, 0.0, 0.0, 0.0, 0.0]},
+               {'name': 'head_tilt', 'type': 'roty', 'xyzrpy': [0.0, 0.0, 0.1, 0.0, 0.0, 0.0]}]
+    camera_ids = ['cam_%u' % k for k in range(num_cameras)]
+    baseline = 0.1
+
+    system = {
+        'dh_chains': {
+            'arm_chain': {'dh': arm_dh, 'gearing': [1.0] * num_joints, 'cov': [joint_sigma] * num_joints},
+            'head_chain': {'dh': head_dh, 'gearing': [1.0, 1.0], 'cov': [joint_sigma] * 2}},
+        'transforms': {
+            # The checkerboard is centered in front of the cameras, 0.7m away
+            'arm_base_link': [0.6, 0.5 * (corners_x - 1) * spacing, 1.1 - 0.5 * (corners_y - 1) * spacing - link_length * (num_joints - 1), 0.0, 0.0, 0.0],
+            'arm_cb_link': [0.1, 0.02, 0.05] + _checkerboard_rotation,
+            'head_base_link': [0.0, 0.0, 1.0, 0.0, 0.0, 0.0]},
+        'rectified_cams': {},
+        'checkerboards': {'cb': {'corners_x': corners_x, 'corners_y': corners_y, 'spacing_x': spacing, 'spacing_y': spacing}}}
+    free = {
+        'dh_chains': {
+            'arm_chain': {'dh': [{'xyzrpy': [1, 1, 1, 1, 1, 1]} for j in range(num_joints)], 'gearing': [0] * num_joints},
+            'head_chain': {'dh': [{'xyzrpy': [0, 0, 0, 0, 0, 0]}, {'xyzrpy': [1, 1, 1, 1, 1, 1]}], 'gearing': [0, 0]}},
+        'transforms': {'arm_base_link': [0, 0, 0, 0, 0, 0], 'arm_cb_link': [1, 1, 1, 1, 1, 1], 'head_base_link': [0, 0, 0, 0, 0, 0]},
+        'rectified_cams': {},
+        'checkerboards': {'cb': {'spacing_x': 0, 'spacing_y': 0}}}
+    sensors = {
+        'camera_chains': [],
+        'sensor_chains': [{'sensor_id': 'arm_chain', 'before_chain': [], 'chains': ['arm_chain'], 'after_chain': ['arm_cb_link']}],
+        'chains': [{'chain_id': 'arm_chain', 'before_chain': ['arm_base_link'], 'after_chain': []},
+                   {'chain_id': 'head_chain', 'before_chain': ['head_base_link'], 'after_chain': []}]}
+
+    for k, camera_id in enumerate(camera_ids):
+        camera_link = camera_id + '_link'
+        offset = baseline * (0.5 * (num_cameras - 1) - k)
+        system['transforms'][camera_link] = [0.05, offset, 0.0] + _camera_rotation
+        system['rectified_cams'][camera_id] = {'baseline_shift': 0.0, 'f_shift': 0.0, 'cx_shift': 0.0, 'cy_shift': 0.0,
+                                               'cov': {'u': pixel_sigma, 'v': pixel_sigma}}
+        # The first camera defines the frame of the others
+        free['transforms'][camera_link] = [1, 1, 1, 1, 1, 1] if k > 0 else [0, 0, 0, 0, 0, 0]
+        free['rectified_cams'][camera_id] = {'baseline_shift': 0, 'f_shift': 0, 'cx_shift': 0, 'cy_shift': 0}
+        sensors['camera_chains'].append({'sensor_id': camera_id, 'camera_id': camera_id,
+                                         'chain': {'before_chain': [], 'chains': ['head_chain'], 'after_chain': [camera_link]}})
+    return system, sensors, free
+
+
+def set_synthetic_intrinsics(sensors, focal_length=500.0, width=640, height=480):
+    """
+    Seeds the intrinsics registry with distortion-free intrinsics for all cameras of sensors
+    """
+    camera_matrix = [[focal_length, 0.0, 0.5 * width], [0.0, focal_length, 0.5 * height], [0.0, 0.0, 1.0]]
+    for config in sensors['camera_chains']:
+        set_intrinsics(config['camera_id'], camera_matrix, zeros(5))
+
+
+def synthetic_measurements(system, sensors, num_samples, joint_range=0.2, noise=1.0, seed=0):
+    """
+    Samples measurements of the checkerboard in every camera (see set_synthetic_intrinsics) and in the
+    chain of the sensor_chains sensor.
+    - joint_range: The joint positions are uniformly distributed in [-joint_range, joint_range]
+    - noise: Scale of the noise w.r.t. the standard deviations in the cov entries of system
+    Returns: (store, poses), a MeasurementStore and the Mx6 array of the true checkerboard poses
+    """
+    rand = numpy.random.RandomState(seed)
+    robot_params = RobotParams()
+    robot_params.configure(copy.deepcopy(system))
+
+    chain_config = sensors['sensor_chains'][0]
+    target_id = system['checkerboards'].keys()[0]
+    target_chain = FullChainRobotParams(chain_config, sensors)
+    target_chain.update_config(robot_params)
+    target_pts_cb = robot_params.checkerboards[target_id].generate_points()
+
+    camera_configs = sensors['camera_chains']
+    camera_chains = [FullChainRobotParams(config['chain'], sensors) for config in camera_configs]
+    for camera_chain in camera_chains:
+        camera_chain.update_config(robot_params)
+
+    frame_ids = [chain['chain_id'] for chain in sensors['chains']]
+    joint_sigmas = [array(system['dh_chains'][frame_id]['cov'], float64) for frame_id in frame_ids]
+
+    samples = []
+    cameras = []
+    chains = []
+    image_points = []
+    joint_positions = []
+    poses = zeros([num_samples, 6])
+    for k in range(num_samples):
+        samples.append({'sample_id': 'sample_%u' % k, 'target_id': target_id, 'chain_id': chain_config['sensor_id']})
+        positions = [rand.uniform(-joint_range, joint_range, len(sigmas)) for sigmas in joint_sigmas]
+        M_chain = dict((frame_id, StoredChainState(StoredHeader(frame_id), q)) for frame_id, q in zip(frame_ids, positions))
+
+        target_pose = target_chain.calc_block.fk([M_chain[c] for c in chain_config['chains']])
+        poses[k, 0:3] = array(target_pose)[0:3, 3]
+        poses[k, 3:6] = rotation_vectors(array(target_pose)[0:3, 0:3])[0]
+        target_pts = target_pose * target_pts_cb
+
+        for camera_index, (config, camera_chain) in enumerate(zip(camera_configs, camera_chains)):
+            camera = robot_params.rectified_cams[config['camera_id']]
+            camera_pose = camera_chain.calc_block.fk([M_chain[c] for c in config['chain']['chains']])
+            pixel_pts = array(camera.project(get_intrinsics(config['camera_id'])[0], camera_pose.I * target_pts)).T
+            sigma = array([camera._cov_dict['u'], camera._cov_dict['v']], float64)
+            pixel_pts = pixel_pts + noise * sigma * rand.standard_normal(pixel_pts.shape)
+            first = len(image_points)
+            image_points.extend(pixel_pts.tolist())
+            cameras.append([k, camera_index, first, len(image_points)])
+
+        for frame_index, (q, sigmas) in enumerate(zip(positions, joint_sigmas)):
+            first = len(joint_positions)
+            joint_positions.extend((q + noise * sigmas * rand.standard_normal(len(q))).tolist())
+            chains.append([k, frame_index, first, len(joint_positions)])
+
+    columns = {'samples': samples, 'camera_ids': [config['camera_id'] for config in camera_configs], 'frame_ids': frame_ids,
+               'image_points': array(image_points, float64).reshape(-1, 2),
+               'cameras': array(cameras, numpy.int64).reshape(-1, 4),
+               'joint_positions': array(joint_positions, float64),
+               'chains': array(chains, numpy.int64).reshape(-1, 4)}
+    return MeasurementStore(columns), poses
+
+
+def synthetic_multisensors(sensors, store):
+    """
+    Builds a MultiSensor for every sample of the MeasurementStore store
+    """
+    multisensors = []
+    for msg in store:
+        ms = MultiSensor(sensors, store)
+        ms.sensors_from_message(msg)
+        multisensors.append(ms)
+    return multisensors
+
+
+def determinable_synthetic_problem(num_samples, noise=1.0, seed=0):
+    """
+    Small synthetic problem (3 arm joints, 2 cameras, 3x2 checkerboard) in which only the parameters that
+    the measurements determine are free, i.e. the checkerboard mount and the transform of the second camera.
+    Its marginal information is invertible, so the covariance of the free parameters is finite.
+    Returns: (system, sensors, free, store, poses), see synthetic_robot and synthetic_measurements
+    """
+    system, sensors, free = synthetic_robot(num_joints=3, num_cameras=2, corners_x=3, corners_y=2)
+    free['dh_chains']['arm_chain']['dh'] = [{'xyzrpy': [0, 0, 0, 0, 0, 0]} for j in range(3)]
+    free['dh_chains']['head_chain']['dh'] = [{'xyzrpy': [0, 0, 0, 0, 0, 0]} for j in range(2)]
+    set_synthetic_intrinsics(sensors)
+    store, poses = synthetic_measurements(system, sensors, num_samples, noise=noise, seed=seed)
+    return system, sensors, free, store, poses
+
+
+def perturb_system(system, free, scale, seed=0):
+    """
+    Adds uniform noise in [-scale, scale] to all free parameters of system, e.g. to get an initial guess
+    Returns: The perturbed copy of system
+    """
+    rand = numpy.random.RandomState(seed)
+    robot_params = RobotParams()
+    robot_params.configure(copy.deepcopy(system))
+    free_list = robot_params.calc_free(copy.deepcopy(free))
+    free_idx = numpy.where(free_list)[0]
+    offsets = zeros([robot_params.length, 1])
+    offsets[free_idx, 0] = rand.uniform(-scale, scale, len(free_idx))
+    return robot_params.params_to_config(robot_params.deflate() + matrix(offsets))
+
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+
+# Benchmark of the estimator on synthetic robots (see synthetic.py), so it runs without a robot,
+# a bag or a parameter server. For every sample count, it times ErrorCalc.calculate_error,
+# calculate_jacobian, calculate_sparse_jacobian and a full opt_runner step, and writes the timings
+# to a json file. Passing an earlier file with --compare checks the new timings against it.
+# The system, sensors and free parameters of synthetic_robot can be replaced with yaml files in the same
+# format (--system, --sensors, --free), e.g. to benchmark the model of a real robot. The cameras get the
+# intrinsics of set_synthetic_intrinsics, and the noise follows the cov entries of the system.
+#
+# Example:
+#   estimator_benchmark.py --samples 10,100,1000 --output baseline.json
+#   estimator_benchmark.py --samples 10,100,1000 --compare baseline.json
+#   estimator_benchmark.py --samples 100 --system system.yaml --sensors sensors.yaml --free free.yaml
+
+import argparse
+import copy
+import json
+import sys
+import time
+import numpy
+import yaml
+
+from cob_robot_calibration_est.robot_params import RobotParams
+from cob_robot_calibration_est.opt_runner import ErrorCalc, opt_runner, build_opt_vector
+from cob_robot_calibration_est.synthetic import synthetic_robot, set_synthetic_intrinsics, synthetic_measurements, synthetic_multisensors, perturb_system
+
+
+def time_calls(function, x, repeat):
+    """
+    Calls function repeat times. The first entry of x is changed for every call, so that no
+    results are reused from the previous call.
+    Returns: Dictionary with the minimum and median seconds per call
+    """
+    times = []
+    for i in range(repeat):
+        x_i = x.copy()
+        x_i[0] += 1e-9 * (i + 1)
+        start = time.time()
+        function(x_i)
+        times.append(time.time() - start)
+    return {'min': min(times), 'median': float(numpy.median(times))}
+
+
+def load_robot(args):
+    """
+    Builds the synthetic robot of the benchmark, with the dictionaries of the --system, --sensors
+    and --free yaml files in place of those of synthetic_robot
+    Returns: (system, sensors, free)
+    """
+    robot = list(synthetic_robot(args.joints, args.cameras, args.corners_x, args.corners_y))
+    for k, filename in enumerate([args.system, args.sensors, args.free]):
+        if filename is not None:
+            f = open(filename)
+            robot[k] = yaml.load(f)
+            f.close()
+    system, sensors, free = robot
+    set_synthetic_intrinsics(sensors)
+    return system, sensors, free
+
+
+def benchmark(num_samples, args):
+    """
+    Runs the benchmark for num_samples samples
+    Returns: Dictionary with the problem size and the timings
+    """
+    system, sensors, free = load_robot(args)
+    store, poses = synthetic_measurements(system, sensors, num_samples, seed=args.seed)
+    guess = perturb_system(system, free, args.perturbation, args.seed)
+    pose_guesses = poses + numpy.random.RandomState(args.seed).uniform(-args.perturbation, args.perturbation, poses.shape)
+
+    start = time.time()
+    multisensors = synthetic_multisensors(sensors, store)
+    result = {'samples': num_samples, 'build_sensors': time.time() - start}
+
+    robot_params = RobotParams()
+    robot_params.configure(copy.deepcopy(guess))
+    error_calc = ErrorCalc(robot_params, copy.deepcopy(free), multisensors, args.use_cov)
+    x = build_opt_vector(robot_params, copy.deepcopy(free), pose_guesses)
+    result['rows'] = sum([ms.get_residual_length() for ms in multisensors])
+    result['columns'] = len(x)
+
+    result['calculate_error'] = time_calls(error_calc.calculate_error, x, args.repeat)
+    if result['rows'] * result['columns'] <= args.max_dense:
+        result['calculate_jacobian'] = time_calls(error_calc.calculate_jacobian, x, args.repeat)
+    else:
+        result['calculate_jacobian'] = None
+    result['calculate_sparse_jacobian'] = time_calls(error_calc.calculate_sparse_jacobian, x, args.repeat)
+
+    if args.solver in ['leastsq'] and result['rows'] * result['columns'] > args.max_dense:
+        result['opt_runner'] = None
+    else:
+        start = time.time()
+        opt_runner(copy.deepcopy(guess), pose_guesses, copy.deepcopy(free), multisensors, args.use_cov,
+                   args.solver, 'analytic', args.processes)
+        result['opt_runner'] = time.time() - start
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the timings of results with those of a baseline
+    Returns: List of (samples, timing, ratio) of all timings that are slower than the baseline by more than tolerance
+    """
+    regressions = []
+    baseline_results = dict([(r['samples'], r) for r in baseline['results']])
+    print "%8s  %-26s %10s %10s %7s" % ("samples", "timing", "baseline", "current", "ratio")
+    for result in results['results']:
+        if result['samples'] not in baseline_results:
+            continue
+        old = baseline_results[result['samples']]
+        for name in ['calculate_error', 'calculate_jacobian', 'calculate_sparse_jacobian', 'opt_runner']:
+            if result.get(name) is None or old.get(name) is None:
+                continue
+            new_time = result[name]['min'] if isinstance(result[name], dict) else result[name]
+            old_time = old[name]['min'] if isinstance(old[name], dict) else old[name]
+            ratio = new_time / old_time
+            print "%8u  %-26s %10.4f %10.4f %7.2f" % (result['samples'], name, old_time, new_time, ratio)
+            if ratio > 1.0 + tolerance:
+                regressions.append((result['samples'], name, ratio))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Times the estimator on synthetic robots")
+    parser.add_argument('--samples', default='10,100,1000,2000', help="Comma separated list of sample counts")
+    parser.add_argument('--joints', type=int, default=6, help="Number of joints of the arm holding the checkerboard")
+    parser.add_argument('--cameras', type=int, default=2, help="Number of cameras")
+    parser.add_argument('--corners-x', type=int, default=6)
+    parser.add_argument('--corners-y', type=int, default=4)
+    parser.add_argument('--system', help="Yaml file with the system to use instead of the synthetic one")
+    parser.add_argument('--sensors', help="Yaml file with the sensors to use instead of the synthetic ones")
+    parser.add_argument('--free', help="Yaml file with the free parameters to use instead of the synthetic ones")
+    parser.add_argument('--use-cov', action='store_true', help="Weight the residuals with the measurement covariances")
+    parser.add_argument('--solver', default='schur', help="Solver of the opt_runner step")
+    parser.add_argument('--processes', type=int, default=1, help="Worker processes of the opt_runner step")
+    parser.add_argument('--perturbation', type=float, default=0.01, help="Error of the initial guess of all free parameters")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of calls per timing")
+    parser.add_argument('--max-dense', type=float, default=2e7, help="Largest number of dense jacobian entries that is timed")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Json file the timings are written to")
+    parser.add_argument('--compare', help="Json file of an earlier run to compare the timings with")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative slowdown w.r.t. --compare")
+    args = parser.parse_args()
+
+    config = dict(vars(args))
+    del config['output'], config['compare'], config['tolerance']
+    results = {'config': config, 'results': []}
+    for num_samples in [int(n) for n in args.samples.split(',')]:
+        results['results'].append(benchmark(num_samples, args))
+
+    print ""
+    print "%8s %8s %8s  %-26s %10s %10s" % ("samples", "rows", "columns", "timing", "min", "median")
+    for result in results['results']:
+        for name in ['calculate_error', 'calculate_jacobian', 'calculate_sparse_jacobian']:
+            if result[name] is not None:
+                print "%8u %8u %8u  %-26s %10.4f %10.4f" % (result['samples'], result['rows'], result['columns'], name,
+                                                          result[name]['min'], result[name]['median'])
+        if result['opt_runner'] is not None:
+            print "%8u %8u %8u  %-26s %10.4f" % (result['samples'], result['rows'], result['columns'], 'opt_runner', result['opt_runner'])
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if dict(baseline['config'], samples=None) != dict(config, samples=None):
+            print "Warning: The benchmark configuration differs from the one of %s" % args.compare
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print "Slower than %s by more than %.0f%%:" % (args.compare, 100 * args.tolerance)
+            for num_samples, name, ratio in regressions:
+                print " - %s with %u samples (x%.2f)" % (name, num_samples, ratio)
+            sys.exit(1)
@@ -39,7 +39,6 @@ import sys
 import rospy
 import time
 import numpy
-import rosbag
 import yaml
 import os.path
 
@@ -51,6 +50,11 @@ from numpy import matrix
 from cob_robot_calibration_est.robot_params import RobotParams
 from cob_robot_calibration_est.sensors.multi_sensor import MultiSensor
 from cob_robot_calibration_est.opt_runner import opt_runner
+from cob_robot_calibration_est.measurement_cache import load_measurement_store, bag_hash
+from cob_robot_calibration_est.checkpoint import step_key, StepCheckpoint
+from cob_robot_calibration_est import profiling
+from cob_robot_calibration_est.covariance import normal_matrix, marginal_covariance, unconstrained_params, save_sparse, std_summary
+from cob_robot_calibration_est.sample_selection import choose_samples
 
 def usage():
     rospy.logerr("Not enough arguments")
@@ -125,6 +129,31 @@ def check_file_permissions(filename):
     return (os.stat(filename).st_mode & stat.S_IWOTH) > 0
 
 
+def write_covariance(output_prefix, system, free_dict, information, summary):
+    '''
+    Writes the sparse normal matrix of a step to <output_prefix>_information.npz and the covariance of
+    its free system parameters to <output_prefix>_cov.npy. With summary, the standard deviations of the
+    free parameters are written to <output_prefix>_std.yaml as well.
+    '''
+    robot_params = RobotParams()
+    robot_params.configure(system)
+    free_list = robot_params.calc_free(free_dict)
+    # The normal matrix only holds the poses of the samples the step was optimized with
+    num_poses = (information.shape[0] - sum(free_list)) // 6
+
+    save_sparse(output_prefix + "_information.npz", information)
+    cov = marginal_covariance(information, num_poses)
+    numpy.save(output_prefix + "_cov.npy", cov)
+    names = [name for name, free in zip(robot_params.get_param_names(), free_list) if free]
+    unconstrained = unconstrained_params(cov, names)
+    if len(unconstrained) > 0:
+        rospy.logwarn("The measurements don't constrain these free parameters, their variance is infinite: %s" % ", ".join(unconstrained))
+    if summary:
+        out_f = open(output_prefix + "_std.yaml", 'w')
+        yaml.dump(std_summary(cov, names), out_f, default_flow_style=False)
+        out_f.close()
+
+
 def load_requested_sensors(all_sensors_dict, requested_sensors):
     '''
     Build a sensor dictionary with the subset of sensors that we request
@@ -180,15 +209,25 @@ if __name__ == '__main__':
     # Load all the calibration steps.
     step_list = load_calibration_steps(config["cal_steps"])
 
+    # Read all robot measurements once. They are cached on disk, so that reruns on the same bag don't need to read it again.
+    # The store keeps them in flat arrays, which the sensors of every step only reference
+    if 'measurement_cache_dir' in config.keys():
+        cache_dir = config['measurement_cache_dir']
+    else:
+        cache_dir = os.path.join(os.environ.get('ROS_HOME', os.path.expanduser('~/.ros')), 'cob_robot_calibration_est', 'measurement_cache')
+    robot_measurements = load_measurement_store(bag_filename, cache_dir)
+
+    # Checkpoints of the calibration steps. Steps whose inputs didn't change since the last run are skipped,
+    # and interrupted steps resume from their last snapshot
+    if 'checkpoint_dir' in config.keys():
+        checkpoint_dir = config['checkpoint_dir']
+    else:
+        checkpoint_dir = os.path.join(os.environ.get('ROS_HOME', os.path.expanduser('~/.ros')), 'cob_robot_calibration_est', 'checkpoints')
+    checkpoint_interval = config.get('checkpoint_interval', 60.0)
+    bag_key = bag_hash(bag_filename)
+
     # Count how many checkerboard poses we need to track
-    msg_count = 0
-    # f = open(bag_filename)
-    bag = rosbag.Bag(bag_filename)
-    multisensors = []
-    for topic, msg, t in bag.read_messages(topics=['/robot_measurement', 'robot_measurement']):
-        if topic == "robot_measurement" or topic == "/robot_measurement":
-            msg_count+=1
-    bag.close()
+    msg_count = len(robot_measurements)
 
     if 'initial_poses' in config.keys():
         previous_pose_guesses = numpy.array(yaml.load(config['initial_poses']))
@@ -197,7 +236,7 @@ if __name__ == '__main__':
 
     # Check if we can write to all of our output files
     output_filenames = []
-    for suffix in [".yaml", "_poses.yaml", "_cov.txt"]:
+    for suffix in [".yaml", "_poses.yaml", "_information.npz", "_cov.npy", "_std.yaml"]:
         output_filenames += [output_dir + "/" + cur_step["output_filename"] + suffix for cur_step in step_list]
 
     valid_list = [check_file_permissions(curfile) for curfile in output_filenames];
@@ -209,6 +248,12 @@ if __name__ == '__main__':
         print "\n".join([" - " + cur_file for cur_file,cur_valid in zip(output_filenames, valid_list) if not cur_valid])
         sys.exit(-1)
 
+    # Optionally profile the hot paths of all steps. The statistics are written to <profile_output>.json
+    # and a trace for chrome://tracing to <profile_output>_trace.json
+    profile_output = config.get('profile_output', None)
+    if profile_output is not None:
+        profiler = profiling.enable()
+
     # Specify which system the first calibration step should use.
     # Normally this would be set at the end of the calibration loop, but for the first step,
     # this is grabbed from the param server
@@ -223,20 +268,16 @@ if __name__ == '__main__':
         # Need to load only the sensors that we're interested in
         cur_sensors = load_requested_sensors(all_sensors_dict, cur_step['sensors'])
 
-        # Load all the sensors from bag
-        # f = open(bag_filename)
-        bag = rosbag.Bag(bag_filename)
+        # Load all the sensors from the measurements
         multisensors = []
-        for topic, msg, t in bag.read_messages(topics=['/robot_measurement', 'robot_measurement']):
-            if topic == "robot_measurement" or topic == "/robot_measurement":
-                # Hack to rename laser id
-#                for cur_laser in msg.M_laser:
-#                    if cur_laser.laser_id in ["tilt_laser_6x8", "tilt_laser_8x6", "tilt_laser_7x6", "tilt_laser_6x7"]:
-#                        cur_laser.laser_id = "tilt_laser"
-                ms = MultiSensor(cur_sensors)
-                ms.sensors_from_message(msg)
-                multisensors.append(ms)
-        bag.close()
+        for msg in robot_measurements:
+            # Hack to rename laser id
+#            for cur_laser in msg.M_laser:
+#                if cur_laser.laser_id in ["tilt_laser_6x8", "tilt_laser_8x6", "tilt_laser_7x6", "tilt_laser_6x7"]:
+#                    cur_laser.laser_id = "tilt_laser"
+            ms = MultiSensor(cur_sensors, robot_measurements)
+            ms.sensors_from_message(msg)
+            multisensors.append(ms)
 
         # Display sensor count statistics
         print "Executing step with the following Sensors:"
@@ -257,10 +298,25 @@ if __name__ == '__main__':
 
         print "Pose Guesses:\n", previous_pose_guesses
 
-        if len(multisensors) == 0:
+        solver = cur_step.get('solver', 'leastsq')
+        jacobian = cur_step.get('jacobian', 'analytic')
+        processes = cur_step.get('processes', config.get('processes', 1))
+        sample_budget = cur_step.get('sample_budget', config.get('sample_budget', None))
+
+        # The step can be skipped if its checkpoint holds the result for exactly the same inputs
+        key = step_key(bag_key, previous_system, previous_pose_guesses, cur_step['free_params'], cur_sensors,
+                       {'use_cov': cur_step['use_cov'], 'solver': solver, 'jacobian': jacobian, 'sample_budget': sample_budget})
+        checkpoint = StepCheckpoint(checkpoint_dir, key, checkpoint_interval)
+        result = checkpoint.load_result()
+
+        if result is not None:
+            print "Nothing changed since the last run of this step. Using the result from its checkpoint"
+            output_dict, output_poses, information = result
+        elif len(multisensors) == 0:
             rospy.logwarn("No error blocks were generated for this optimization step. Skipping this step.  This will result in a miscalibrated sensor")
             output_dict = previous_system
             output_poses = previous_pose_guesses
+            information = None
         else:
             free_dict = yaml.load(cur_step["free_params"])
             use_cov = cur_step['use_cov']
@@ -268,7 +324,21 @@ if __name__ == '__main__':
                 print "Executing step with covariance calculations"
             else:
                 print "Executing step without covariance calculations"
-            output_dict, output_poses, J = opt_runner(previous_system, previous_pose_guesses, free_dict, multisensors, use_cov)
+            print "Executing step with the [%s] solver and %s jacobians in %u process(es)" % (solver, jacobian, processes)
+
+            # Optionally only optimize over the most informative samples. The others get the pose guesses
+            # from the forward kinematics that the selection was scored with
+            selected = numpy.arange(len(multisensors))
+            output_poses = numpy.array(previous_pose_guesses, float)
+            if sample_budget is not None and sample_budget < len(multisensors):
+                selected, output_poses = choose_samples(previous_system, free_dict, multisensors, previous_pose_guesses, use_cov, sample_budget)
+                print "Selected the %u most informative of %u samples:" % (len(selected), len(multisensors))
+                print " " + ", ".join([str(k) for k in selected])
+            output_dict, selected_poses, J = opt_runner(previous_system, previous_pose_guesses[selected], free_dict,
+                                                        [multisensors[k] for k in selected], use_cov, solver, jacobian, processes, checkpoint)
+            output_poses[selected] = selected_poses
+            information = normal_matrix(J)
+            checkpoint.save_result(output_dict, output_poses, information)
 
         # Dump results to file
         out_f = open(output_dir + "/" + cur_step["output_filename"] + ".yaml", 'w')
@@ -279,9 +349,17 @@ if __name__ == '__main__':
         yaml.dump([list([float(x) for x in pose]) for pose in list(output_poses)], out_f)
         out_f.close()
 
-        cov_x = matrix(J).T * matrix(J)
-        numpy.savetxt(output_dir + "/" + cur_step["output_filename"] + "_cov.txt", cov_x, fmt="% 9.3f")
+        # The covariance of the free system parameters, with the checkerboard poses marginalized
+        if information is not None:
+            write_covariance(output_dir + "/" + cur_step["output_filename"], output_dict, yaml.load(cur_step["free_params"]),
+                             information, config.get('std_summary', True))
 
         previous_system = output_dict
         previous_pose_guesses = output_poses
 
+    if profile_output is not None:
+        profiling.disable()
+        profiler.write_json(profile_output + ".json")
+        profiler.write_chrome_trace(profile_output + "_trace.json")
+        print "Wrote the profile to %s.json and %s_trace.json" % (profile_output, profile_output)
+
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+
+
+# Online calibration: estimates the free system parameters of a calibration step while the data is being
+# collected. The node updates an OnlineEstimator with every sample published on /robot_measurement, and
+# publishes the standard deviations of the free parameters on ~parameter_std (as yaml dictionary) and
+# whether they converged on ~converged. collect_robot_calibration_data.py can then stop driving to the
+# calibration positions early (see its stop_on_convergence parameter). When the node is shut down, the
+# estimate is polished with a batch optimization over all samples, and the results are written to
+# output_dir with the output_filename of the step, as by multi_step_cov_estimator.py.
+#
+# Usage:
+#   online_cov_estimator.py [output_dir]
+# The node reads the calibration_config of multi_step_cov_estimator.py and the private parameters
+#   ~step:              Name of the calibration step to run (default: the last one)
+#   ~window:            Number of samples whose checkerboard poses are optimized (default: 10)
+#   ~iterations:        Solver iterations per sample (default: 5)
+#   ~prior_std:         Standard deviation of the free parameters of the initial system (default: none)
+#   ~tolerance:         Relative change of the standard deviations below which they count as
+#   ~converged_samples: converged, over the last converged_samples samples (default: 0.05 and 3)
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+import threading
+import yaml
+import rospy
+
+from std_msgs.msg import Bool, String
+from cob_calibration_msgs.msg import RobotMeasurement
+
+from cob_robot_calibration_est.online_estimator import OnlineEstimator
+from cob_robot_calibration_est.covariance import normal_matrix
+from multi_step_cov_estimator import build_sensor_defs, load_calibration_steps, load_requested_sensors, check_file_permissions, write_covariance
+
+
+class OnlineCalibration:
+    """
+    Feeds the robot measurements into the estimator and publishes its uncertainty
+    """
+    def __init__(self, estimator, tolerance, converged_samples):
+        self.estimator = estimator
+        self.lock = threading.Lock()
+        self._tolerance = tolerance
+        self._converged_samples = converged_samples
+        self._converged = False
+        self._converged_pub = rospy.Publisher("~converged", Bool, latch=True)
+        self._std_pub = rospy.Publisher("~parameter_std", String, latch=True)
+        self._converged_pub.publish(Bool(False))
+        rospy.Subscriber("/robot_measurement", RobotMeasurement, self.measurement_callback)
+
+    def measurement_callback(self, msg):
+        with self.lock:
+            if not self.estimator.add_measurement(msg):
+                rospy.logwarn("Sample [%s] has none of the sensors of this step. Skipping it", msg.sample_id)
+                return
+            converged = self.estimator.converged(self._tolerance, self._converged_samples)
+            summary = self.estimator.std_summary()
+            num_samples = len(self.estimator.std_history)
+
+        rospy.loginfo("Updated the estimate with sample [%s] (%u samples)", msg.sample_id, num_samples)
+        if converged and not self._converged:
+            rospy.loginfo("The uncertainty of the free parameters converged after %u samples", num_samples)
+        self._converged = converged
+        self._std_pub.publish(String(yaml.dump(summary, default_flow_style=False)))
+        self._converged_pub.publish(Bool(converged))
+
+
+if __name__ == '__main__':
+    rospy.init_node("online_cov_estimator")
+
+    print "Starting The Online [Covariance] Estimator Node\n"
+
+    if len(rospy.myargv()) < 2:
+        output_dir = "."
+    else:
+        output_dir = rospy.myargv()[1]
+
+    config_param_name = "calibration_config"
+    if not rospy.has_param(config_param_name):
+        rospy.logerr("Could not find parameter [%s]. Please populate this namespace with the estimation configuration.", config_param_name)
+        sys.exit(1)
+    config = rospy.get_param(config_param_name)
+
+    sensors_dump = [yaml.load(x) for x in config["sensors"].values()]
+    all_sensors_dict = build_sensor_defs(sensors_dump)
+    step_list = load_calibration_steps(config["cal_steps"])
+    step_name = rospy.get_param("~step", step_list[-1]["name"])
+    cur_step = [step for step in step_list if step["name"] == step_name]
+    if len(cur_step) == 0:
+        rospy.logerr("Could not find the calibration step [%s]", step_name)
+        sys.exit(1)
+    cur_step = cur_step[0]
+
+    output_prefix = output_dir + "/" + cur_step["output_filename"]
+    output_filenames = [output_prefix + suffix for suffix in [".yaml", "_poses.yaml", "_information.npz", "_cov.npy", "_std.yaml"]]
+    valid_list = [check_file_permissions(curfile) for curfile in output_filenames]
+    if not all(valid_list):
+        print "Invalid file permissions. You need to be able to write to the following files:"
+        print "\n".join([" - " + cur_file for cur_file, cur_valid in zip(output_filenames, valid_list) if not cur_valid])
+        sys.exit(-1)
+
+    cur_sensors = load_requested_sensors(all_sensors_dict, list(cur_step['sensors']))
+    free_dict = yaml.load(cur_step["free_params"])
+    estimator = OnlineEstimator(yaml.load(config["initial_system"]), free_dict, cur_sensors, cur_step['use_cov'],
+                                rospy.get_param("~window", 10), rospy.get_param("~iterations", 5),
+                                rospy.get_param("~prior_std", None))
+    calibration = OnlineCalibration(estimator, rospy.get_param("~tolerance", 0.05), rospy.get_param("~converged_samples", 3))
+    print "Estimating step [%s] online. Waiting for robot measurements" % step_name
+    rospy.spin()
+
+    # Final batch optimization over all samples
+    with calibration.lock:
+        if len(estimator.std_history) == 0:
+            print "No robot measurements of the sensors of this step were received"
+            sys.exit(1)
+        solver = cur_step.get('solver', 'leastsq')
+        jacobian = cur_step.get('jacobian', 'analytic')
+        processes = cur_step.get('processes', config.get('processes', 1))
+        print "Polishing the online estimate with a batch optimization over %u samples" % len(estimator.multisensors)
+        output_dict, output_poses, J = estimator.polish(solver, jacobian, processes)
+
+    out_f = open(output_prefix + ".yaml", 'w')
+    yaml.dump(output_dict, out_f)
+    out_f.close()
+
+    out_f = open(output_prefix + "_poses.yaml", 'w')
+    yaml.dump([list([float(x) for x in pose]) for pose in list(output_poses)], out_f)
+    out_f.close()
+
+    write_covariance(output_prefix, output_dict, yaml.load(cur_step["free_params"]), normal_matrix(J), config.get('std_summary', True))
+    print "Wrote the results to %s" % output_prefix
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+import unittest
+import rospy
+import numpy
+import scipy.linalg
+
+from cob_robot_calibration_est.block_diagonal import inv_sqrt_blocks, scale_blocks, dense_blocks, diagonal_blocks
+from numpy import *
+
+def random_spd_blocks(N, k):
+    A = random.RandomState(0).normal(size=(N, k, k))
+    return einsum('nij,nkj->nik', A, A) + 0.1 * eye(k)
+
+class TestInvSqrtBlocks(unittest.TestCase):
+    def check(self, k):
+        cov = random_spd_blocks(5, k)
+        result = inv_sqrt_blocks(cov)
+        self.assertEqual(result.shape, (5, k, k))
+        for n in range(5):
+            expected = real(scipy.linalg.sqrtm(linalg.inv(cov[n])))
+            self.assertAlmostEqual(linalg.norm(result[n] - expected), 0.0, 6)
+
+    def test_2x2(self):
+        self.check(2)
+
+    def test_3x3(self):
+        self.check(3)
+
+    def test_diagonal(self):
+        result = inv_sqrt_blocks(array([[[4, 0], [0, 0.25]]], float))
+        self.assertAlmostEqual(linalg.norm(result[0] - diag([0.5, 2])), 0.0, 6)
+
+    def test_not_positive_definite(self):
+        self.assertRaises(linalg.LinAlgError, inv_sqrt_blocks, array([[[1, 2], [2, 1]]], float))
+
+class TestScaleBlocks(unittest.TestCase):
+    def test_vector(self):
+        blocks = random_spd_blocks(4, 2)
+        v = arange(8, dtype=float)
+        expected = array(dense_blocks(blocks) * matrix(v).T)[:, 0]
+        self.assertAlmostEqual(linalg.norm(scale_blocks(blocks, v) - expected), 0.0, 6)
+
+    def test_matrix(self):
+        blocks = random_spd_blocks(4, 3)
+        m = arange(36, dtype=float).reshape(12, 3)
+        expected = dense_blocks(blocks) * matrix(m)
+        self.assertAlmostEqual(linalg.norm(scale_blocks(blocks, m) - expected), 0.0, 6)
+
+    def test_diagonal_blocks(self):
+        blocks = random_spd_blocks(3, 2)
+        self.assertAlmostEqual(linalg.norm(diagonal_blocks(dense_blocks(blocks), 2) - blocks), 0.0, 6)
+
+if __name__ == '__main__':
+    import rostest
+    rostest.unitrun('cob_robot_calibration_est', 'test_InvSqrtBlocks', TestInvSqrtBlocks, coverage_packages=['cob_robot_calibration_est.block_diagonal'])
+    rostest.unitrun('cob_robot_calibration_est', 'test_ScaleBlocks', TestScaleBlocks, coverage_packages=['cob_robot_calibration_est.block_diagonal'])
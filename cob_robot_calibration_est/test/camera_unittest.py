@@ -144,6 +144,73 @@ class TestRectifiedCamera(unittest.TestCase):
         cam = RectifiedCamera(params)
         self.assertEqual(cam.deflate()[0,0], 10)
 
+    def test_project_jacobian(self):
+        cam = RectifiedCamera({'baseline_shift': 0.3,
+                               'f_shift': 2.0,
+                               'cx_shift': 1.0,
+                               'cy_shift':-1.0,
+                               'cov': {'u':0.5, 'v':0.5} })
+        P_list = [ 500,   0, 320,
+                     0, 510, 240,
+                     0,   0,   1 ]
+        pts = matrix( [ [ 0.1, -0.2 ],
+                        [ 0.05, 0.3 ],
+                        [ 1.0,  1.5 ],
+                        [ 1,    1   ]], float )
+
+        pixel_pts, J_params, J_pts = cam.project_jacobian(P_list, pts)
+        self.assertAlmostEqual(numpy.linalg.norm(pixel_pts - cam.project(P_list, pts)), 0.0, 6)
+
+        for k, name in enumerate(cam.get_param_names()):
+            cam._config[name] += 1e-6
+            plus = cam.project(P_list, pts)
+            cam._config[name] -= 2e-6
+            minus = cam.project(P_list, pts)
+            cam._config[name] += 1e-6
+            self.assertAlmostEqual(numpy.linalg.norm((plus - minus).T / 2e-6 - J_params[:,:,k]), 0.0, 5)
+
+        for j in range(3):
+            d = matrix(zeros((4,1)))
+            d[j,0] = 1e-6
+            plus = cam.project(P_list, pts + d)
+            minus = cam.project(P_list, pts - d)
+            self.assertAlmostEqual(numpy.linalg.norm((plus - minus).T / 2e-6 - J_pts[:,:,j]), 0.0, 5)
+
+
+    def test_project_batch(self):
+        cam = RectifiedCamera({'baseline_shift': 0.3,
+                               'f_shift': 2.0,
+                               'cx_shift': 1.0,
+                               'cy_shift':-1.0,
+                               'cov': {'u':0.5, 'v':0.5} })
+        P_list = [ 500,   0, 320,
+                     0, 510, 240,
+                     0,   0,   1 ]
+        pts = numpy.random.RandomState(0).uniform(-0.5, 0.5, (3,4,5))
+        pts[:,2,:] += 2.0
+        pts[:,3,:] = 1.0
+
+        pixel_pts = cam.project_batch(P_list, pts)
+        pixel_pts_J, J_params, J_pts = cam.project_batch_jacobian(P_list, pts)
+        for m in range(3):
+            single = cam.project_jacobian(P_list, matrix(pts[m]))
+            self.assertAlmostEqual(numpy.linalg.norm(pixel_pts[m] - cam.project(P_list, matrix(pts[m]))), 0.0, 6)
+            self.assertAlmostEqual(numpy.linalg.norm(pixel_pts_J[m] - single[0]), 0.0, 6)
+            self.assertAlmostEqual(numpy.linalg.norm(J_params[m] - single[1]), 0.0, 6)
+            self.assertAlmostEqual(numpy.linalg.norm(J_pts[m] - single[2]), 0.0, 6)
+
+    def test_projection_matrix_cache(self):
+        cam = RectifiedCamera(DefaultParams())
+        P_list = [ 500, 0, 320, 0, 510, 240, 0, 0, 1 ]
+        P = cam.projection_matrix(P_list)
+        self.assertTrue(P is cam.projection_matrix(P_list))
+        cam.inflate(matrix([0.5, 1, 0, 0]).T)
+        P2 = cam.projection_matrix(P_list)
+        self.assertFalse(P is P2)
+        self.assertAlmostEqual(P2[0,3], 0.5, 6)
+        self.assertAlmostEqual(P2[1,1], 511, 6)
+
+
 if __name__ == '__main__':
     import rostest
     rostest.unitrun('cob_robot_calibration_est', 'test_RectifiedCamera', TestRectifiedCamera, coverage_packages=['cob_robot_calibration_est.camera'])
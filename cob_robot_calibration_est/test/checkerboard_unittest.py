@@ -88,6 +88,31 @@ class TestCheckerboard(unittest.TestCase):
         print result
         self.assertAlmostEqual(numpy.linalg.norm(result - expected), 0.0, 6)
 
+    def test_generate_points_cache(self):
+        cb = Checkerboard({"corners_x":  2,
+                            "corners_y": 3,
+                            "spacing_x": 10,
+                            "spacing_y": 20 })
+        result = cb.generate_points()
+        self.assertTrue(cb.generate_points() is result)
+        self.assertRaises(ValueError, result.__setitem__, (0,0), 1.0)
+
+        cb.inflate( matrix([10,20], float).T )
+        self.assertTrue(cb.generate_points() is result)
+
+        cb.inflate( matrix([5,20], float).T )
+        self.assertAlmostEqual(cb.generate_points()[0,1], 5, 6)
+        self.assertAlmostEqual(result[0,1], 10, 6)
+
+    def test_generate_points_jacobian(self):
+        cb = Checkerboard({"corners_x":  2,
+                            "corners_y": 3,
+                            "spacing_x": 10,
+                            "spacing_y": 20 })
+        result = cb.generate_points_jacobian()
+        self.assertEqual(result.shape, (2,4,6))
+        self.assertAlmostEqual(numpy.linalg.norm(result[0,0:3] * 10 + result[1,0:3] * 20 - cb.generate_points()[0:3]), 0.0, 6)
+
     def test_get_length(self):
         cb = Checkerboard()
         self.assertEqual(cb.get_length(), 2)
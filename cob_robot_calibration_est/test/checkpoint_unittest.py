@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+import rospy
+import numpy
+import scipy.sparse
+
+from cob_robot_calibration_est.checkpoint import step_key, StepCheckpoint
+
+def loadStep():
+    system = {'transforms': {'head_link': [0.1, 0.0, 0.2, 0.0, 0.0, 0.3]}}
+    free = {'transforms': {'head_link': [1, 1, 1, 0, 0, 0]}}
+    sensors = {'camera_chains': [{'sensor_id': 'left', 'camera_id': 'left'}]}
+    return system, numpy.zeros([2, 6]), free, sensors
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_step_key(self):
+        system, poses, free, sensors = loadStep()
+        key = step_key("bag", system, poses, free, sensors, {'solver': 'leastsq'})
+        self.assertEqual(key, step_key("bag", loadStep()[0], poses.copy(), free, sensors, {'solver': 'leastsq'}))
+        self.assertNotEqual(key, step_key("other_bag", system, poses, free, sensors, {'solver': 'leastsq'}))
+        self.assertNotEqual(key, step_key("bag", system, poses + 1e-9, free, sensors, {'solver': 'leastsq'}))
+        self.assertNotEqual(key, step_key("bag", system, poses, free, sensors, {'solver': 'schur'}))
+        system['transforms']['head_link'][0] = 0.11
+        self.assertNotEqual(key, step_key("bag", system, poses, free, sensors, {'solver': 'leastsq'}))
+
+    def test_result(self):
+        system, poses, free, sensors = loadStep()
+        checkpoint = StepCheckpoint(self.tmp_dir, "step")
+        self.assertEqual(checkpoint.load_result(), None)
+        checkpoint.save_result(system, poses + 0.1, scipy.sparse.eye(3))
+
+        system_out, poses_out, information_out = StepCheckpoint(self.tmp_dir, "step").load_result()
+        self.assertEqual(system_out, system)
+        self.assertAlmostEqual(numpy.linalg.norm(poses_out - (poses + 0.1)), 0.0, 12)
+        self.assertAlmostEqual(numpy.linalg.norm(information_out.toarray() - numpy.eye(3)), 0.0, 12)
+
+    def test_snapshot(self):
+        checkpoint = StepCheckpoint(self.tmp_dir, "step", interval=1e6)
+        checkpoint.snapshot(numpy.array([1.0, 2.0]), numpy.array([3.0]))
+        checkpoint.snapshot(numpy.array([4.0, 5.0]), numpy.array([1.0]))
+        checkpoint.snapshot(numpy.array([6.0, 7.0]), numpy.array([2.0]))
+        # Nothing is written before the interval is over
+        self.assertEqual(checkpoint.load_snapshot(2), None)
+
+        # Only the best vector is kept
+        checkpoint.flush()
+        self.assertEqual(checkpoint.load_snapshot(2).tolist(), [4.0, 5.0])
+        self.assertEqual(checkpoint.load_snapshot(3), None)
+
+        checkpoint = StepCheckpoint(self.tmp_dir, "step", interval=0.0)
+        checkpoint.snapshot(numpy.array([8.0, 9.0]), numpy.array([5.0]))
+        self.assertEqual(checkpoint.load_snapshot(2).tolist(), [8.0, 9.0])
+
+if __name__ == '__main__':
+    import rostest
+    rostest.unitrun('cob_robot_calibration_est', 'test_Checkpoint', TestCheckpoint, coverage_packages=['cob_robot_calibration_est.checkpoint'])
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+import copy
+import shutil
+import tempfile
+import unittest
+import rospy
+import numpy
+import scipy.sparse
+
+from cob_robot_calibration_est.robot_params import RobotParams
+from cob_robot_calibration_est.opt_runner import ErrorCalc, build_opt_vector
+from cob_robot_calibration_est.synthetic import determinable_synthetic_problem, synthetic_multisensors
+from cob_robot_calibration_est.covariance import normal_matrix, marginal_information, marginal_covariance, unconstrained_params, save_sparse, load_sparse, std_summary
+
+def loadProblem(num_samples):
+    # Only the parameters that the measurements determine are free, so that J'*J is invertible
+    system, sensors, free, store, poses = determinable_synthetic_problem(num_samples)
+    multisensors = synthetic_multisensors(sensors, store)
+    robot_params = RobotParams()
+    robot_params.configure(copy.deepcopy(system))
+    error_calc = ErrorCalc(robot_params, copy.deepcopy(free), multisensors, True)
+    x = build_opt_vector(robot_params, copy.deepcopy(free), poses)
+    return error_calc, x, robot_params, free
+
+class TestCovariance(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_marginal_covariance(self):
+        error_calc, x, robot_params, free = loadProblem(50)
+        J = error_calc.calculate_sparse_jacobian(x)
+        N = normal_matrix(J)
+        self.assertTrue(scipy.sparse.issparse(N))
+
+        J_dense = J.toarray()
+        N_dense = numpy.dot(J_dense.T, J_dense)
+        self.assertTrue(numpy.abs(N.toarray() - N_dense).max() <= 1e-12 * numpy.abs(N_dense).max())
+
+        # The marginal covariance is the parameter block of the inverse of the full normal matrix
+        F = J.shape[1] - 6 * 50
+        expected = numpy.linalg.inv(N_dense)[:F, :F]
+        cov = marginal_covariance(N, 50)
+        self.assertEqual(cov.shape, (F, F))
+        # The pose blocks are badly scaled, which limits the accuracy of the dense inverse
+        self.assertTrue(numpy.allclose(cov, expected, rtol=1e-4, atol=1e-4 * numpy.abs(expected).max()))
+        self.assertTrue(numpy.all(numpy.diag(cov) > 0))
+
+    def test_unobserved_pose(self):
+        error_calc, x, robot_params, free = loadProblem(4)
+        J = error_calc.calculate_sparse_jacobian(x)
+        # Append the columns of a fifth pose that none of the measurements see
+        J_extra = scipy.sparse.hstack([J, scipy.sparse.csr_matrix((J.shape[0], 6))])
+        S = marginal_information(normal_matrix(J), 4)
+        S_extra = marginal_information(normal_matrix(J_extra), 5)
+        self.assertTrue(numpy.abs(S_extra - S).max() <= 1e-12 * numpy.abs(S).max())
+
+    def test_unobserved_parameter(self):
+        error_calc, x, robot_params, free = loadProblem(20)
+        J = error_calc.calculate_sparse_jacobian(x)
+        F = J.shape[1] - 6 * 20
+        cov = marginal_covariance(normal_matrix(J), 20)
+        # Insert a free parameter in front of the poses that none of the measurements depend on
+        J_extra = scipy.sparse.hstack([J[:, :F], scipy.sparse.csr_matrix((J.shape[0], 1)), J[:, F:]])
+        cov_extra = marginal_covariance(normal_matrix(J_extra), 20)
+        self.assertEqual(cov_extra.shape, (F + 1, F + 1))
+        self.assertTrue(numpy.isinf(cov_extra[F, F]))
+        self.assertTrue(numpy.all(numpy.isnan(cov_extra[F, :F])))
+        self.assertTrue(numpy.allclose(cov_extra[:F, :F], cov, rtol=1e-6, atol=1e-6 * numpy.abs(cov).max()))
+        self.assertEqual(unconstrained_params(cov_extra, ["p%u" % k for k in range(F + 1)]), ["p%u" % F])
+        summary = std_summary(cov_extra, ["p%u" % k for k in range(F + 1)])
+        self.assertTrue(numpy.isinf(summary["p%u" % F]))
+
+    def test_redundant_parameters(self):
+        error_calc, x, robot_params, free = loadProblem(20)
+        J = error_calc.calculate_sparse_jacobian(x).tocsc()
+        F = J.shape[1] - 6 * 20
+        # Two copies of the same column only constrain their sum
+        J_extra = scipy.sparse.hstack([J[:, :F], J[:, 0], J[:, F:]])
+        cov = marginal_covariance(normal_matrix(J_extra), 20)
+        self.assertTrue(numpy.isinf(cov[0, 0]))
+        self.assertTrue(numpy.isinf(cov[F, F]))
+        self.assertTrue(numpy.all(numpy.isfinite(numpy.diag(cov)[1:F])))
+
+    def test_save_sparse(self):
+        M = scipy.sparse.csr_matrix(numpy.array([[1.0, 0.0, 2.0], [0.0, 0.0, 3.0]]))
+        filename = self.tmp_dir + "/M.npz"
+        save_sparse(filename, M)
+        self.assertEqual(numpy.abs(load_sparse(filename) - M).max(), 0.0)
+
+    def test_std_summary(self):
+        error_calc, x, robot_params, free = loadProblem(4)
+        names = [name for name, f in zip(robot_params.get_param_names(), robot_params.calc_free(copy.deepcopy(free))) if f]
+        self.assertTrue("transforms.arm_cb_link.rx" in names)
+        self.assertTrue("transforms.cam_1_link.z" in names)
+        self.assertEqual(len(names), 12)
+
+        summary = std_summary(numpy.diag([4.0, 9.0]), ["a", "b"])
+        self.assertEqual(summary, {"a": 2.0, "b": 3.0})
+
+if __name__ == '__main__':
+    import rostest
+    rostest.unitrun('cob_robot_calibration_est', 'test_Covariance', TestCovariance, coverage_packages=['cob_robot_calibration_est.covariance'])
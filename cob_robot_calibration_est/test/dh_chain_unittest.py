@@ -43,6 +43,7 @@ import numpy
 from cob_robot_calibration_est.dh_chain import chain_T
 from cob_robot_calibration_est.dh_chain import DhChain
 from sensor_msgs.msg import JointState
+from control_msgs.msg import JointTrajectoryControllerState
 
 class LoadDhChain(unittest.TestCase):
     def setUp(self):
@@ -146,6 +147,88 @@ class TestDhChain(LoadDhChain):
                                       [ 0, 0, 0, 1]] )
         self.assertAlmostEqual(numpy.linalg.norm(eef-eef_expected), 0.0, 6)
 
+class TestDhChainJacobian(unittest.TestCase):
+    def setUp(self):
+        params = [{"name": "j1", "type" : "rotz", "xyzrpy":[0.1, 0.2, 0.3, 0.4, 0.5, 0.6]},
+                  {"name": "j2", "type" : "rotx", "xyzrpy":[1, 0, 2, -0.3, 0.2, 0.1]},
+                  {"name": "j3", "type" : "roty", "xyzrpy":[0.02, 0.3, 0.1, 0, 0, 1.1]}]
+        self.dh_chain = DhChain({'dh':params, 'gearing':[1, 0.9, 1.1], 'cov':[1, 1, 1]})
+        self.chain_state = JointTrajectoryControllerState()
+        self.chain_state.actual.positions = [0.3, -0.2, 0.7]
+
+    def test_fk_jacobian(self):
+        T, dT_params, dT_joints = self.dh_chain.fk_jacobian(self.chain_state)
+        self.assertAlmostEqual(numpy.linalg.norm(T - self.dh_chain.fk(self.chain_state)), 0.0, 6)
+        self.assertEqual(dT_params.shape, (21,4,4))
+        self.assertEqual(dT_joints.shape, (3,4,4))
+
+        param_vec = self.dh_chain.deflate()
+        for k in range(param_vec.shape[0]):
+            dp = numpy.matrix(numpy.zeros(param_vec.shape))
+            dp[k,0] = 1e-6
+            self.dh_chain.inflate(param_vec + dp)
+            T_plus = self.dh_chain.fk(self.chain_state)
+            self.dh_chain.inflate(param_vec - dp)
+            T_minus = self.dh_chain.fk(self.chain_state)
+            self.assertAlmostEqual(numpy.linalg.norm((T_plus - T_minus) / 2e-6 - dT_params[k]), 0.0, 6)
+        self.dh_chain.inflate(param_vec)
+
+        positions = self.chain_state.actual.positions
+        for k in range(len(positions)):
+            self.chain_state.actual.positions = list(positions)
+            self.chain_state.actual.positions[k] += 1e-6
+            T_plus = self.dh_chain.fk(self.chain_state)
+            self.chain_state.actual.positions[k] -= 2e-6
+            T_minus = self.dh_chain.fk(self.chain_state)
+            self.assertAlmostEqual(numpy.linalg.norm((T_plus - T_minus) / 2e-6 - dT_joints[k]), 0.0, 6)
+
+    def test_fk_joint_jacobian(self):
+        for link_num in [1, -1]:
+            T_j, dT_j = self.dh_chain.fk_joint_jacobian(self.chain_state, link_num)
+            T, dT_params, dT_joints = self.dh_chain.fk_jacobian(self.chain_state, link_num)
+            self.assertEqual(dT_j.shape, (3,4,4))
+            self.assertAlmostEqual(numpy.linalg.norm(T_j - T), 0.0, 6)
+            self.assertAlmostEqual(numpy.linalg.norm(dT_j - dT_joints), 0.0, 6)
+
+    def test_fk_many(self):
+        other_state = JointTrajectoryControllerState()
+        other_state.actual.positions = [-0.5, 0.1, 0.2]
+        T = self.dh_chain.fk_many([self.chain_state, other_state], 1)
+        self.assertEqual(T.shape, (2,4,4))
+        self.assertAlmostEqual(numpy.linalg.norm(T[0] - self.dh_chain.fk(self.chain_state, 1)), 0.0, 6)
+        self.assertAlmostEqual(numpy.linalg.norm(T[1] - self.dh_chain.fk(other_state, 1)), 0.0, 6)
+
+    def test_fk_batch(self):
+        other_state = JointTrajectoryControllerState()
+        other_state.actual.positions = [-0.5, 0.1, 0.2]
+        states = [self.chain_state, other_state]
+        for link_num in [0, 1, -1]:
+            T = self.dh_chain.fk_batch([s.actual.positions for s in states], link_num)
+            self.assertEqual(T.shape, (2,4,4))
+            for k in range(2):
+                self.assertAlmostEqual(numpy.linalg.norm(T[k] - self.dh_chain.fk(states[k], link_num)), 0.0, 6)
+
+    def test_prefetch(self):
+        T = self.dh_chain.fk(self.chain_state)
+        self.dh_chain.prefetch([self.chain_state])
+        self.assertAlmostEqual(numpy.linalg.norm(self.dh_chain.prefetched_fk(self.chain_state) - T), 0.0, 6)
+
+        param_vec = self.dh_chain.deflate()
+        param_vec[0,0] += 1
+        self.dh_chain.inflate(param_vec)
+        self.assertEqual(self.dh_chain.prefetched_fk(self.chain_state), None)
+
+    def test_chain_cache(self):
+        T = self.dh_chain.fk(self.chain_state)
+        version = self.dh_chain._version
+        self.dh_chain.inflate(self.dh_chain.deflate())
+        self.assertEqual(self.dh_chain._version, version)
+
+        param_vec = self.dh_chain.deflate()
+        param_vec[0,0] += 1
+        self.dh_chain.inflate(param_vec)
+        self.assertNotEqual(self.dh_chain._version, version)
+        self.assertAlmostEqual(numpy.linalg.norm(self.dh_chain.fk(self.chain_state) - T), 1.0, 6)
 
 class TestChainT(unittest.TestCase):
 
@@ -210,3 +293,4 @@ if __name__ == '__main__':
     import rostest
     rostest.unitrun('cob_robot_calibration_est', 'test_ChainT', TestChainT, coverage_packages=['cob_robot_calibration_est.dh_chain'])
     rostest.unitrun('cob_robot_calibration_est', 'test_DhChain', TestDhChain, coverage_packages=['cob_robot_calibration_est.dh_chain'])
+    rostest.unitrun('cob_robot_calibration_est', 'test_DhChainJacobian', TestDhChainJacobian, coverage_packages=['cob_robot_calibration_est.dh_chain'])
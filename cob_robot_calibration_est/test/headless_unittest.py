@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+import os
+import subprocess
+import unittest
+import rospy
+
+# Runs a synthetic calibration problem in a fresh interpreter and prints the ROS modules it loaded
+HEADLESS_SCRIPT = """
+import sys
+import copy
+from cob_robot_calibration_est.robot_params import RobotParams
+from cob_robot_calibration_est.opt_runner import ErrorCalc, build_opt_vector
+from cob_robot_calibration_est.parallel_error_calc import ParallelErrorCalc
+from cob_robot_calibration_est.measurement_cache import load_measurement_store
+from cob_robot_calibration_est.synthetic import synthetic_robot, set_synthetic_intrinsics, synthetic_measurements, synthetic_multisensors
+
+system, sensors, free = synthetic_robot(num_joints=3, num_cameras=2)
+set_synthetic_intrinsics(sensors)
+store, poses = synthetic_measurements(system, sensors, 3, noise=0.0)
+multisensors = synthetic_multisensors(sensors, store)
+robot_params = RobotParams()
+robot_params.configure(copy.deepcopy(system))
+error_calc = ErrorCalc(robot_params, copy.deepcopy(free), multisensors, True)
+x = build_opt_vector(robot_params, copy.deepcopy(free), poses)
+error_calc.calculate_residual(x)
+error_calc.calculate_jacobian_blocks(x)
+
+ros_modules = ['roslib', 'rospy', 'rosbag', 'tf', 'PyKDL', 'cv', 'cv2', 'cob_calibration_msgs', 'control_msgs', 'sensor_msgs']
+sys.stderr.write(repr(sorted([m for m in ros_modules if m in sys.modules])))
+"""
+
+class TestHeadless(unittest.TestCase):
+    def test_ros_free_import(self):
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        process = subprocess.Popen([sys.executable, '-c', HEADLESS_SCRIPT], env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        self.assertEqual(process.returncode, 0, err)
+        self.assertEqual(err.strip().splitlines()[-1], '[]')
+
+if __name__ == '__main__':
+    import rostest
+    rostest.unitrun('cob_robot_calibration_est', 'test_Headless', TestHeadless, coverage_packages=['cob_robot_calibration_est'])
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+import os
+import tempfile
+import unittest
+import rospy
+import numpy
+
+from cob_robot_calibration_est.intrinsics import read_intrinsics, set_intrinsics, get_intrinsics, clear_intrinsics
+
+class TestIntrinsics(unittest.TestCase):
+    def tearDown(self):
+        clear_intrinsics()
+
+    def test_set_get(self):
+        set_intrinsics("camA", [500, 0, 320, 0, 500, 240, 0, 0, 1], [0.1, 0.01, 0, 0, 0])
+        camera_matrix, distortion = get_intrinsics("camA")
+        self.assertEqual(camera_matrix.shape, (3,3))
+        self.assertAlmostEqual(camera_matrix[1,2], 240, 6)
+        self.assertAlmostEqual(distortion[1], 0.01, 6)
+
+        # The arrays are shared and read-only
+        self.assertTrue(get_intrinsics("camA")[0] is camera_matrix)
+        self.assertRaises(ValueError, camera_matrix.__setitem__, (0,0), 1.0)
+        self.assertRaises(ValueError, distortion.__setitem__, 0, 1.0)
+
+    def test_read_intrinsics(self):
+        f = tempfile.NamedTemporaryFile(suffix='.yaml', delete=False)
+        f.write('''
+image_width: 640
+image_height: 480
+camera_matrix:
+  rows: 3
+  cols: 3
+  data: [500, 0, 320, 0, 500, 240, 0, 0, 1]
+distortion_coefficients:
+  rows: 1
+  cols: 5
+  data: [0.1, 0.01, 0, 0, 0]
+''')
+        f.close()
+        try:
+            camera_matrix, distortion = read_intrinsics(f.name)
+        finally:
+            os.remove(f.name)
+        self.assertAlmostEqual(numpy.linalg.norm(camera_matrix - numpy.array([[500, 0, 320], [0, 500, 240], [0, 0, 1]])), 0.0, 6)
+        self.assertEqual(distortion.shape, (5,))
+
+if __name__ == '__main__':
+    import rostest
+    rostest.unitrun('cob_robot_calibration_est', 'test_Intrinsics', TestIntrinsics, coverage_packages=['cob_robot_calibration_est.intrinsics'])
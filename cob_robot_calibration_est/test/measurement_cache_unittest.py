@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+import os
+import shutil
+import tempfile
+import unittest
+import rospy
+import numpy
+
+from cob_robot_calibration_est.measurement_cache import bag_hash, write_cache, read_cache, load_measurements, load_measurement_store
+from measurement_store_unittest import loadMessages
+
+class TestMeasurementCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_round_trip(self):
+        path = os.path.join(self.tmp_dir, "cache")
+        write_cache(path, loadMessages())
+        msgs = read_cache(path)
+
+        self.assertEqual(len(msgs), 2)
+        self.assertEqual(msgs[0].sample_id, "s0")
+        self.assertEqual(msgs[1].chain_id, "chainB")
+        self.assertEqual(msgs[0].M_cam[0].camera_id, "camA")
+        self.assertEqual([(p.x, p.y) for p in msgs[0].M_cam[0].image_points], [(1, 2), (3, 4)])
+        self.assertEqual(len(msgs[1].M_cam), 0)
+        self.assertEqual([c.header.frame_id for c in msgs[1].M_chain], ["chainB", "chainA"])
+        self.assertEqual(list(msgs[1].M_chain[1].actual.positions), [0.0, 1.0])
+
+    def test_bag_hash(self):
+        filename = os.path.join(self.tmp_dir, "a.bag")
+        with open(filename, 'w') as f:
+            f.write("a" * 1000)
+        h = bag_hash(filename)
+        self.assertEqual(h, bag_hash(filename))
+        with open(filename, 'w') as f:
+            f.write("a" * 999 + "b")
+        self.assertNotEqual(h, bag_hash(filename))
+
+    def test_load_uses_cache(self):
+        filename = os.path.join(self.tmp_dir, "a.bag")
+        with open(filename, 'w') as f:
+            f.write("not a bag")
+        # Pre-populate the cache, so that the (invalid) bag is never opened
+        write_cache(os.path.join(self.tmp_dir, bag_hash(filename)), loadMessages())
+        msgs = load_measurements(filename, self.tmp_dir)
+        self.assertEqual(len(msgs), 2)
+
+    def test_load_measurement_store(self):
+        filename = os.path.join(self.tmp_dir, "a.bag")
+        with open(filename, 'w') as f:
+            f.write("not a bag")
+        write_cache(os.path.join(self.tmp_dir, bag_hash(filename)), loadMessages())
+        store = load_measurement_store(filename, self.tmp_dir)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store[0].M_cam[0].image_points.tolist(), [[1, 2], [3, 4]])
+        self.assertEqual([c.header.frame_id for c in store[1].M_chain], ["chainB", "chainA"])
+        self.assertEqual(list(store[1].M_chain[0].actual.positions), [2.0])
+
+if __name__ == '__main__':
+    import rostest
+    rostest.unitrun('cob_robot_calibration_est', 'test_MeasurementCache', TestMeasurementCache, coverage_packages=['cob_robot_calibration_est.measurement_cache'])
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+import unittest
+import rospy
+import numpy
+
+from cob_calibration_msgs.msg import RobotMeasurement, CameraMeasurement, ImagePoint
+from control_msgs.msg import JointTrajectoryControllerState
+from cob_robot_calibration_est.measurement_store import MeasurementStore, measurement_columns, store_measurements, image_point_array
+
+def chain_state(frame_id, positions):
+    state = JointTrajectoryControllerState()
+    state.header.frame_id = frame_id
+    state.actual.positions = positions
+    return state
+
+def loadMessages():
+    cam = CameraMeasurement()
+    cam.camera_id = "camA"
+    cam.image_points = [ImagePoint(1, 2), ImagePoint(3, 4)]
+    return [ RobotMeasurement(sample_id="s0", target_id="boardA", chain_id="chainA",
+                              M_cam=[cam], M_chain=[chain_state("chainA", [0.5, 1.5])]),
+             RobotMeasurement(sample_id="s1", target_id="boardA", chain_id="chainB",
+                              M_cam=[], M_chain=[chain_state("chainB", [2.0]), chain_state("chainA", [0.0, 1.0])]) ]
+
+class TestMeasurementStore(unittest.TestCase):
+    def test_samples(self):
+        store = store_measurements(loadMessages())
+
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store[0].sample_id, "s0")
+        self.assertEqual(store[1].chain_id, "chainB")
+        self.assertEqual([m.target_id for m in store], ["boardA", "boardA"])
+        self.assertEqual(store[0].M_cam[0].camera_id, "camA")
+        self.assertEqual(store[0].M_cam[0].image_points.tolist(), [[1, 2], [3, 4]])
+        self.assertEqual(len(store[1].M_cam), 0)
+        self.assertEqual([c.header.frame_id for c in store[1].M_chain], ["chainB", "chainA"])
+        self.assertEqual(list(store[1].M_chain[1].actual.positions), [0.0, 1.0])
+
+    def test_views(self):
+        store = store_measurements(loadMessages())
+        positions = store[1].M_chain[1].actual.positions
+        # The measurements are read-only views into the flat arrays, with shared headers
+        self.assertFalse(positions.flags.writeable)
+        self.assertTrue(positions.base is store[0].M_chain[0].actual.positions.base)
+        self.assertTrue(store[0].M_chain[0].header is store[1].M_chain[1].header)
+
+    def test_extend(self):
+        msgs = loadMessages()
+        store = MeasurementStore()
+        store.extend(measurement_columns(msgs[0:1]))
+        positions = store[0].M_chain[0].actual.positions
+        store.extend(measurement_columns(msgs[1:2]))
+        self.assertEqual([m.sample_id for m in store], ["s0", "s1"])
+        self.assertEqual([c.header.frame_id for c in store[1].M_chain], ["chainB", "chainA"])
+        self.assertEqual(list(store[1].M_chain[1].actual.positions), [0.0, 1.0])
+        self.assertTrue(store[0].M_chain[0].actual.positions is positions)
+        self.assertEqual(list(positions), [0.5, 1.5])
+
+    def test_full_chain_shared(self):
+        store = store_measurements(loadMessages())
+        config = {'chains': [{'chain_id': 'chainA', 'before_chain': [], 'after_chain': []}]}
+        config_dict = {'chains': ['chainA'], 'before_chain': [], 'after_chain': []}
+        chain = store.full_chain(config_dict, config)
+        self.assertTrue(chain is store.full_chain(config_dict, config))
+        self.assertFalse(chain is store.full_chain(dict(config_dict), config))
+
+    def test_image_point_array(self):
+        points = [ImagePoint(1, 2), ImagePoint(3, 4)]
+        self.assertEqual(image_point_array(points).tolist(), [[1, 2], [3, 4]])
+        self.assertEqual(image_point_array([]).shape, (0, 2))
+        a = numpy.zeros([3, 2])
+        self.assertTrue(image_point_array(a) is a)
+
+if __name__ == '__main__':
+    import rostest
+    rostest.unitrun('cob_robot_calibration_est', 'test_MeasurementStore', TestMeasurementStore, coverage_packages=['cob_robot_calibration_est.measurement_store'])
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+import copy
+import unittest
+import rospy
+import numpy
+
+from cob_robot_calibration_est.robot_params import RobotParams
+from cob_robot_calibration_est.measurement_store import StoredRobotMeasurement
+from cob_robot_calibration_est.synthetic import determinable_synthetic_problem, perturb_system
+from cob_robot_calibration_est.covariance import normal_matrix, marginal_information, marginal_covariance, eliminate_pose
+from cob_robot_calibration_est.online_estimator import OnlineEstimator, compress_rows, parameter_std
+
+def loadProblem(num_samples):
+    system, sensors, free, store, poses = determinable_synthetic_problem(num_samples)
+    return perturb_system(system, free, 0.01), sensors, free, store
+
+def free_params(system, free):
+    robot_params = RobotParams()
+    robot_params.configure(copy.deepcopy(system))
+    free_list = robot_params.calc_free(copy.deepcopy(free))
+    return numpy.array(robot_params.deflate()[numpy.where(free_list)[0]]).ravel()
+
+class TestOnlineEstimator(unittest.TestCase):
+    def test_matches_batch(self):
+        guess, sensors, free, store = loadProblem(20)
+        estimator = OnlineEstimator(guess, free, sensors, window=5)
+        for msg in store:
+            self.assertTrue(estimator.add_measurement(msg))
+        self.assertEqual(len(estimator.std_history), 20)
+        self.assertTrue(numpy.all(estimator.std_history[-1] < estimator.std_history[5]))
+
+        # The samples that left the window are only linearized once, so the result is close to,
+        # but not exactly the batch result
+        output_dict, output_poses, J = estimator.polish()
+        self.assertEqual(output_poses.shape, (20, 6))
+        batch_params = free_params(output_dict, free)
+        self.assertTrue(numpy.all(numpy.abs(estimator.params - batch_params) < 0.5 * estimator.std))
+        batch_std = numpy.sqrt(numpy.diag(marginal_covariance(normal_matrix(J), 20)))
+        self.assertTrue(numpy.allclose(estimator.std, batch_std, rtol=0.05))
+
+        summary = estimator.std_summary()
+        self.assertEqual(len(summary), 12)
+        self.assertEqual(summary["transforms.cam_1_link.z"], estimator.std[estimator.param_names.index("transforms.cam_1_link.z")])
+
+    def test_empty_measurement(self):
+        guess, sensors, free, store = loadProblem(1)
+        estimator = OnlineEstimator(guess, free, sensors, prior_std=0.1)
+        self.assertFalse(estimator.add_measurement(StoredRobotMeasurement("s0", "cb", "arm_chain")))
+        self.assertEqual(len(estimator.multisensors), 1)
+        self.assertEqual(len(estimator.std_history), 0)
+        self.assertTrue(numpy.allclose(estimator.std, 0.1))
+        self.assertTrue(numpy.all(estimator.params == free_params(guess, free)))
+
+    def test_eliminate_pose(self):
+        rand = numpy.random.RandomState(0)
+        J_params = rand.standard_normal([20, 3])
+        J_pose = rand.standard_normal([20, 6])
+        r = rand.standard_normal(20)
+        A, e = eliminate_pose(J_params, J_pose, r)
+        # A'A is the Schur complement of the pose block
+        S = marginal_information(normal_matrix(numpy.hstack([J_params, J_pose])), 1)
+        self.assertTrue(numpy.allclose(numpy.dot(A.T, A), S))
+        # The cost for a change of the parameters, with the optimal pose
+        dp = rand.standard_normal(3)
+        b = r + numpy.dot(J_params, dp)
+        dc = numpy.linalg.lstsq(J_pose, -b, rcond=None)[0]
+        cost = numpy.sum((b + numpy.dot(J_pose, dc)) ** 2)
+        self.assertAlmostEqual(numpy.sum((numpy.dot(A, dp) + e) ** 2), cost)
+
+    def test_compress_rows(self):
+        rand = numpy.random.RandomState(1)
+        A = rand.standard_normal([10, 3])
+        e = rand.standard_normal(10)
+        R, d = compress_rows(A, e)
+        self.assertEqual(R.shape, (3, 3))
+        self.assertTrue(numpy.allclose(numpy.dot(R.T, R), numpy.dot(A.T, A)))
+        self.assertTrue(numpy.allclose(numpy.dot(R.T, d), numpy.dot(A.T, e)))
+
+    def test_parameter_std(self):
+        R = numpy.array([[2.0, 1.0], [0.0, 1e-3]])
+        cov = numpy.linalg.inv(numpy.dot(R.T, R))
+        self.assertTrue(numpy.allclose(parameter_std(R), numpy.sqrt(numpy.diag(cov))))
+        self.assertTrue(numpy.all(numpy.isinf(parameter_std(numpy.zeros([0, 2])))))
+        self.assertTrue(numpy.all(numpy.isinf(parameter_std(numpy.array([[1.0, 2.0], [2.0, 4.0]])))))
+
+    def test_converged(self):
+        guess, sensors, free, store = loadProblem(1)
+        estimator = OnlineEstimator(guess, free, sensors)
+        estimator.std_history = [numpy.array([numpy.inf, 1.0]), numpy.array([1.0, 1.0])]
+        self.assertFalse(estimator.converged(0.05, 1))
+        estimator.std_history.append(numpy.array([0.9, 1.0]))
+        self.assertFalse(estimator.converged(0.05, 1))
+        estimator.std_history.append(numpy.array([0.88, 0.99]))
+        self.assertTrue(estimator.converged(0.05, 1))
+        self.assertFalse(estimator.converged(0.05, 2))
+
+if __name__ == '__main__':
+    import rostest
+    rostest.unitrun('cob_robot_calibration_est', 'test_OnlineEstimator', TestOnlineEstimator, coverage_packages=['cob_robot_calibration_est.online_estimator'])
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+from copy import deepcopy
+import unittest
+import rospy
+import numpy
+import scipy.sparse
+
+from cob_robot_calibration_est.opt_runner import assemble_sparse_jacobian, schur_step, column_groups, block_group_columns, opt_runner
+from cob_robot_calibration_est.synthetic import determinable_synthetic_problem, synthetic_multisensors, perturb_system
+from numpy import *
+
+class TestAssembleSparseJacobian(unittest.TestCase):
+    def test_layout(self):
+        J_params = array([[ 1, 0],
+                          [ 0, 2],
+                          [ 3, 4]], float)
+        J_poses = [ ones([2,6]), 2*ones([1,6]) ]
+
+        J = assemble_sparse_jacobian(J_params, J_poses)
+
+        expected = zeros([3, 2 + 12])
+        expected[:, 0:2] = J_params
+        expected[0:2, 2:8] = 1
+        expected[2, 8:14] = 2
+
+        self.assertEqual(J.shape, (3, 14))
+        self.assertEqual(J.nnz, 4 + 18)
+        self.assertAlmostEqual(numpy.linalg.norm(J.todense() - expected), 0.0, 6)
+
+    def test_empty_multisensor(self):
+        J_params = array([[ 1, 1]], float)
+        J_poses = [ zeros([0,6]), ones([1,6]) ]
+
+        J = assemble_sparse_jacobian(J_params, J_poses)
+
+        self.assertEqual(J.shape, (1, 14))
+        self.assertAlmostEqual(J.todense()[0, 2:8].sum(), 0.0, 6)
+        self.assertAlmostEqual(J.todense()[0, 8:14].sum(), 6.0, 6)
+
+    def test_param_blocks(self):
+        J_params = array([[ 1, 0, 5],
+                          [ 0, 2, 0],
+                          [ 3, 4, 0]], float)
+        J_poses = [ ones([3,6]) ]
+        param_blocks = [ (2, array([0, 1])), (1, array([1, 2])) ]
+
+        J = assemble_sparse_jacobian(J_params, J_poses, param_blocks)
+
+        expected = zeros([3, 3 + 6])
+        expected[0:2, 0:2] = J_params[0:2, 0:2]
+        expected[2, 1:3] = J_params[2, 1:3]
+        expected[:, 3:9] = 1
+
+        # Structural zeros are stored, the entries outside of the blocks are not
+        self.assertEqual(J.nnz, 6 + 18)
+        self.assertAlmostEqual(numpy.linalg.norm(J.todense() - expected), 0.0, 6)
+
+class TestSchurStep(unittest.TestCase):
+    def setUp(self):
+        random.seed(0)
+        self.J_params = random.randn(30, 4)
+        self.J_poses = [ random.randn(12, 6), random.randn(18, 6) ]
+        self.r = random.randn(30)
+        self.J = assemble_sparse_jacobian(self.J_params, self.J_poses).toarray()
+
+    def dense_step(self, damping):
+        D = sqrt((self.J ** 2).sum(0))
+        A = concatenate([self.J, sqrt(damping) * diag(D)])
+        b = concatenate([self.r, zeros(self.J.shape[1])])
+        return numpy.linalg.lstsq(A, -b, rcond=None)[0]
+
+    def test_gauss_newton(self):
+        dx, J_dx = schur_step(self.J_params, self.J_poses, self.r, 0.0)
+        self.assertEqual(dx.shape, (4 + 12,))
+        self.assertAlmostEqual(numpy.linalg.norm(dx - self.dense_step(0.0)), 0.0, 6)
+        self.assertAlmostEqual(numpy.linalg.norm(J_dx - dot(self.J, dx)), 0.0, 6)
+
+    def test_damped(self):
+        dx, J_dx = schur_step(self.J_params, self.J_poses, self.r, 0.5)
+        self.assertAlmostEqual(numpy.linalg.norm(dx - self.dense_step(0.5)), 0.0, 6)
+        self.assertAlmostEqual(numpy.linalg.norm(J_dx - dot(self.J, dx)), 0.0, 6)
+
+    def test_unobserved_pose(self):
+        J_poses = [ self.J_poses[0], zeros([18, 6]) ]
+        self.assertRaises(numpy.linalg.LinAlgError, schur_step, self.J_params, J_poses, self.r, 0.0)
+        dx, J_dx = schur_step(self.J_params, J_poses, self.r, 0.5)
+        self.assertAlmostEqual(numpy.linalg.norm(dx[10:16]), 0.0, 6)
+
+class TestColumnGroups(unittest.TestCase):
+    def setUp(self):
+        # Two samples with a chain sensor (params 0,1) and a camera (params 1,2) each,
+        # plus a pose (columns 4:10 and 10:16) per sample. Param 3 isn't used at all.
+        self.block_cols = [ [0, 1] + range(4, 10),
+                            [1, 2] + range(4, 10),
+                            [0, 1] + range(10, 16),
+                            [1, 2] + range(10, 16) ]
+
+    def test_orthogonal(self):
+        groups = column_groups(self.block_cols, 16)
+        self.assertEqual(sorted(concatenate(groups)), range(16))
+        for group in groups:
+            for cols in self.block_cols:
+                self.assertTrue(len(intersect1d(group, cols)) <= 1)
+        # The chain sensors never see param 2 and the cameras never see param 0, so they share a group.
+        # Param 1 appears in all rows and only shares its group with the unused param 3.
+        self.assertEqual(len(groups), 2 + 6)
+
+    def test_block_group_columns(self):
+        groups = [ array([0, 2, 3]), array([1]), array([4, 10]) ]
+        columns = block_group_columns(groups, [ [0, 1], [1, 2], [4, 5], [] ])
+        self.assertEqual(columns.tolist(), [ [ 0,  2, -1, -1],
+                                             [ 1,  1, -1, -1],
+                                             [-1, -1,  4, -1] ])
+
+class TestOptRunner(unittest.TestCase):
+    def test_sparse_jacobian(self):
+        system, sensors, free, store, poses = determinable_synthetic_problem(3)
+        guess = perturb_system(system, free, 0.001)
+        for solver in ['leastsq', 'schur']:
+            output_dict, output_poses, J = opt_runner(deepcopy(guess), poses, deepcopy(free), synthetic_multisensors(sensors, store),
+                                                      True, solver)
+            self.assertEqual(output_poses.shape, (3, 6))
+            self.assertTrue(scipy.sparse.issparse(J))
+            self.assertEqual(J.shape[1], 12 + 3 * 6)
+
+if __name__ == '__main__':
+    import rostest
+    rostest.unitrun('cob_robot_calibration_est', 'test_AssembleSparseJacobian', TestAssembleSparseJacobian, coverage_packages=['cob_robot_calibration_est.opt_runner'])
+    rostest.unitrun('cob_robot_calibration_est', 'test_SchurStep', TestSchurStep, coverage_packages=['cob_robot_calibration_est.opt_runner'])
+    rostest.unitrun('cob_robot_calibration_est', 'test_ColumnGroups', TestColumnGroups, coverage_packages=['cob_robot_calibration_est.opt_runner'])
+    rostest.unitrun('cob_robot_calibration_est', 'test_OptRunner', TestOptRunner, coverage_packages=['cob_robot_calibration_est.opt_runner'])
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+from copy import deepcopy
+import unittest
+import rospy
+import numpy
+
+from cob_robot_calibration_est.robot_params import RobotParams
+from cob_robot_calibration_est.opt_runner import ErrorCalc, build_opt_vector
+from cob_robot_calibration_est.parallel_error_calc import ParallelErrorCalc, shard_ranges, shared_array
+from cob_robot_calibration_est.synthetic import synthetic_robot, set_synthetic_intrinsics, synthetic_measurements, synthetic_multisensors, perturb_system
+from numpy import *
+
+class TestShardRanges(unittest.TestCase):
+    def test_even(self):
+        self.assertEqual(shard_ranges([2, 2, 2, 2], 2), [(0, 2), (2, 4)])
+
+    def test_balanced_rows(self):
+        self.assertEqual(shard_ranges([6, 1, 1, 1, 1, 1, 1], 2), [(0, 1), (1, 7)])
+
+    def test_more_shards_than_multisensors(self):
+        self.assertEqual(shard_ranges([3, 3], 4), [(0, 1), (1, 2)])
+
+    def test_covers_all(self):
+        ranges = shard_ranges([5, 1, 7, 2, 2, 9, 4], 3)
+        self.assertEqual(ranges[0][0], 0)
+        self.assertEqual(ranges[-1][1], 7)
+        for (first0, last0), (first1, last1) in zip(ranges[0:-1], ranges[1:]):
+            self.assertEqual(last0, first1)
+
+class TestSharedArray(unittest.TestCase):
+    def test_shape(self):
+        a = shared_array((3, 4))
+        self.assertEqual(a.shape, (3, 4))
+        self.assertAlmostEqual(numpy.linalg.norm(a), 0.0, 6)
+
+    def test_empty(self):
+        a = shared_array((0, 6))
+        self.assertEqual(a.shape, (0, 6))
+
+def loadErrorCalcs(use_cov, jacobian='analytic', num_samples=5):
+    system, sensors, free = synthetic_robot(num_joints=3, num_cameras=2, corners_x=3, corners_y=2)
+    set_synthetic_intrinsics(sensors)
+    store, poses = synthetic_measurements(system, sensors, num_samples)
+    # Evaluate away from the true parameters, where the residual isn't just noise
+    guess = perturb_system(system, free, 0.01)
+    robot_params = RobotParams()
+    robot_params.configure(deepcopy(guess))
+    x = build_opt_vector(robot_params, deepcopy(free), poses + 0.01)
+    serial = ErrorCalc(robot_params, deepcopy(free), synthetic_multisensors(sensors, store), use_cov, jacobian)
+    robot_params = RobotParams()
+    robot_params.configure(deepcopy(guess))
+    parallel = ParallelErrorCalc(robot_params, deepcopy(free), synthetic_multisensors(sensors, store), use_cov, jacobian, processes=2)
+    return serial, parallel, x
+
+class TestParallelErrorCalc(unittest.TestCase):
+    def compare(self, use_cov, jacobian='analytic'):
+        serial, parallel, x = loadErrorCalcs(use_cov, jacobian)
+        try:
+            self.assertEqual(len(parallel._workers), 2)
+            r = serial.calculate_residual(x)
+            self.assertTrue(numpy.abs(r).max() > 0.0)
+            self.assertTrue(numpy.allclose(parallel.calculate_residual(x), r, rtol=1e-12, atol=1e-12))
+
+            J_params, J_poses = serial.calculate_jacobian_blocks(x)
+            J_params_par, J_poses_par = parallel.calculate_jacobian_blocks(x)
+            self.assertTrue(numpy.allclose(J_params_par, J_params, rtol=1e-12, atol=1e-12))
+            self.assertEqual(len(J_poses_par), len(J_poses))
+            for J_pose, J_pose_par in zip(J_poses, J_poses_par):
+                self.assertTrue(numpy.allclose(J_pose_par, numpy.array(J_pose).reshape(-1, 6), rtol=1e-12, atol=1e-12))
+
+            J = numpy.array(serial.calculate_jacobian(x))
+            self.assertTrue(numpy.allclose(parallel.calculate_sparse_jacobian(x).toarray(), J, rtol=1e-12, atol=1e-12))
+            self.assertTrue(numpy.allclose(numpy.array(parallel.calculate_jacobian(x)), J, rtol=1e-12, atol=1e-12))
+        finally:
+            parallel.close()
+
+    def test_matches_serial(self):
+        self.compare(False)
+
+    def test_matches_serial_use_cov(self):
+        self.compare(True)
+
+    def test_matches_serial_numeric(self):
+        self.compare(True, 'numeric')
+
+    def test_worker_error(self):
+        serial, parallel, x = loadErrorCalcs(False)
+        try:
+            try:
+                parallel.run_workers('unknown', x)
+                self.fail("run_workers didn't raise")
+            except Exception, e:
+                self.assertTrue("Worker process failed" in str(e))
+                self.assertTrue("Traceback" in str(e))
+                self.assertTrue("Unknown command [unknown]" in str(e))
+            # The workers keep serving requests after a failure
+            self.assertTrue(numpy.allclose(parallel.calculate_residual(x), serial.calculate_residual(x), rtol=1e-12, atol=1e-12))
+        finally:
+            parallel.close()
+
+    def test_close(self):
+        serial, parallel, x = loadErrorCalcs(False)
+        processes = [process for process, conn in parallel._workers]
+        self.assertTrue(all([process.is_alive() for process in processes]))
+        parallel.close()
+        self.assertEqual(parallel._workers, [])
+        for process in processes:
+            self.assertFalse(process.is_alive())
+            self.assertEqual(process.exitcode, 0)
+        self.assertRaises(Exception, parallel.calculate_residual, x)
+
+if __name__ == '__main__':
+    import rostest
+    rostest.unitrun('cob_robot_calibration_est', 'test_ShardRanges', TestShardRanges, coverage_packages=['cob_robot_calibration_est.parallel_error_calc'])
+    rostest.unitrun('cob_robot_calibration_est', 'test_SharedArray', TestSharedArray, coverage_packages=['cob_robot_calibration_est.parallel_error_calc'])
+    rostest.unitrun('cob_robot_calibration_est', 'test_ParallelErrorCalc', TestParallelErrorCalc, coverage_packages=['cob_robot_calibration_est.parallel_error_calc'])
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import rospy
+
+from cob_robot_calibration_est import profiling
+from cob_robot_calibration_est.profiling import timed, Profiler
+
+@timed('square')
+def square(x):
+    return x * x
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        profiling.disable()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_disabled(self):
+        profiler = Profiler()
+        self.assertEqual(square(3), 9)
+        self.assertEqual(profiler.statistics()['totals'], {})
+        self.assertEqual(profiling.disable(), None)
+
+    def test_timed(self):
+        profiler = profiling.enable()
+        square(2)
+        square(3)
+        profiling.next_iteration()
+        square(4)
+        self.assertEqual(profiling.disable(), profiler)
+        square(5)
+
+        stats = profiler.statistics()
+        self.assertEqual(stats['totals']['square']['calls'], 3)
+        self.assertEqual(len(stats['iterations']), 2)
+        self.assertEqual(stats['iterations'][0]['square']['calls'], 2)
+        self.assertEqual(stats['iterations'][1]['square']['calls'], 1)
+        self.assertEqual(len(profiler.events), 3)
+
+    def test_max_events(self):
+        profiler = profiling.enable(Profiler(max_events=1))
+        square(2)
+        square(3)
+        self.assertEqual(len(profiler.events), 1)
+        self.assertEqual(profiler.statistics()['totals']['square']['calls'], 2)
+
+    def test_exception(self):
+        @timed('fail')
+        def fail():
+            raise ValueError()
+        profiler = profiling.enable()
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(profiler.statistics()['totals']['fail']['calls'], 1)
+
+    def test_write(self):
+        profiler = profiling.enable()
+        square(2)
+        profiling.next_iteration()
+        square(3)
+        json_filename = os.path.join(self.tmp_dir, 'profile.json')
+        trace_filename = os.path.join(self.tmp_dir, 'profile_trace.json')
+        profiler.write_json(json_filename)
+        profiler.write_chrome_trace(trace_filename)
+
+        stats = json.load(open(json_filename))
+        self.assertEqual(stats['totals']['square']['calls'], 2)
+        trace = json.load(open(trace_filename))
+        self.assertEqual(len(trace['traceEvents']), 2)
+        event = trace['traceEvents'][1]
+        self.assertEqual(event['name'], 'square')
+        self.assertEqual(event['ph'], 'X')
+        self.assertEqual(event['args']['iteration'], 1)
+        self.assertTrue(event['dur'] >= 0)
+
+if __name__ == '__main__':
+    import rostest
+    rostest.unitrun('cob_robot_calibration_est', 'test_Profiling', TestProfiling, coverage_packages=['cob_robot_calibration_est.profiling'])
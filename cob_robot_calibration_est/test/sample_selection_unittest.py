@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+import copy
+import unittest
+import rospy
+import numpy
+
+from cob_robot_calibration_est.robot_params import RobotParams
+from cob_robot_calibration_est.opt_runner import ErrorCalc, build_opt_vector
+from cob_robot_calibration_est.synthetic import determinable_synthetic_problem, synthetic_multisensors
+from cob_robot_calibration_est.covariance import normal_matrix, marginal_information
+from cob_robot_calibration_est.sample_selection import sample_information, select_samples, choose_samples
+
+def loadProblem(num_samples):
+    system, sensors, free, store, poses = determinable_synthetic_problem(num_samples)
+    return system, free, synthetic_multisensors(sensors, store), poses
+
+def log_det(info_rows):
+    A = numpy.vstack(info_rows)
+    return numpy.linalg.slogdet(numpy.dot(A.T, A))[1]
+
+class TestSampleSelection(unittest.TestCase):
+    def test_sample_information(self):
+        system, free, multisensors, poses = loadProblem(5)
+        robot_params = RobotParams()
+        robot_params.configure(copy.deepcopy(system))
+        error_calc = ErrorCalc(robot_params, copy.deepcopy(free), multisensors, True)
+        x = build_opt_vector(robot_params, copy.deepcopy(free), poses)
+        info_rows = sample_information(error_calc, x)
+        self.assertEqual(len(info_rows), 5)
+
+        # The information of all samples is the Schur complement of the full normal matrix
+        S = marginal_information(normal_matrix(error_calc.calculate_sparse_jacobian(x)), 5)
+        A = numpy.vstack(info_rows)
+        self.assertTrue(numpy.allclose(numpy.dot(A.T, A), S, rtol=1e-8, atol=1e-8 * numpy.abs(S).max()))
+
+    def test_select_samples(self):
+        rand = numpy.random.RandomState(0)
+        info_rows = [rand.standard_normal([2, 4]) for k in range(12)]
+        selected = select_samples(info_rows, 5)
+        self.assertEqual(len(selected), 5)
+        self.assertEqual(list(selected), sorted(set(selected)))
+
+        # Same result as the plain greedy selection without the heap
+        M = 1e-6 * numpy.diag(sum((A ** 2).sum(0) for A in info_rows))
+        greedy = []
+        for step in range(5):
+            gains = [numpy.linalg.slogdet(M + numpy.dot(A.T, A))[1] if k not in greedy else -numpy.inf
+                     for k, A in enumerate(info_rows)]
+            greedy.append(int(numpy.argmax(gains)))
+            M = M + numpy.dot(info_rows[greedy[-1]].T, info_rows[greedy[-1]])
+        self.assertEqual(list(selected), sorted(greedy))
+
+        self.assertEqual(len(select_samples(info_rows, 20)), 12)
+        self.assertEqual(len(select_samples([], 3)), 0)
+
+    def test_redundant_samples(self):
+        # Repeated measurements of the same direction only add little information
+        A = numpy.array([[1.0, 0.0, 0.0]])
+        info_rows = [A, A, A, numpy.array([[0.0, 0.1, 0.0]]), numpy.zeros([0, 3]), numpy.array([[0.0, 0.0, 0.1]])]
+        self.assertEqual(list(select_samples(info_rows, 3)), [0, 3, 5])
+        self.assertEqual(list(select_samples(info_rows, 5)), [0, 1, 2, 3, 5])
+
+    def test_choose_samples(self):
+        system, free, multisensors, poses = loadProblem(40)
+        # The poses are guessed from the forward kinematics
+        selected, pose_guesses = choose_samples(system, free, multisensors, numpy.zeros([40, 6]), True, 10)
+        self.assertEqual(len(selected), 10)
+        self.assertEqual(pose_guesses.shape, (40, 6))
+        # Without errors in the system, they only differ by the noise of the joint positions
+        self.assertTrue(numpy.abs(pose_guesses - poses).max() < 0.01)
+
+        robot_params = RobotParams()
+        robot_params.configure(copy.deepcopy(system))
+        error_calc = ErrorCalc(robot_params, copy.deepcopy(free), multisensors, True)
+        info_rows = sample_information(error_calc, build_opt_vector(robot_params, copy.deepcopy(free), poses))
+        # The selection is more informative than evenly spread samples
+        self.assertTrue(log_det([info_rows[k] for k in selected]) > log_det(info_rows[::4]))
+
+if __name__ == '__main__':
+    import rostest
+    rostest.unitrun('cob_robot_calibration_est', 'test_SampleSelection', TestSampleSelection, coverage_packages=['cob_robot_calibration_est.sample_selection'])
@@ -40,7 +40,7 @@ import rospy
 import time
 import numpy
 
-from cob_robot_calibration_est.single_transform import SingleTransform
+from cob_robot_calibration_est.single_transform import SingleTransform, pose_jacobian, pose_transforms, rotation_vectors
 from numpy import *
 
 
@@ -150,6 +150,19 @@ class TestSingleTransform(unittest.TestCase):
 
         self.assertAlmostEqual(numpy.linalg.norm(st.transform-expected), 0.0, 6)
 
+    def test_pose_jacobian(self):
+        for p in [ [0, 0, 0, 0, 0, 0],
+                   [1, 2, 3, 0, 0, pi/2],
+                   [0.1, -0.2, 0.3, 0.4, -0.5, 0.6] ]:
+            J = pose_jacobian(p)
+            self.assertEqual(J.shape, (6,4,4))
+            for k in range(6):
+                dp = numpy.zeros(6)
+                dp[k] = 1e-6
+                T_plus = SingleTransform().inflate(numpy.array(p) + dp, True)
+                T_minus = SingleTransform().inflate(numpy.array(p) - dp, True)
+                self.assertAlmostEqual(numpy.linalg.norm((T_plus - T_minus) / 2e-6 - J[k]), 0.0, 6)
+
     def test_length(self):
         st = SingleTransform([0, 0, 0, 0, 0, 0])
         self.assertEqual(st.get_length(), 6)
@@ -188,6 +201,26 @@ class TestSingleTransform(unittest.TestCase):
         st=SingleTransform(p)
         self.assertAlmostEqual(numpy.linalg.norm(st.transform-st.inflate_old(p)), 0.0,4)
 
+    def test_pose_transforms(self):
+        poses = numpy.random.randn(10,6)
+        poses[0] = 0
+        poses[1,3:6] = [1e-9, 0, -1e-9]
+        T = pose_transforms(poses)
+        self.assertEqual(T.shape, (10,4,4))
+        for p, T_p in zip(poses, T):
+            st = SingleTransform(list(p))
+            self.assertAlmostEqual(numpy.linalg.norm(st.transform - T_p), 0.0, 12)
+            self.assertAlmostEqual(numpy.linalg.norm(numpy.dot(T_p[0:3,0:3].T, T_p[0:3,0:3]) - numpy.eye(3)), 0.0, 12)
+
+    def test_rotation_vectors(self):
+        r = numpy.array([[0, 0, 0],
+                         [1e-9, 2e-9, 0],
+                         [0.1, -0.2, 0.3],
+                         [0, 0, pi - 1e-9],
+                         [1, 2, -2]], float)
+        T = pose_transforms(numpy.hstack([numpy.zeros((5,3)), r]))
+        result = rotation_vectors(T[:,0:3,0:3])
+        self.assertAlmostEqual(numpy.linalg.norm(result - r), 0.0, 6)
 
 if __name__ == '__main__':
     import rostest
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+#################################################################
+##\file
+#
+# \note
+#   Copyright (c) 2013 \n
+#   Fraunhofer Institute for Manufacturing Engineering
+#   and Automation (IPA) \n\n
+#
+#################################################################
+#
+# \note
+#   Project name: care-o-bot
+# \note
+#   ROS stack name: cob_calibration
+# \note
+#   ROS package name: cob_robot_calibration_est
+#
+#################################################################
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer. \n
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution. \n
+#     - Neither the name of the Fraunhofer Institute for Manufacturing
+#       Engineering and Automation (IPA) nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission. \n
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License LGPL as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License LGPL for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License LGPL along with this program.
+# If not, see <http://www.gnu.org/licenses/>.
+#
+#################################################################
+
+
+
+import roslib; roslib.load_manifest('cob_robot_calibration_est')
+
+import sys
+import copy
+import unittest
+import rospy
+import numpy
+
+from cob_robot_calibration_est.robot_params import RobotParams
+from cob_robot_calibration_est.opt_runner import ErrorCalc, build_opt_vector
+from cob_robot_calibration_est.synthetic import synthetic_robot, set_synthetic_intrinsics, synthetic_measurements, synthetic_multisensors, determinable_synthetic_problem, perturb_system
+
+def loadErrorCalc(system, sensors, free, store, use_cov=False):
+    robot_params = RobotParams()
+    robot_params.configure(copy.deepcopy(system))
+    return ErrorCalc(robot_params, copy.deepcopy(free), synthetic_multisensors(sensors, store), use_cov), robot_params
+
+class TestSynthetic(unittest.TestCase):
+    def setUp(self):
+        self.system, self.sensors, self.free = synthetic_robot(num_joints=4, num_cameras=3, corners_x=3, corners_y=2)
+        set_synthetic_intrinsics(self.sensors)
+
+    def test_measurements(self):
+        store, poses = synthetic_measurements(self.system, self.sensors, 5)
+        self.assertEqual(len(store), 5)
+        self.assertEqual(poses.shape, (5, 6))
+        for msg in store:
+            self.assertEqual([m.camera_id for m in msg.M_cam], ['cam_0', 'cam_1', 'cam_2'])
+            self.assertEqual([m.image_points.shape for m in msg.M_cam], [(6, 2)] * 3)
+            self.assertEqual([len(c.actual.positions) for c in msg.M_chain], [4, 2])
+
+    def test_noise_free(self):
+        store, poses = synthetic_measurements(self.system, self.sensors, 5, noise=0.0)
+        error_calc, robot_params = loadErrorCalc(self.system, self.sensors, self.free, store)
+        x = build_opt_vector(robot_params, copy.deepcopy(self.free), poses)
+        self.assertAlmostEqual(numpy.abs(error_calc.calculate_residual(x)).max(), 0.0, 6)
+
+    def test_noise(self):
+        # Scaled by the covariances, the residual of the true parameters has unit variance
+        store, poses = synthetic_measurements(self.system, self.sensors, 50)
+        error_calc, robot_params = loadErrorCalc(self.system, self.sensors, self.free, store, True)
+        x = build_opt_vector(robot_params, copy.deepcopy(self.free), poses)
+        r = error_calc.calculate_residual(x)
+        self.assertTrue(0.8 < numpy.sqrt(numpy.mean(r ** 2)) < 1.2)
+
+    def test_multisensors(self):
+        store, poses = synthetic_measurements(self.system, self.sensors, 3)
+        multisensors = synthetic_multisensors(self.sensors, store)
+        self.assertEqual(len(multisensors), 3)
+        for ms in multisensors:
+            self.assertEqual(sorted([sensor.sensor_id for sensor in ms.sensors]), ['arm_chain', 'cam_0', 'cam_1', 'cam_2'])
+
+    def test_determinable_problem(self):
+        system, sensors, free, store, poses = determinable_synthetic_problem(10)
+        self.assertEqual(len(store), 10)
+        error_calc, robot_params = loadErrorCalc(system, sensors, free, store, True)
+        x = build_opt_vector(robot_params, copy.deepcopy(free), poses)
+        J = error_calc.calculate_jacobian(x)
+        self.assertEqual(numpy.linalg.matrix_rank(J), J.shape[1])
+
+    def test_perturb_system(self):
+        guess = perturb_system(self.system, self.free, 0.01)
+        self.assertEqual(guess['transforms']['head_base_link'], self.system['transforms']['head_base_link'])
+        self.assertNotEqual(guess['transforms']['arm_cb_link'], self.system['transforms']['arm_cb_link'])
+        offsets = numpy.array(guess['transforms']['arm_cb_link']) - numpy.array(self.system['transforms']['arm_cb_link'])
+        self.assertTrue(numpy.abs(offsets).max() <= 0.01)
+
+if __name__ == '__main__':
+    import rostest
+    rostest.unitrun('cob_robot_calibration_est', 'test_Synthetic', TestSynthetic, coverage_packages=['cob_robot_calibration_est.synthetic'])